@@ -5,13 +5,43 @@ import secrets
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 from pydantic import BaseModel, Field
-import psycopg2
 from psycopg2.extras import RealDictCursor
 
+from db import Statement, get_pool, run
+from sessions import get_session_token, invalidate_session
+from instrument import instrumented, phase
+
+os.environ.setdefault('PYDANTIC_DISABLE_PLUGINS', '__all__')
+
 class LoginRequest(BaseModel):
     username: str = Field(..., min_length=1)
     password: str = Field(..., min_length=1)
 
+LOGIN_LOOKUP = Statement('login_lookup', """
+    SELECT id, username, email, password_hash, full_name, avatar_url, created_at
+    FROM users 
+    WHERE username = $1 OR email = $1
+""", ('text',))
+
+TOUCH_PRESENCE = Statement('touch_presence', """
+    INSERT INTO user_presence (user_id, last_active_at)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE
+    SET last_active_at = EXCLUDED.last_active_at
+    WHERE user_presence.last_active_at < EXCLUDED.last_active_at
+""", ('int', 'timestamp'))
+
+# The revocation row tells the other functions' session caches to drop the token
+REVOKE_SESSION = Statement('revoke_session', """
+    WITH revoked AS (
+        DELETE FROM sessions WHERE session_token = $1 RETURNING session_token
+    ), pruned AS (
+        DELETE FROM session_revocations WHERE revoked_at < $2 - interval '1 day'
+    )
+    INSERT INTO session_revocations (session_token, revoked_at)
+    SELECT session_token, $2 FROM revoked
+""", ('text', 'timestamp'))
+
 def verify_password(stored_hash: str, provided_password: str) -> bool:
     try:
         salt, pwd_hash = stored_hash.split('$')
@@ -23,10 +53,11 @@ def verify_password(stored_hash: str, provided_password: str) -> bool:
 def generate_session_token() -> str:
     return secrets.token_urlsafe(32)
 
+@instrumented('auth-login')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: User login endpoint
-    Args: event with httpMethod, body (username, password)
+    Business: User login and logout endpoint
+    Args: event with httpMethod, body (username, password) or body (action=logout) with X-Auth-Token header
           context with request_id
     Returns: HTTP response with user data and session token
     '''
@@ -38,7 +69,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -55,69 +86,79 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         body_data = json.loads(event.get('body', '{}'))
-        login_request = LoginRequest(**body_data)
         
         database_url = os.environ.get('DATABASE_URL')
         if not database_url:
             raise ValueError('DATABASE_URL not configured')
         
-        conn = psycopg2.connect(database_url)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(
-            """SELECT id, username, email, password_hash, full_name, avatar_url, created_at
-               FROM users 
-               WHERE username = %s OR email = %s""",
-            (login_request.username, login_request.username)
-        )
-        user = cur.fetchone()
-        
-        if not user or not verify_password(user['password_hash'], login_request.password):
-            cur.close()
-            conn.close()
+        if body_data.get('action') == 'logout':
+            session_token = get_session_token(event) or body_data.get('session_token')
+            if not session_token:
+                raise ValueError('session_token is required')
+            
+            with get_pool(database_url).connection() as conn:
+                cur = conn.cursor()
+                run(cur, REVOKE_SESSION, (session_token, datetime.utcnow()))
+                conn.commit()
+                cur.close()
+            
+            invalidate_session(session_token)
+            
             return {
-                'statusCode': 401,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid username or password'}),
+                'body': json.dumps({'success': True}),
                 'isBase64Encoded': False
             }
         
-        cur.execute(
-            """UPDATE users 
-               SET online_status = %s, last_seen = %s 
-               WHERE id = %s""",
-            (True, datetime.utcnow(), user['id'])
-        )
+        with phase('validate'):
+            login_request = LoginRequest(**body_data)
         
-        session_token = generate_session_token()
-        expires_at = datetime.utcnow() + timedelta(days=30)
+        with get_pool(database_url).connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute(
-            """INSERT INTO sessions (user_id, session_token, expires_at)
-               VALUES (%s, %s, %s)""",
-            (user['id'], session_token, expires_at)
-        )
+            run(cur, LOGIN_LOOKUP, (login_request.username,))
+            user = cur.fetchone()
         
-        conn.commit()
-        cur.close()
-        conn.close()
+            if not user or not verify_password(user['password_hash'], login_request.password):
+                cur.close()
+                return {
+                    'statusCode': 401,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid username or password'}),
+                    'isBase64Encoded': False
+                }
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'user': {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'email': user['email'],
-                    'full_name': user['full_name'],
-                    'avatar_url': user['avatar_url'],
-                    'created_at': user['created_at'].isoformat() if user['created_at'] else None
-                },
-                'session_token': session_token
-            }),
-            'isBase64Encoded': False
-        }
+            run(cur, TOUCH_PRESENCE, (user['id'], datetime.utcnow()))
+        
+            session_token = generate_session_token()
+            expires_at = datetime.utcnow() + timedelta(days=30)
+        
+            cur.execute(
+                """INSERT INTO sessions (user_id, session_token, expires_at)
+                   VALUES (%s, %s, %s)""",
+                (user['id'], session_token, expires_at)
+            )
+        
+            conn.commit()
+            cur.close()
+        
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'user': {
+                        'id': user['id'],
+                        'username': user['username'],
+                        'email': user['email'],
+                        'full_name': user['full_name'],
+                        'avatar_url': user['avatar_url'],
+                        'created_at': user['created_at'].isoformat() if user['created_at'] else None
+                    },
+                    'session_token': session_token
+                }),
+                'isBase64Encoded': False
+            }
         
     except ValueError as e:
         return {
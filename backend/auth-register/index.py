@@ -4,11 +4,18 @@ import hashlib
 import secrets
 from datetime import datetime, timedelta
 from typing import Dict, Any
-from pydantic import BaseModel, Field, EmailStr, field_validator
-import psycopg2
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, field_validator
 from psycopg2.extras import RealDictCursor
 
+from db import get_pool
+from instrument import instrumented, phase
+
+os.environ.setdefault('PYDANTIC_DISABLE_PLUGINS', '__all__')
+
 class RegisterRequest(BaseModel):
+    # EmailStr pulls in email_validator; build the validator on the first registration, not at import
+    model_config = ConfigDict(defer_build=True)
+    
     username: str = Field(..., min_length=3, max_length=50)
     email: EmailStr
     password: str = Field(..., min_length=6)
@@ -29,6 +36,7 @@ def hash_password(password: str) -> str:
 def generate_session_token() -> str:
     return secrets.token_urlsafe(32)
 
+@instrumented('auth-register')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User registration endpoint
@@ -61,77 +69,82 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         body_data = json.loads(event.get('body', '{}'))
-        reg_request = RegisterRequest(**body_data)
+        with phase('validate'):
+            reg_request = RegisterRequest(**body_data)
         
         database_url = os.environ.get('DATABASE_URL')
         if not database_url:
             raise ValueError('DATABASE_URL not configured')
         
-        conn = psycopg2.connect(database_url)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_pool(database_url).connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute(
-            "SELECT id FROM users WHERE username = %s OR email = %s",
-            (reg_request.username, reg_request.email)
-        )
-        existing_user = cur.fetchone()
+            cur.execute(
+                "SELECT id FROM users WHERE username = %s OR email = %s",
+                (reg_request.username, reg_request.email)
+            )
+            existing_user = cur.fetchone()
         
-        if existing_user:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Username or email already exists'}),
-                'isBase64Encoded': False
-            }
+            if existing_user:
+                cur.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Username or email already exists'}),
+                    'isBase64Encoded': False
+                }
         
-        password_hash = hash_password(reg_request.password)
+            password_hash = hash_password(reg_request.password)
         
-        cur.execute(
-            """INSERT INTO users (username, email, password_hash, full_name, online_status, last_seen)
-               VALUES (%s, %s, %s, %s, %s, %s)
-               RETURNING id, username, email, full_name, avatar_url, created_at""",
-            (
-                reg_request.username,
-                reg_request.email,
-                password_hash,
-                reg_request.full_name,
-                True,
-                datetime.utcnow()
+            cur.execute(
+                """INSERT INTO users (username, email, password_hash, full_name, last_seen)
+                   VALUES (%s, %s, %s, %s, %s)
+                   RETURNING id, username, email, full_name, avatar_url, created_at""",
+                (
+                    reg_request.username,
+                    reg_request.email,
+                    password_hash,
+                    reg_request.full_name,
+                    datetime.utcnow()
+                )
             )
-        )
-        user = dict(cur.fetchone())
+            user = dict(cur.fetchone())
         
-        session_token = generate_session_token()
-        expires_at = datetime.utcnow() + timedelta(days=30)
+            cur.execute(
+                """INSERT INTO user_presence (user_id, last_active_at)
+                   VALUES (%s, %s)
+                   ON CONFLICT (user_id) DO UPDATE SET last_active_at = EXCLUDED.last_active_at""",
+                (user['id'], datetime.utcnow())
+            )
         
-        cur.execute(
-            """INSERT INTO sessions (user_id, session_token, expires_at)
-               VALUES (%s, %s, %s)""",
-            (user['id'], session_token, expires_at)
-        )
+            session_token = generate_session_token()
+            expires_at = datetime.utcnow() + timedelta(days=30)
         
-        conn.commit()
-        cur.close()
-        conn.close()
+            cur.execute(
+                """INSERT INTO sessions (user_id, session_token, expires_at)
+                   VALUES (%s, %s, %s)""",
+                (user['id'], session_token, expires_at)
+            )
         
-        return {
-            'statusCode': 201,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'user': {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'email': user['email'],
-                    'full_name': user['full_name'],
-                    'avatar_url': user['avatar_url'],
-                    'created_at': user['created_at'].isoformat() if user['created_at'] else None
-                },
-                'session_token': session_token
-            }),
-            'isBase64Encoded': False
-        }
+            conn.commit()
+            cur.close()
+        
+            return {
+                'statusCode': 201,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'user': {
+                        'id': user['id'],
+                        'username': user['username'],
+                        'email': user['email'],
+                        'full_name': user['full_name'],
+                        'avatar_url': user['avatar_url'],
+                        'created_at': user['created_at'].isoformat() if user['created_at'] else None
+                    },
+                    'session_token': session_token
+                }),
+                'isBase64Encoded': False
+            }
         
     except ValueError as e:
         return {
@@ -0,0 +1,123 @@
+'''
+Per-request instrumentation for sampled handler calls: phase timings, SQL statement
+and row counts, replica routing decision, response size. Results go out as a Server-Timing header and one
+JSON log line per request. Each function directory ships an identical copy of this module.
+'''
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from db import set_observer
+
+INSTRUMENT_SAMPLE_RATE = float(os.environ.get('INSTRUMENT_SAMPLE_RATE', '0.01'))
+
+class RequestTrace:
+    def __init__(self, request_id: Optional[str], function_name: str):
+        self.request_id = request_id
+        self.function_name = function_name
+        self.action = ''
+        self.phases: Dict[str, float] = {}
+        self.statements = 0
+        self.rows = 0
+        self.route: Optional[str] = None
+
+    def add(self, name: str, elapsed: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def server_timing(self, total: float) -> str:
+        parts = []
+        for name, elapsed in self.phases.items():
+            entry = f'{name};dur={elapsed * 1000:.2f}'
+            if name == 'sql':
+                entry += f';desc="{self.statements} statements, {self.rows} rows"'
+            elif name == 'route':
+                entry += f';desc="{self.route}"'
+            parts.append(entry)
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts)
+
+_local = threading.local()
+
+def _observe(kind: str, elapsed: float, rows: int) -> None:
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    if kind.startswith('route.'):
+        trace.route = kind[len('route.'):]
+        trace.add('route', elapsed)
+        return
+    trace.add(kind, elapsed)
+    if kind == 'sql':
+        trace.statements += 1
+        trace.rows += rows
+
+set_observer(_observe)
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+def event_action(event: Dict[str, Any]) -> str:
+    params = event.get('queryStringParameters') or {}
+    if params.get('action'):
+        return str(params['action'])
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return ''
+    return str(body.get('action', '')) if isinstance(body, dict) else ''
+
+def instrumented(function_name: str) -> Callable:
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            if INSTRUMENT_SAMPLE_RATE <= 0 or random.random() >= INSTRUMENT_SAMPLE_RATE:
+                return handler(event, context)
+
+            trace = RequestTrace(getattr(context, 'request_id', None), function_name)
+            trace.action = event_action(event)
+            _local.trace = trace
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _local.trace = None
+            total = time.perf_counter() - started
+
+            body = response.get('body') or ''
+            response['headers'] = {
+                **(response.get('headers') or {}),
+                'Server-Timing': trace.server_timing(total),
+                'Timing-Allow-Origin': '*',
+            }
+            log_line = {
+                'type': 'request_trace',
+                'request_id': trace.request_id,
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'action': trace.action,
+                'status': response.get('statusCode'),
+                'total_ms': round(total * 1000, 3),
+                'phases_ms': {name: round(elapsed * 1000, 3) for name, elapsed in trace.phases.items()},
+                'statements': trace.statements,
+                'rows': trace.rows,
+                'route': trace.route,
+                'response_bytes': len(body.encode()) if isinstance(body, str) else len(body),
+            }
+            print(json.dumps(log_line), flush=True)
+            return response
+        return wrapper
+    return decorate
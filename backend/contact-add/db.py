@@ -0,0 +1,504 @@
+'''
+Pooled PostgreSQL connections shared by warm function instances, with optional
+routing of reads to streaming replicas (DATABASE_REPLICA_URLS).
+Each function directory ships an identical copy of this module.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set
+
+import psycopg2
+import psycopg2.extensions
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+POOL_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+
+DATABASE_REPLICA_URLS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_CATCHUP_TIMEOUT = float(os.environ.get('DB_REPLICA_CATCHUP_TIMEOUT', '0.05'))
+REPLICA_CATCHUP_POLL = 0.01
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '10'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_LAG_CHECK_INTERVAL', '5'))
+REPLICA_RETRY_AFTER = float(os.environ.get('DB_REPLICA_RETRY_AFTER', '30'))
+REPLICA_PIN_TTL = float(os.environ.get('DB_REPLICA_PIN_TTL', '60'))
+REPLICA_PIN_SIZE = int(os.environ.get('DB_REPLICA_PIN_SIZE', '10000'))
+
+class PoolExhaustedError(Exception):
+    pass
+
+# Called as observer(kind, seconds, rows) for 'connect', 'sql' and 'fetch' events and
+# 'route.<decision>' for replica routing; installed by instrument.py, None means nothing is measured.
+_observer: Optional[Callable[[str, float, int], None]] = None
+
+def set_observer(observer: Optional[Callable[[str, float, int], None]]) -> None:
+    global _observer
+    _observer = observer
+
+class TracedCursorMixin:
+    def execute(self, query, vars=None):
+        observer = _observer
+        if observer is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observer('sql', time.perf_counter() - started, max(self.rowcount, 0))
+
+    def executemany(self, query, vars_list):
+        observer = _observer
+        if observer is None:
+            return super().executemany(query, vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            observer('sql', time.perf_counter() - started, max(self.rowcount, 0))
+
+    def fetchone(self):
+        observer = _observer
+        if observer is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        observer('fetch', time.perf_counter() - started, 0)
+        return row
+
+    def fetchmany(self, size=None):
+        observer = _observer
+        if observer is None:
+            return super().fetchmany() if size is None else super().fetchmany(size)
+        started = time.perf_counter()
+        rows = super().fetchmany() if size is None else super().fetchmany(size)
+        observer('fetch', time.perf_counter() - started, 0)
+        return rows
+
+    def fetchall(self):
+        observer = _observer
+        if observer is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        observer('fetch', time.perf_counter() - started, 0)
+        return rows
+
+_traced_cursors: Dict[type, type] = {}
+
+def traced_cursor_class(cursor_class: type) -> type:
+    traced = _traced_cursors.get(cursor_class)
+    if traced is None:
+        traced = type('Traced' + cursor_class.__name__, (TracedCursorMixin, cursor_class), {})
+        _traced_cursors[cursor_class] = traced
+    return traced
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Set[str] = set()
+        # Primary DSN when this is a connection to one of its replicas
+        self.replica_of: Optional[str] = None
+
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.pop('cursor_factory', None) or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = traced_cursor_class(cursor_class)
+        return super().cursor(*args, **kwargs)
+
+class Statement:
+    '''
+    A named query that is PREPAREd once per pooled connection and then run
+    with EXECUTE. The SQL uses $1..$n placeholders with explicit param types.
+    '''
+    def __init__(self, name: str, sql: str, param_types: Sequence[str] = ()):
+        self.name = name
+        self.sql = sql
+        self.param_types = tuple(param_types)
+        types = f" ({', '.join(self.param_types)})" if self.param_types else ''
+        self.prepare_sql = f"PREPARE {name}{types} AS {sql}"
+        placeholders = f" ({', '.join(['%s'] * len(self.param_types))})" if self.param_types else ''
+        self.execute_sql = f"EXECUTE {name}{placeholders}"
+
+class ConnectionPool:
+    def __init__(self, dsn: str, max_size: int = POOL_MAX_SIZE, replica_of: Optional[str] = None):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.replica_of = replica_of
+        self._idle: List[Any] = []
+        self._checked_at: Dict[int, float] = {}
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'reconnects': 0,
+            'healthcheck_failures': 0,
+            'discarded': 0,
+            'exhausted': 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.dsn,
+            connect_timeout=POOL_CONNECT_TIMEOUT,
+            connection_factory=PooledConnection
+        )
+        conn.replica_of = self.replica_of
+        self._checked_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        checked_at = self._checked_at.get(id(conn), 0.0)
+        if time.monotonic() - checked_at < POOL_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.stats['healthcheck_failures'] += 1
+            return False
+        self._checked_at[id(conn)] = time.monotonic()
+        return True
+
+    def _discard(self, conn) -> None:
+        self._checked_at.pop(id(conn), None)
+        self.stats['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=POOL_ACQUIRE_TIMEOUT):
+            self.stats['exhausted'] += 1
+            raise PoolExhaustedError(f'No free database connection after {POOL_ACQUIRE_TIMEOUT}s')
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    self.stats['misses'] += 1
+                    return self._connect()
+                if self._is_healthy(conn):
+                    self.stats['hits'] += 1
+                    return conn
+                self._discard(conn)
+                self.stats['reconnects'] += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken: bool = False) -> None:
+        try:
+            if not broken and not conn.closed:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        observer = _observer
+        started = time.perf_counter()
+        conn = self.acquire()
+        if observer is not None:
+            observer('connect', time.perf_counter() - started, 0)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            idle = len(self._idle)
+        return {**self.stats, 'idle': idle, 'max_size': self.max_size}
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(dsn: Optional[str] = None, replica_of: Optional[str] = None) -> ConnectionPool:
+    dsn = dsn or os.environ.get('DATABASE_URL')
+    if not dsn:
+        raise ValueError('DATABASE_URL not configured')
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(dsn, ConnectionPool(dsn, replica_of=replica_of))
+    return pool
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    return {str(index): pool.snapshot() for index, pool in enumerate(_pools.values())}
+
+@contextmanager
+def primary_connection(conn) -> Iterator[Any]:
+    '''Yields conn itself when it is a primary connection, otherwise one from the primary pool.'''
+    if conn.replica_of is None:
+        yield conn
+    else:
+        with get_pool(conn.replica_of).connection() as primary:
+            yield primary
+
+def parse_lsn(value: Optional[str]) -> int:
+    try:
+        high, low = value.split('/')
+        return (int(high, 16) << 32) | int(low, 16)
+    except (AttributeError, ValueError):
+        return 0
+
+def format_lsn(lsn: int) -> str:
+    return f'{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}'
+
+REPLICA_STATUS = """
+    SELECT pg_last_wal_replay_lsn()::text,
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END
+"""
+
+class Replica:
+    def __init__(self, dsn: str, primary_dsn: str):
+        self.pool = get_pool(dsn, replica_of=primary_dsn)
+        self.replayed_lsn = 0
+        self.lag_seconds: Optional[float] = None
+        self.checked_at = 0.0
+        self.down_until = 0.0
+        self.stats = {'reads': 0, 'lag_fallbacks': 0, 'errors': 0}
+
+    def refresh(self, conn) -> None:
+        cursor = conn.cursor()
+        cursor.execute(REPLICA_STATUS)
+        replayed, lag = cursor.fetchone()
+        cursor.close()
+        conn.rollback()
+        self.replayed_lsn = max(self.replayed_lsn, parse_lsn(replayed))
+        self.lag_seconds = float(lag)
+        self.checked_at = time.monotonic()
+
+    def caught_up(self, conn, required_lsn: int) -> bool:
+        if time.monotonic() - self.checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+            self.refresh(conn)
+        if self.lag_seconds is not None and self.lag_seconds > REPLICA_MAX_LAG:
+            return False
+        deadline = time.monotonic() + REPLICA_CATCHUP_TIMEOUT
+        while self.replayed_lsn < required_lsn:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(REPLICA_CATCHUP_POLL)
+            self.refresh(conn)
+        return True
+
+class ReplicaRouter:
+    '''
+    Sends reads to replicas and everything else to the primary. A read that must see
+    a write (X-Min-LSN from the client, or a recent write pinned to its session token
+    on this instance) waits briefly for the replica to replay that LSN and otherwise
+    falls back to the primary.
+    '''
+    def __init__(self, primary_dsn: str, replica_dsns: Sequence[str]):
+        self.primary_dsn = primary_dsn
+        self.replicas = [Replica(dsn, primary_dsn) for dsn in replica_dsns]
+        self._next = 0
+        self._pins: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'primary_writes': 0,
+            'primary_reads': 0,
+            'replica_reads': 0,
+            'lag_fallbacks': 0,
+            'error_fallbacks': 0,
+            'pinned_reads': 0,
+        }
+
+    def pinned_lsn(self, token: Optional[str]) -> int:
+        if not token:
+            return 0
+        with self._lock:
+            pin = self._pins.get(token)
+            if pin is None:
+                return 0
+            if pin[1] <= time.monotonic():
+                del self._pins[token]
+                return 0
+            return pin[0]
+
+    def record_write(self, conn, token: Optional[str]) -> Optional[str]:
+        '''Returns the primary WAL position after a committed write and pins it to the session.'''
+        if not self.replicas:
+            return None
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_current_wal_lsn()::text')
+        lsn = parse_lsn(cursor.fetchone()[0])
+        cursor.close()
+        conn.commit()
+        if token:
+            with self._lock:
+                previous = self._pins.pop(token, (0, 0.0))
+                self._pins[token] = (max(lsn, previous[0]), time.monotonic() + REPLICA_PIN_TTL)
+                while len(self._pins) > REPLICA_PIN_SIZE:
+                    self._pins.popitem(last=False)
+        return format_lsn(lsn)
+
+    def _replica_order(self) -> List[Replica]:
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        now = time.monotonic()
+        ordered = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in ordered if replica.down_until <= now]
+
+    def _acquire_replica(self, stack: ExitStack, required_lsn: int) -> Optional[Any]:
+        for replica in self._replica_order():
+            attempt = ExitStack()
+            try:
+                conn = attempt.enter_context(replica.pool.connection())
+                ready = replica.caught_up(conn, required_lsn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolExhaustedError):
+                attempt.close()
+                replica.down_until = time.monotonic() + REPLICA_RETRY_AFTER
+                replica.stats['errors'] += 1
+                continue
+            if ready:
+                replica.stats['reads'] += 1
+                stack.enter_context(attempt)
+                return conn
+            attempt.close()
+            replica.stats['lag_fallbacks'] += 1
+        return None
+
+    @contextmanager
+    def connection(self, read_only: bool = False, token: Optional[str] = None, min_lsn: Optional[str] = None) -> Iterator[Any]:
+        observer = _observer
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            conn = None
+            decision = 'primary'
+            if read_only and self.replicas:
+                pinned = self.pinned_lsn(token)
+                required_lsn = max(parse_lsn(min_lsn), pinned)
+                conn = self._acquire_replica(stack, required_lsn)
+                with self._lock:
+                    if pinned:
+                        self.stats['pinned_reads'] += 1
+                    if conn is not None:
+                        self.stats['replica_reads'] += 1
+                        decision = 'replica'
+                    elif any(replica.down_until > time.monotonic() for replica in self.replicas):
+                        self.stats['error_fallbacks'] += 1
+                        decision = 'fallback'
+                    else:
+                        self.stats['lag_fallbacks'] += 1
+                        decision = 'fallback'
+            if conn is None:
+                conn = stack.enter_context(get_pool(self.primary_dsn).connection())
+                with self._lock:
+                    self.stats['primary_reads' if read_only else 'primary_writes'] += 1
+            if observer is not None:
+                observer('route.' + decision, time.perf_counter() - started, 0)
+            yield conn
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            pins = len(self._pins)
+        return {
+            **self.stats,
+            'pins': pins,
+            'replicas': [
+                {
+                    **replica.stats,
+                    'replayed_lsn': format_lsn(replica.replayed_lsn),
+                    'lag_seconds': replica.lag_seconds,
+                    'down': replica.down_until > time.monotonic(),
+                }
+                for replica in self.replicas
+            ],
+        }
+
+_routers: Dict[str, ReplicaRouter] = {}
+_routers_lock = threading.Lock()
+
+def get_router(dsn: Optional[str] = None) -> ReplicaRouter:
+    dsn = dsn or os.environ.get('DATABASE_URL')
+    if not dsn:
+        raise ValueError('DATABASE_URL not configured')
+    router = _routers.get(dsn)
+    if router is None:
+        with _routers_lock:
+            router = _routers.get(dsn) or _routers.setdefault(dsn, ReplicaRouter(dsn, DATABASE_REPLICA_URLS))
+    return router
+
+def router_stats() -> Dict[str, Dict[str, Any]]:
+    return {str(index): router.snapshot() for index, router in enumerate(_routers.values())}
+
+_statement_stats: Dict[str, Dict[str, float]] = {}
+_statement_stats_lock = threading.Lock()
+
+def _record(name: str, phase: str, elapsed: float) -> None:
+    with _statement_stats_lock:
+        stats = _statement_stats.setdefault(name, {
+            'prepare_count': 0,
+            'prepare_seconds': 0.0,
+            'execute_count': 0,
+            'execute_seconds': 0.0,
+        })
+        stats[phase + '_count'] += 1
+        stats[phase + '_seconds'] += elapsed
+
+def run(cursor, statement: Statement, params: Sequence[Any] = ()) -> None:
+    prepared = cursor.connection.prepared
+    if statement.name not in prepared:
+        started = time.perf_counter()
+        cursor.execute(statement.prepare_sql)
+        _record(statement.name, 'prepare', time.perf_counter() - started)
+        prepared.add(statement.name)
+    started = time.perf_counter()
+    cursor.execute(statement.execute_sql, tuple(params))
+    _record(statement.name, 'execute', time.perf_counter() - started)
+
+def prepare(conn, statements: Sequence[Statement]) -> int:
+    prepared = 0
+    cursor = conn.cursor()
+    for statement in statements:
+        if statement.name in conn.prepared:
+            continue
+        started = time.perf_counter()
+        cursor.execute(statement.prepare_sql)
+        _record(statement.name, 'prepare', time.perf_counter() - started)
+        conn.prepared.add(statement.name)
+        prepared += 1
+    cursor.close()
+    conn.commit()
+    return prepared
+
+def statement_report() -> Dict[str, Dict[str, float]]:
+    report = {}
+    with _statement_stats_lock:
+        for name, stats in _statement_stats.items():
+            report[name] = {
+                'prepares': stats['prepare_count'],
+                'executions': stats['execute_count'],
+                'avg_prepare_ms': round(stats['prepare_seconds'] * 1000 / stats['prepare_count'], 3) if stats['prepare_count'] else 0.0,
+                'avg_execute_ms': round(stats['execute_seconds'] * 1000 / stats['execute_count'], 3) if stats['execute_count'] else 0.0,
+                'total_execute_ms': round(stats['execute_seconds'] * 1000, 3),
+            }
+    return report
@@ -1,19 +1,122 @@
 import json
 import os
-from typing import Dict, Any
-import psycopg2
+import re
+from datetime import datetime
+from typing import Annotated, Dict, Any, List
 from pydantic import BaseModel, Field, ValidationError
 
+from db import Statement, get_router, run
+from sessions import get_session_token, verify_session
+from instrument import instrumented, phase
+
+os.environ.setdefault('PYDANTIC_DISABLE_PLUGINS', '__all__')
+
 class AddContactRequest(BaseModel):
     user_id: int = Field(..., gt=0)
     contact_user_id: int = Field(..., gt=0)
 
+CONTACT_IMPORT_MAX = int(os.environ.get('CONTACT_IMPORT_MAX', '5000'))
+SHA256_HEX = re.compile('^[0-9a-fA-F]{64}$')
+
+class ImportContactsRequest(BaseModel):
+    user_id: int = Field(..., gt=0)
+    entries: List[Annotated[str, Field(min_length=1, max_length=320)]] = Field(..., min_length=1, max_length=CONTACT_IMPORT_MAX)
+    hashed: bool = False
+    full_resync: bool = False
+
+ADD_CONTACT = Statement('add_contact', """
+    INSERT INTO contacts (user_id, contact_user_id)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id, contact_user_id) DO NOTHING
+""", ('int', 'int'))
+
+# One round trip for the whole address book: entries are reduced to hashes, entries
+# imported before are skipped unless $4 (full resync), the rest are matched through
+# the contact_hash expression indexes, logged, and added as contacts in one INSERT.
+IMPORT_CONTACTS = Statement('import_contacts', """
+    WITH entries AS (
+        SELECT entry_hash, min(entry) AS entry
+        FROM (
+            SELECT CASE WHEN $3 THEN lower(btrim(e)) ELSE contact_hash(e) END AS entry_hash, e AS entry
+            FROM unnest($2) AS e
+        ) normalized
+        GROUP BY entry_hash
+    ),
+    fresh AS (
+        SELECT en.entry_hash, en.entry
+        FROM entries en
+        WHERE $4 OR NOT EXISTS (
+            SELECT 1 FROM contact_import_entries ci
+            WHERE ci.user_id = $1 AND ci.entry_hash = en.entry_hash
+        )
+    ),
+    matched AS (
+        SELECT f.entry_hash, f.entry, u.id
+        FROM fresh f
+        INNER JOIN users u ON contact_hash(u.username) = f.entry_hash
+        UNION
+        SELECT f.entry_hash, f.entry, u.id
+        FROM fresh f
+        INNER JOIN users u ON contact_hash(u.email) = f.entry_hash
+    ),
+    logged AS (
+        INSERT INTO contact_import_entries (user_id, entry_hash, matched_user_id, imported_at)
+        SELECT $1, f.entry_hash, (SELECT min(m.id) FROM matched m WHERE m.entry_hash = f.entry_hash), $5
+        FROM fresh f
+        ON CONFLICT (user_id, entry_hash) DO UPDATE
+        SET matched_user_id = EXCLUDED.matched_user_id, imported_at = EXCLUDED.imported_at
+    ),
+    added AS (
+        INSERT INTO contacts (user_id, contact_user_id)
+        SELECT DISTINCT $1, m.id FROM matched m WHERE m.id <> $1
+        ON CONFLICT (user_id, contact_user_id) DO NOTHING
+        RETURNING contact_user_id
+    )
+    SELECT
+        (SELECT count(*) FROM entries) AS received,
+        (SELECT count(*) FROM fresh) AS processed,
+        r.entry, r.id, r.username, r.full_name, r.avatar_url, r.added
+    FROM (SELECT 1) one
+    LEFT JOIN (
+        SELECT m.entry, u.id, u.username, u.full_name, u.avatar_url, a.contact_user_id IS NOT NULL AS added
+        FROM matched m
+        INNER JOIN users u ON u.id = m.id
+        LEFT JOIN added a ON a.contact_user_id = m.id
+        WHERE m.id <> $1
+    ) r ON true
+    ORDER BY r.username, r.entry
+""", ('int', 'text[]', 'boolean', 'boolean', 'timestamp'))
+
+def import_contacts(cursor, req: ImportContactsRequest) -> Dict[str, Any]:
+    run(cursor, IMPORT_CONTACTS, (req.user_id, req.entries, req.hashed, req.full_resync, datetime.utcnow()))
+    rows = cursor.fetchall()
+    
+    matches = [
+        {
+            'entry': row[2],
+            'user': {'id': row[3], 'username': row[4], 'full_name': row[5], 'avatar_url': row[6]},
+            'added': row[7]
+        }
+        for row in rows if row[3] is not None
+    ]
+    return {
+        'success': True,
+        'received': rows[0][0],
+        'processed': rows[0][1],
+        'skipped': rows[0][0] - rows[0][1],
+        'added': sum(1 for match in matches if match['added']),
+        'matches': matches
+    }
+
+@instrumented('contact-add')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Add a user to contacts list
-    Args: event - dict with httpMethod, body (user_id, contact_user_id)
+    Business: Add a user to contacts list, or import an address book in bulk
+    Args: event - dict with httpMethod, headers (X-Auth-Token), body (user_id, contact_user_id)
+                  or body (action=import, user_id, entries, hashed, full_resync); hashed entries
+                  are sha256 hex digests of the trimmed, lowercased username or email
           context - object with request_id attribute
-    Returns: HTTP response with success status
+    Returns: HTTP response with success status, or the matched users for an import
     '''
     method: str = event.get('httpMethod', 'POST')
     
@@ -37,10 +140,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     body_data = json.loads(event.get('body', '{}'))
+    action = body_data.get('action', 'add')
     
-    req = AddContactRequest(**body_data)
+    if action not in ('add', 'import'):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid action'})
+        }
+    
+    with phase('validate'):
+        req = ImportContactsRequest(**body_data) if action == 'import' else AddContactRequest(**body_data)
+    
+    if action == 'import' and req.hashed and not all(SHA256_HEX.match(entry) for entry in req.entries):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Hashed entries must be sha256 hex digests'})
+        }
     
-    if req.user_id == req.contact_user_id:
+    if action == 'add' and req.user_id == req.contact_user_id:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -55,22 +174,48 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Database configuration missing'})
         }
     
-    conn = psycopg2.connect(dsn)
-    cursor = conn.cursor()
+    router = get_router(dsn)
+    token = get_session_token(event)
     
-    cursor.execute(f"""
-        INSERT INTO contacts (user_id, contact_user_id)
-        VALUES ({req.user_id}, {req.contact_user_id})
-        ON CONFLICT (user_id, contact_user_id) DO NOTHING
-    """)
+    with router.connection(False, token) as conn:
+        auth_user_id = verify_session(conn, token)
+        
+        if auth_user_id is None:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or missing session token'})
+            }
+        
+        if req.user_id != auth_user_id:
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'user_id does not match the session user'})
+            }
+        
+        cursor = conn.cursor()
+    
+        if action == 'import':
+            response_body = import_contacts(cursor, req)
+        else:
+            run(cursor, ADD_CONTACT, (req.user_id, req.contact_user_id))
+            response_body = {'success': True, 'message': 'Contact added successfully'}
+    
+        conn.commit()
+        cursor.close()
+        
+        # user-search reads is_contact from a replica; the LSN lets it wait for this insert
+        write_lsn = router.record_write(conn, token)
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if write_lsn:
+        headers['X-Write-LSN'] = write_lsn
+        headers['Access-Control-Expose-Headers'] = 'X-Write-LSN'
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'headers': headers,
         'isBase64Encoded': False,
-        'body': json.dumps({'success': True, 'message': 'Contact added successfully'})
+        'body': json.dumps(response_body)
     }
@@ -0,0 +1,487 @@
+import base64
+import hashlib
+import json
+import os
+import secrets
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from psycopg2.extras import RealDictCursor
+
+from db import Statement, get_pool, run
+from sessions import get_session_token, verify_session
+from storage import get_store
+from instrument import instrumented, phase
+
+os.environ.setdefault('PYDANTIC_DISABLE_PLUGINS', '__all__')
+
+MEDIA_MAX_FILE_SIZE = int(os.environ.get('MEDIA_MAX_FILE_SIZE', str(2 * 1024 ** 3)))
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', str(2 * 1024 ** 2)))
+MEDIA_CHUNK_SIZE_MIN = 256 * 1024
+MEDIA_CHUNK_SIZE_MAX = int(os.environ.get('MEDIA_CHUNK_SIZE_MAX', str(4 * 1024 ** 2)))
+MEDIA_MAX_CHUNKS = 10000
+MEDIA_UPLOAD_TTL_HOURS = int(os.environ.get('MEDIA_UPLOAD_TTL_HOURS', '24'))
+MEDIA_READ_BLOCK = 1024 * 1024
+
+# Content types the worker renders previews for
+PREVIEW_CONTENT_TYPES = ('image/', 'video/')
+
+class InitUploadRequest(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+    
+    file_name: str = Field(..., min_length=1, max_length=255)
+    file_size: int = Field(..., gt=0)
+    content_type: str = Field(default='application/octet-stream', pattern=r'^[\w.+-]+/[\w.+-]+$', max_length=100)
+    chunk_size: Optional[int] = Field(None, ge=MEDIA_CHUNK_SIZE_MIN, le=MEDIA_CHUNK_SIZE_MAX)
+    sha256: Optional[str] = Field(None, pattern='^[0-9a-f]{64}$')
+
+UPLOAD_COLUMNS = """
+        upload_id, file_name, content_type, byte_size, chunk_size, chunk_count, status, sha256,
+        to_char(expires_at, 'YYYY-MM-DD"T"HH24:MI:SS') AS expires_at
+"""
+
+RESUMABLE_UPLOAD = Statement('resumable_upload', f"""
+        SELECT {UPLOAD_COLUMNS}
+        FROM media_uploads
+        WHERE user_id = $1 AND expected_sha256 = $2 AND byte_size = $3 AND chunk_size = $4
+          AND status = 'uploading' AND expires_at > $5
+        ORDER BY created_at DESC
+        LIMIT 1
+""", ('int', 'text', 'bigint', 'int', 'timestamp'))
+
+INSERT_UPLOAD = Statement('insert_upload', f"""
+        INSERT INTO media_uploads
+            (upload_id, user_id, file_name, content_type, byte_size, chunk_size, chunk_count, expected_sha256, expires_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        RETURNING {UPLOAD_COLUMNS}
+""", ('text', 'int', 'text', 'text', 'bigint', 'int', 'int', 'text', 'timestamp'))
+
+UPLOAD_BY_ID = Statement('upload_by_id', f"""
+        SELECT {UPLOAD_COLUMNS}, expected_sha256, expires_at < $3 AS expired
+        FROM media_uploads
+        WHERE upload_id = $1 AND user_id = $2
+""", ('text', 'int', 'timestamp'))
+
+LOCK_UPLOAD = Statement('lock_upload', f"""
+        SELECT {UPLOAD_COLUMNS}, expected_sha256, expires_at < $3 AS expired
+        FROM media_uploads
+        WHERE upload_id = $1 AND user_id = $2
+        FOR UPDATE
+""", ('text', 'int', 'timestamp'))
+
+RECEIVED_CHUNKS = Statement('received_chunks', """
+        SELECT coalesce(array_agg(chunk_index ORDER BY chunk_index), '{}')
+        FROM media_upload_chunks
+        WHERE upload_id = $1
+""", ('text',))
+
+RECORD_CHUNK = Statement('record_chunk', """
+        INSERT INTO media_upload_chunks (upload_id, chunk_index, byte_size)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (upload_id, chunk_index) DO UPDATE
+        SET byte_size = EXCLUDED.byte_size, received_at = CURRENT_TIMESTAMP
+""", ('text', 'int', 'int'))
+
+BLOB_COLUMNS = """
+        sha256, storage_key, byte_size, content_type, variants
+"""
+
+BLOB_BY_SHA = Statement('blob_by_sha', f"""
+        SELECT {BLOB_COLUMNS} FROM media_blobs WHERE sha256 = $1
+""", ('text',))
+
+# A blob is visible to whoever uploaded it and to members of a chat it was sent to.
+# Messages carry the hash messenger-api checked at send time, not a client-set URL.
+MEDIA_ACCESS = Statement('media_access', """
+        SELECT EXISTS (
+            SELECT 1 FROM media_uploads
+            WHERE user_id = $2 AND sha256 = $1 AND status = 'complete'
+        ) OR EXISTS (
+            SELECT 1
+            FROM messages m
+            INNER JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = $2
+            WHERE m.media_sha256 = $1
+        ) AS visible
+""", ('text', 'int'))
+
+INSERT_BLOB = Statement('insert_blob', """
+        INSERT INTO media_blobs (sha256, storage_key, byte_size, content_type, created_by)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (sha256) DO NOTHING
+""", ('text', 'text', 'bigint', 'text', 'int'))
+
+ENQUEUE_JOB = Statement('enqueue_media_job', """
+        INSERT INTO media_jobs (sha256, kind)
+        VALUES ($1, $2)
+        ON CONFLICT (sha256, kind) DO NOTHING
+""", ('text', 'text'))
+
+FINISH_UPLOAD = Statement('finish_upload', """
+        WITH finished AS (
+            UPDATE media_uploads SET status = 'complete', sha256 = $2
+            WHERE upload_id = $1
+            RETURNING upload_id
+        )
+        DELETE FROM media_upload_chunks c USING finished f WHERE c.upload_id = f.upload_id
+""", ('text', 'text'))
+
+def chunk_key(upload_id: str, index: int) -> str:
+    return f'uploads/{upload_id}/{index:06d}'
+
+def blob_key(sha256: str) -> str:
+    return f'blobs/{sha256[:2]}/{sha256}'
+
+def expected_chunk_size(upload: Dict, index: int) -> int:
+    if index < upload['chunk_count'] - 1:
+        return upload['chunk_size']
+    return upload['byte_size'] - upload['chunk_size'] * (upload['chunk_count'] - 1)
+
+def message_type_for(content_type: str) -> str:
+    kind = content_type.split('/', 1)[0]
+    return kind if kind in ('image', 'video', 'audio') else 'file'
+
+def media_payload(blob: Dict, file_name: str, deduplicated: bool) -> Dict:
+    return {
+        'sha256': blob['sha256'],
+        'media_url': get_store().describe(blob['storage_key'])['url'],
+        'file_name': file_name,
+        'file_size': blob['byte_size'],
+        'content_type': blob['content_type'],
+        'message_type': message_type_for(blob['content_type']),
+        'variants': blob['variants'],
+        'deduplicated': deduplicated
+    }
+
+def upload_status(conn, upload: Dict) -> Dict:
+    cursor = conn.cursor()
+    run(cursor, RECEIVED_CHUNKS, (upload['upload_id'],))
+    received = set(cursor.fetchone()[0])
+    cursor.close()
+    return {
+        'upload_id': upload['upload_id'],
+        'status': upload['status'],
+        'file_name': upload['file_name'],
+        'file_size': upload['byte_size'],
+        'chunk_size': upload['chunk_size'],
+        'chunk_count': upload['chunk_count'],
+        'received_chunks': len(received),
+        'missing_chunks': [index for index in range(upload['chunk_count']) if index not in received],
+        'expires_at': upload['expires_at']
+    }
+
+def init_upload(body_data: Dict, user_id: int, conn) -> Dict:
+    with phase('validate'):
+        req = InitUploadRequest(**body_data)
+    
+    if req.file_size > MEDIA_MAX_FILE_SIZE:
+        return {'statusCode': 413, 'error': f'Files larger than {MEDIA_MAX_FILE_SIZE} bytes are not accepted'}
+    
+    chunk_size = req.chunk_size or MEDIA_CHUNK_SIZE
+    chunk_count = -(-req.file_size // chunk_size)
+    if chunk_count > MEDIA_MAX_CHUNKS:
+        return {'statusCode': 400, 'error': f'An upload can have at most {MEDIA_MAX_CHUNKS} chunks; use a larger chunk_size'}
+    
+    now = datetime.utcnow()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    # A client that lost its upload_id gets the unfinished session back instead of starting over
+    if req.sha256:
+        run(cursor, RESUMABLE_UPLOAD, (user_id, req.sha256, req.file_size, chunk_size, now))
+        upload = cursor.fetchone()
+        if upload:
+            data = upload_status(conn, upload)
+            conn.commit()
+            cursor.close()
+            return {'statusCode': 200, 'data': {'upload': {**data, 'resumed': True}}}
+    
+    run(cursor, INSERT_UPLOAD, (
+        secrets.token_urlsafe(24),
+        user_id,
+        req.file_name,
+        req.content_type,
+        req.file_size,
+        chunk_size,
+        chunk_count,
+        req.sha256,
+        now + timedelta(hours=MEDIA_UPLOAD_TTL_HOURS)
+    ))
+    upload = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    
+    return {
+        'statusCode': 201,
+        'data': {
+            'upload': {
+                'upload_id': upload['upload_id'],
+                'status': upload['status'],
+                'file_name': upload['file_name'],
+                'file_size': upload['byte_size'],
+                'chunk_size': upload['chunk_size'],
+                'chunk_count': upload['chunk_count'],
+                'received_chunks': 0,
+                'missing_chunks': list(range(upload['chunk_count'])),
+                'expires_at': upload['expires_at'],
+                'resumed': False
+            }
+        }
+    }
+
+def upload_chunk(params: Dict, body: bytes, user_id: int, conn) -> Dict:
+    upload_id = params.get('upload_id') or ''
+    try:
+        index = int(params.get('index', ''))
+    except ValueError:
+        return {'statusCode': 400, 'error': 'index must be an integer'}
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    run(cursor, UPLOAD_BY_ID, (upload_id, user_id, datetime.utcnow()))
+    upload = cursor.fetchone()
+    
+    if not upload:
+        cursor.close()
+        return {'statusCode': 404, 'error': 'Upload not found'}
+    if upload['status'] != 'uploading':
+        cursor.close()
+        return {'statusCode': 409, 'error': 'Upload is already complete'}
+    if upload['expired']:
+        cursor.close()
+        return {'statusCode': 410, 'error': 'Upload has expired'}
+    if not 0 <= index < upload['chunk_count']:
+        cursor.close()
+        return {'statusCode': 400, 'error': f"index must be between 0 and {upload['chunk_count'] - 1}"}
+    
+    expected = expected_chunk_size(upload, index)
+    if len(body) != expected:
+        cursor.close()
+        return {'statusCode': 400, 'error': f'Chunk {index} must be {expected} bytes, got {len(body)}'}
+    
+    # Written before it is recorded: a recorded chunk always has its bytes in the store
+    with get_store().open_write(chunk_key(upload_id, index)) as target:
+        target.write(body)
+    
+    run(cursor, RECORD_CHUNK, (upload_id, index, len(body)))
+    conn.commit()
+    cursor.close()
+    
+    return {'statusCode': 200, 'data': {'upload_id': upload_id, 'index': index, 'bytes': len(body)}}
+
+def get_upload(params: Dict, user_id: int, conn) -> Dict:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    run(cursor, UPLOAD_BY_ID, (params.get('upload_id') or '', user_id, datetime.utcnow()))
+    upload = cursor.fetchone()
+    
+    if not upload:
+        cursor.close()
+        return {'statusCode': 404, 'error': 'Upload not found'}
+    
+    data = upload_status(conn, upload)
+    if upload['status'] == 'complete':
+        run(cursor, BLOB_BY_SHA, (upload['sha256'],))
+        data['media'] = media_payload(cursor.fetchone(), upload['file_name'], False)
+    elif upload['expired']:
+        data['status'] = 'expired'
+    conn.commit()
+    cursor.close()
+    
+    return {'statusCode': 200, 'data': {'upload': data}}
+
+def assemble(upload: Dict, target_key: str) -> str:
+    store = get_store()
+    digest = hashlib.sha256()
+    with store.open_write(target_key) as target:
+        for index in range(upload['chunk_count']):
+            with store.open_read(chunk_key(upload['upload_id'], index)) as source:
+                while True:
+                    block = source.read(MEDIA_READ_BLOCK)
+                    if not block:
+                        break
+                    digest.update(block)
+                    target.write(block)
+    return digest.hexdigest()
+
+def complete_upload(body_data: Dict, user_id: int, conn) -> Dict:
+    upload_id = str(body_data.get('upload_id') or '')
+    store = get_store()
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # The row lock makes concurrent complete calls for one upload run one after another
+    run(cursor, LOCK_UPLOAD, (upload_id, user_id, datetime.utcnow()))
+    upload = cursor.fetchone()
+    
+    if not upload:
+        conn.rollback()
+        cursor.close()
+        return {'statusCode': 404, 'error': 'Upload not found'}
+    
+    if upload['status'] == 'complete':
+        run(cursor, BLOB_BY_SHA, (upload['sha256'],))
+        blob = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        return {'statusCode': 200, 'data': {'media': media_payload(blob, upload['file_name'], False)}}
+    
+    if upload['expired']:
+        conn.rollback()
+        cursor.close()
+        return {'statusCode': 410, 'error': 'Upload has expired'}
+    
+    status = upload_status(conn, upload)
+    if status['missing_chunks']:
+        conn.rollback()
+        cursor.close()
+        return {'statusCode': 409, 'error': f"Upload is missing {len(status['missing_chunks'])} chunks"}
+    
+    assembled_key = f'uploads/{upload_id}/assembled'
+    sha256 = assemble(upload, assembled_key)
+    
+    if upload['expected_sha256'] and upload['expected_sha256'] != sha256:
+        store.delete(assembled_key)
+        conn.rollback()
+        cursor.close()
+        return {'statusCode': 422, 'error': 'Uploaded content does not match the declared sha256'}
+    
+    run(cursor, BLOB_BY_SHA, (sha256,))
+    blob = cursor.fetchone()
+    deduplicated = blob is not None
+    
+    if deduplicated:
+        store.delete(assembled_key)
+    else:
+        # The key is derived from the content, so a racing upload of the same bytes writes an identical object
+        store.move(assembled_key, blob_key(sha256))
+        run(cursor, INSERT_BLOB, (sha256, blob_key(sha256), upload['byte_size'], upload['content_type'], user_id))
+        if upload['content_type'].startswith(PREVIEW_CONTENT_TYPES):
+            run(cursor, ENQUEUE_JOB, (sha256, 'thumbnail'))
+        run(cursor, BLOB_BY_SHA, (sha256,))
+        blob = cursor.fetchone()
+    
+    run(cursor, FINISH_UPLOAD, (upload_id, sha256))
+    conn.commit()
+    cursor.close()
+    
+    store.delete_prefix(f'uploads/{upload_id}/')
+    
+    return {'statusCode': 200, 'data': {'media': media_payload(blob, upload['file_name'], deduplicated)}}
+
+def get_media(params: Dict, user_id: int, conn) -> Dict:
+    sha256 = (params.get('sha256') or '').lower()
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    run(cursor, BLOB_BY_SHA, (sha256,))
+    blob = cursor.fetchone()
+    
+    # Knowing a hash is not enough: blobs the caller cannot see answer like missing ones
+    payload = media_payload(blob, params.get('file_name') or sha256, False) if blob else None
+    if payload:
+        run(cursor, MEDIA_ACCESS, (sha256, user_id))
+        if not cursor.fetchone()['visible']:
+            payload = None
+    conn.commit()
+    cursor.close()
+    
+    if not payload:
+        return {'statusCode': 404, 'error': 'Media not found'}
+    
+    return {'statusCode': 200, 'data': {'media': payload}}
+
+def read_chunk_body(event: Dict[str, Any]) -> Optional[bytes]:
+    # Binary bodies arrive base64-encoded from the gateway; clients without binary
+    # support send the base64 text themselves, so both decode the same way
+    try:
+        return base64.b64decode(event.get('body') or '', validate=True)
+    except ValueError:
+        return None
+
+@instrumented('media-upload')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Chunked, resumable media uploads stored once per distinct content
+    Args: event - dict with httpMethod, headers (X-Auth-Token), queryStringParameters, body
+          context - object with request_id attribute
+    Returns: HTTP response with upload session or stored media
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database configuration missing'})
+        }
+    
+    try:
+        params = dict(event.get('queryStringParameters') or {})
+        
+        with get_pool(dsn).connection() as conn:
+            auth_user_id = verify_session(conn, get_session_token(event))
+            
+            if auth_user_id is None:
+                result = {'statusCode': 401, 'error': 'Invalid or missing session token'}
+            
+            elif method == 'GET':
+                action = params.get('action', '')
+                
+                if action == 'upload_status':
+                    result = get_upload(params, auth_user_id, conn)
+                elif action == 'media':
+                    result = get_media(params, auth_user_id, conn)
+                else:
+                    result = {'statusCode': 400, 'error': 'Invalid action'}
+            
+            elif method == 'POST' and params.get('action') == 'upload_chunk':
+                body = read_chunk_body(event)
+                if body is None:
+                    result = {'statusCode': 400, 'error': 'Chunk body must be base64-encoded'}
+                else:
+                    result = upload_chunk(params, body, auth_user_id, conn)
+            
+            elif method == 'POST':
+                body_data = json.loads(event.get('body') or '{}')
+                action = body_data.get('action', '')
+                
+                if action == 'init_upload':
+                    result = init_upload(body_data, auth_user_id, conn)
+                elif action == 'complete_upload':
+                    result = complete_upload(body_data, auth_user_id, conn)
+                else:
+                    result = {'statusCode': 400, 'error': 'Invalid action'}
+            else:
+                result = {'statusCode': 405, 'error': 'Method not allowed'}
+        
+        if 'error' in result:
+            return {
+                'statusCode': result['statusCode'],
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': result['error']})
+            }
+        
+        with phase('serialize'):
+            response_body = json.dumps(result['data'])
+        
+        return {
+            'statusCode': result['statusCode'],
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'isBase64Encoded': False,
+            'body': response_body
+        }
+    
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
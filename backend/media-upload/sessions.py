@@ -0,0 +1,187 @@
+'''
+Session token verification backed by an in-process LRU+TTL cache.
+Each function directory that checks tokens ships an identical copy of this module.
+
+Logout deletes the session and records it in session_revocations. Every process
+polls that table at most once per SESSION_REVOCATION_POLL seconds, on the next
+request it serves, and drops the revoked tokens from its cache. A logged-out
+token is therefore still accepted for up to SESSION_REVOCATION_POLL seconds
+(plus replica lag, where reads go to a replica) by processes that had it cached,
+not for the whole SESSION_CACHE_TTL.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import Statement, primary_connection, run
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+SESSION_NEGATIVE_CACHE_SIZE = int(os.environ.get('SESSION_NEGATIVE_CACHE_SIZE', '2000'))
+SESSION_NEGATIVE_CACHE_TTL = float(os.environ.get('SESSION_NEGATIVE_CACHE_TTL', '10'))
+SESSION_REVOCATION_POLL = float(os.environ.get('SESSION_REVOCATION_POLL', '1'))
+# Each poll re-reads this far behind the newest revocation it has seen, for logouts
+# that commit out of order or reach one replica later than another
+SESSION_REVOCATION_OVERLAP = timedelta(seconds=30)
+
+class SessionCache:
+    def __init__(self, max_size: int, ttl: float, negative_max_size: int, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_max_size = negative_max_size
+        self.negative_ttl = negative_ttl
+        self._entries: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+        self._negative: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, token: str) -> Tuple[bool, Optional[int]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(token)
+                    self.stats['hits'] += 1
+                    return True, entry[0]
+                del self._entries[token]
+            negative_until = self._negative.get(token)
+            if negative_until is not None:
+                if negative_until > now:
+                    self.stats['negative_hits'] += 1
+                    return True, None
+                del self._negative[token]
+            self.stats['misses'] += 1
+        return False, None
+
+    def put(self, token: str, user_id: int, expires_in: float) -> None:
+        valid_until = time.monotonic() + min(self.ttl, expires_in)
+        with self._lock:
+            self._entries[token] = (user_id, valid_until)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def put_negative(self, token: str) -> None:
+        with self._lock:
+            self._negative[token] = time.monotonic() + self.negative_ttl
+            self._negative.move_to_end(token)
+            while len(self._negative) > self.negative_max_size:
+                self._negative.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self.stats['invalidations'] += 1
+            self._negative.pop(token, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._entries)
+            negative_size = len(self._negative)
+        lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+        hit_rate = (self.stats['hits'] + self.stats['negative_hits']) / lookups if lookups else 0.0
+        return {**self.stats, 'size': size, 'negative_size': negative_size, 'hit_rate': round(hit_rate, 4)}
+
+SESSION_LOOKUP = Statement('session_lookup', """
+    SELECT user_id, expires_at FROM sessions WHERE session_token = $1 AND expires_at > $2
+""", ('text', 'timestamp'))
+
+REVOKED_SESSIONS = Statement('revoked_sessions', """
+    SELECT session_token, revoked_at FROM session_revocations WHERE revoked_at > $1
+""", ('timestamp',))
+
+class RevocationFeed:
+    '''Applies logouts made through any process to this process's session cache.'''
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.since = datetime.utcnow()
+        self.next_poll = 0.0
+        self.polls = 0
+        self._lock = threading.Lock()
+
+    def claim(self) -> Optional[datetime]:
+        '''The bound to read revocations from, when a poll is due and no other request runs one.'''
+        if time.monotonic() < self.next_poll or not self._lock.acquire(blocking=False):
+            return None
+        return self.since - SESSION_REVOCATION_OVERLAP
+
+    def release(self, cache: SessionCache, rows: Optional[List[Tuple[str, datetime]]]) -> None:
+        '''Applies what a claimed poll read; None when the read failed and is retried next request.'''
+        try:
+            if rows is not None:
+                for token, revoked_at in rows:
+                    cache.invalidate(token)
+                    self.since = max(self.since, revoked_at)
+                self.polls += 1
+                self.next_poll = time.monotonic() + self.interval
+        finally:
+            self._lock.release()
+
+    def poll(self, conn, cache: SessionCache) -> None:
+        # One request polls when due; concurrent ones carry on with the cache as it is
+        since = self.claim()
+        if since is None:
+            return
+        rows = None
+        try:
+            cursor = conn.cursor()
+            run(cursor, REVOKED_SESSIONS, (since,))
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            self.release(cache, rows)
+
+session_cache = SessionCache(
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+    SESSION_NEGATIVE_CACHE_SIZE,
+    SESSION_NEGATIVE_CACHE_TTL
+)
+revocation_feed = RevocationFeed(SESSION_REVOCATION_POLL)
+
+def get_session_token(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'x-auth-token':
+            return value.strip() or None
+    return None
+
+def verify_session(conn, token: Optional[str]) -> Optional[int]:
+    if not token:
+        return None
+
+    revocation_feed.poll(conn, session_cache)
+    found, user_id = session_cache.get(token)
+    if found:
+        return user_id
+
+    now = datetime.utcnow()
+    cursor = conn.cursor()
+    run(cursor, SESSION_LOOKUP, (token, now))
+    row = cursor.fetchone()
+    cursor.close()
+
+    if not row:
+        if conn.replica_of is not None:
+            # Sessions are created on the primary; a miss on a replica may only be lag
+            with primary_connection(conn) as primary:
+                return verify_session(primary, token)
+        session_cache.put_negative(token)
+        return None
+
+    session_cache.put(token, row[0], (row[1] - now).total_seconds())
+    return row[0]
+
+def invalidate_session(token: str) -> None:
+    session_cache.invalidate(token)
@@ -0,0 +1,79 @@
+'''
+Local filesystem stand-in for an object store. Objects are written to a temporary
+file and renamed into place, so readers never see a partial object.
+Each function directory that stores objects ships an identical copy of this module.
+'''
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator
+
+OBJECT_STORE_DIR = os.environ.get('OBJECT_STORE_DIR', os.path.join(tempfile.gettempdir(), 'messenger-objects'))
+
+class LocalObjectStore:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f'Invalid object key: {key}')
+        return path
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                yield fileobj
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open_read(self, key: str) -> BinaryIO:
+        return open(self.path(key), 'rb')
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def move(self, source_key: str, target_key: str) -> None:
+        target = self.path(target_key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(self.path(source_key), target)
+
+    def delete_prefix(self, prefix: str) -> int:
+        directory = self.path(prefix.rstrip('/'))
+        if not os.path.isdir(directory):
+            return 0
+        deleted = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                os.unlink(path)
+                deleted += 1
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+        return deleted
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def describe(self, key: str) -> Dict[str, Any]:
+        path = self.path(key)
+        return {'key': key, 'url': 'file://' + path, 'bytes': os.path.getsize(path)}
+
+_store = None
+
+def get_store() -> LocalObjectStore:
+    global _store
+    if _store is None:
+        _store = LocalObjectStore(OBJECT_STORE_DIR)
+    return _store
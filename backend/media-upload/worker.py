@@ -0,0 +1,208 @@
+'''
+Background media worker: renders thumbnails for uploaded blobs off the request path
+and removes abandoned upload sessions. Jobs are claimed with FOR UPDATE SKIP LOCKED,
+so any number of workers can run side by side.
+
+    DATABASE_URL=postgresql://localhost/messenger python backend/media-upload/worker.py
+    DATABASE_URL=... python backend/media-upload/worker.py --once
+
+Thumbnails need Pillow (pip install Pillow); without it image jobs are marked skipped.
+'''
+import argparse
+import io
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from psycopg2.extras import RealDictCursor
+
+from db import Statement, get_pool, run
+from storage import get_store
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MEDIA_JOB_BATCH = int(os.environ.get('MEDIA_JOB_BATCH', '10'))
+MEDIA_JOB_LEASE = int(os.environ.get('MEDIA_JOB_LEASE', '300'))
+MEDIA_JOB_MAX_ATTEMPTS = int(os.environ.get('MEDIA_JOB_MAX_ATTEMPTS', '5'))
+MEDIA_JOB_RETRY_BASE = int(os.environ.get('MEDIA_JOB_RETRY_BASE', '30'))
+MEDIA_IDLE_SLEEP = float(os.environ.get('MEDIA_IDLE_SLEEP', '2'))
+MEDIA_SWEEP_INTERVAL = float(os.environ.get('MEDIA_SWEEP_INTERVAL', '600'))
+MEDIA_THUMBNAIL_SIZE = int(os.environ.get('MEDIA_THUMBNAIL_SIZE', '320'))
+MEDIA_THUMBNAIL_MAX_PIXELS = int(os.environ.get('MEDIA_THUMBNAIL_MAX_PIXELS', str(50_000_000)))
+
+log = logging.getLogger('media.worker')
+
+# Pending jobs that are due, and running jobs whose worker let the lease run out
+CLAIM_JOBS = Statement('claim_media_jobs', """
+        WITH claimed AS (
+            SELECT id FROM media_jobs
+            WHERE status IN ('pending', 'running')
+              AND run_after <= $1
+              AND (status = 'pending' OR locked_until < $1)
+            ORDER BY run_after, id
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE media_jobs j
+        SET status = 'running', attempts = j.attempts + 1, locked_until = $3
+        FROM claimed c, media_blobs b
+        WHERE j.id = c.id AND b.sha256 = j.sha256
+        RETURNING j.id, j.sha256, j.kind, j.attempts, b.storage_key, b.content_type
+""", ('timestamp', 'int', 'timestamp'))
+
+FINISH_JOB = Statement('finish_media_job', """
+        UPDATE media_jobs
+        SET status = $2, last_error = $3, locked_until = NULL, finished_at = $4
+        WHERE id = $1
+""", ('bigint', 'text', 'text', 'timestamp'))
+
+RETRY_JOB = Statement('retry_media_job', """
+        UPDATE media_jobs
+        SET status = 'pending', last_error = $2, locked_until = NULL, run_after = $3
+        WHERE id = $1
+""", ('bigint', 'text', 'timestamp'))
+
+ADD_VARIANT = Statement('add_media_variant', """
+        UPDATE media_blobs
+        SET variants = variants || jsonb_build_object($2::text, $3::jsonb)
+        WHERE sha256 = $1
+""", ('text', 'text', 'text'))
+
+EXPIRED_UPLOADS = Statement('expired_uploads', """
+        DELETE FROM media_uploads
+        WHERE upload_id IN (
+            SELECT upload_id FROM media_uploads
+            WHERE status = 'uploading' AND expires_at < $1
+            LIMIT 500
+        )
+        RETURNING upload_id
+""", ('timestamp',))
+
+class SkipJob(Exception):
+    pass
+
+def render_thumbnail(job: Dict[str, Any]) -> Dict[str, Any]:
+    if not job['content_type'].startswith('image/'):
+        raise SkipJob(f"No preview renderer for {job['content_type']}")
+    if Image is None:
+        raise SkipJob('Pillow is not installed')
+
+    store = get_store()
+    with store.open_read(job['storage_key']) as source:
+        image = Image.open(source)
+        if image.width * image.height > MEDIA_THUMBNAIL_MAX_PIXELS:
+            raise SkipJob(f'Image is larger than {MEDIA_THUMBNAIL_MAX_PIXELS} pixels')
+        image.draft('RGB', (MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+        image.thumbnail((MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=80, optimize=True)
+
+    key = f"thumbs/{job['sha256'][:2]}/{job['sha256']}-{MEDIA_THUMBNAIL_SIZE}.jpg"
+    with store.open_write(key) as target:
+        target.write(output.getvalue())
+    return {
+        'url': store.describe(key)['url'],
+        'content_type': 'image/jpeg',
+        'width': image.width,
+        'height': image.height
+    }
+
+RENDERERS = {
+    'thumbnail': render_thumbnail,
+}
+
+def claim(conn) -> List[Dict[str, Any]]:
+    now = datetime.utcnow()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    run(cursor, CLAIM_JOBS, (now, MEDIA_JOB_BATCH, now + timedelta(seconds=MEDIA_JOB_LEASE)))
+    jobs = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    cursor.close()
+    return jobs
+
+def process(conn, job: Dict[str, Any], stats: Dict[str, int]) -> None:
+    cursor = conn.cursor()
+    try:
+        variant = RENDERERS[job['kind']](job)
+    except SkipJob as reason:
+        run(cursor, FINISH_JOB, (job['id'], 'skipped', str(reason), datetime.utcnow()))
+        stats['skipped'] += 1
+    except Exception as error:
+        log.warning('Job %s (%s %s) failed: %s', job['id'], job['kind'], job['sha256'], error)
+        if job['attempts'] >= MEDIA_JOB_MAX_ATTEMPTS:
+            run(cursor, FINISH_JOB, (job['id'], 'failed', str(error)[:1000], datetime.utcnow()))
+            stats['failed'] += 1
+        else:
+            delay = MEDIA_JOB_RETRY_BASE * 2 ** (job['attempts'] - 1)
+            run(cursor, RETRY_JOB, (job['id'], str(error)[:1000], datetime.utcnow() + timedelta(seconds=delay)))
+            stats['retried'] += 1
+    else:
+        run(cursor, ADD_VARIANT, (job['sha256'], job['kind'], json.dumps(variant)))
+        run(cursor, FINISH_JOB, (job['id'], 'done', None, datetime.utcnow()))
+        stats['done'] += 1
+    conn.commit()
+    cursor.close()
+
+def sweep_expired_uploads(conn) -> int:
+    cursor = conn.cursor()
+    run(cursor, EXPIRED_UPLOADS, (datetime.utcnow(),))
+    upload_ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    cursor.close()
+    store = get_store()
+    for upload_id in upload_ids:
+        store.delete_prefix(f'uploads/{upload_id}/')
+    return len(upload_ids)
+
+def work(dsn: str, once: bool, stop: Dict[str, bool]) -> Dict[str, int]:
+    stats = {'done': 0, 'skipped': 0, 'failed': 0, 'retried': 0, 'expired_uploads': 0}
+    swept_at: Optional[float] = None
+    pool = get_pool(dsn)
+
+    while not stop['requested']:
+        with pool.connection() as conn:
+            if swept_at is None or time.monotonic() - swept_at >= MEDIA_SWEEP_INTERVAL:
+                stats['expired_uploads'] += sweep_expired_uploads(conn)
+                swept_at = time.monotonic()
+            jobs = claim(conn)
+            for job in jobs:
+                process(conn, job, stats)
+
+        if not jobs:
+            if once:
+                break
+            time.sleep(MEDIA_IDLE_SLEEP)
+    return stats
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Process media jobs queued by media-upload')
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        raise SystemExit('DATABASE_URL is not set')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    stop = {'requested': False}
+    def request_stop(signum, frame):
+        stop['requested'] = True
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, request_stop)
+
+    stats = work(dsn, args.once, stop)
+    log.info('Stopped: %s', json.dumps(stats))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
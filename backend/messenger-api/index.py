@@ -1,69 +1,78 @@
+import base64
+import hashlib
 import json
 import os
-from typing import Dict, Any, List, Optional
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from pydantic import BaseModel, Field
-
-class CreateChatRequest(BaseModel):
-    user_id: int = Field(..., gt=0)
-    chat_type: str = Field(..., pattern='^(direct|group|channel)$')
-    name: Optional[str] = Field(None, min_length=1, max_length=255)
-    description: Optional[str] = Field(None, max_length=1000)
-    member_ids: List[int] = Field(default_factory=list)
-
-class SendMessageRequest(BaseModel):
-    chat_id: int = Field(..., gt=0)
-    sender_id: int = Field(..., gt=0)
-    message_type: str = Field(default='text', pattern='^(text|image|video|audio|file)$')
-    content: Optional[str] = None
-    media_url: Optional[str] = None
-    file_name: Optional[str] = None
-    file_size: Optional[int] = None
-
-class UpdateProfileRequest(BaseModel):
-    user_id: int = Field(..., gt=0)
-    username: Optional[str] = Field(None, min_length=3, max_length=50)
-    full_name: Optional[str] = Field(None, min_length=1, max_length=255)
-    bio: Optional[str] = Field(None, max_length=500)
-    avatar_url: Optional[str] = None
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import Statement, get_pool, get_router, pool_stats, prepare, router_stats, run, statement_report
+from sessions import SESSION_LOOKUP, get_session_token, session_cache, verify_session
+from profiles import invalidate_profile, load_profiles, profile_cache
+from members import CHAT_MEMBERSHIP, cached_members, invalidate_chat, is_member, membership_cache
+from instrument import instrumented, phase
+
+def validate(model_name: str, data: Dict) -> Any:
+    with phase('validate'):
+        import models
+        return getattr(models, model_name)(**data)
+
+MAX_CHAT_MEMBERS = int(os.environ.get('MAX_CHAT_MEMBERS', '10000'))
+REALTIME_CHANNEL = os.environ.get('REALTIME_CHANNEL', 'chat_events')
+
+PUBLISH_EVENTS = Statement('publish_events', """
+        SELECT pg_notify($1, payload) FROM unnest($2) AS payload
+""", ('text', 'text[]'))
+
+def publish_events(cursor, events: List[Dict]) -> None:
+    if events:
+        payloads = [json.dumps(event, separators=(',', ':')) for event in events]
+        run(cursor, PUBLISH_EVENTS, (REALTIME_CHANNEL, payloads))
+
+# NOTIFY payloads must stay under 8000 bytes, so large member lists go out in slices
+MEMBER_EVENT_CHUNK = 500
+
+def member_events(chat_id: int, field: str, user_ids: List[int]) -> List[Dict]:
+    return [
+        {'t': 'members', 'chat_id': chat_id, field: user_ids[start:start + MEMBER_EVENT_CHUNK]}
+        for start in range(0, len(user_ids), MEMBER_EVENT_CHUNK)
+    ]
 
 def create_chat(body_data: Dict, conn) -> Dict:
-    req = CreateChatRequest(**body_data)
+    req = validate('CreateChatRequest', body_data)
     
     if req.chat_type in ['group', 'channel'] and not req.name:
         return {'statusCode': 400, 'error': 'Name is required for groups and channels'}
     
-    cursor = conn.cursor()
+    member_ids = sorted(set(req.member_ids) - {req.user_id})
     
-    name_escaped = req.name.replace("'", "''") if req.name else 'NULL'
-    desc_escaped = req.description.replace("'", "''") if req.description else 'NULL'
-    name_value = f"'{name_escaped}'" if req.name else 'NULL'
-    desc_value = f"'{desc_escaped}'" if req.description else 'NULL'
+    if len(member_ids) + 1 > MAX_CHAT_MEMBERS:
+        return {'statusCode': 400, 'error': f'A chat can have at most {MAX_CHAT_MEMBERS} members'}
     
-    cursor.execute(f"""
+    cursor = conn.cursor()
+    
+    cursor.execute("""
         INSERT INTO chats (type, name, description, created_by)
-        VALUES ('{req.chat_type}', {name_value}, {desc_value}, {req.user_id})
+        VALUES (%s, %s, %s, %s)
         RETURNING id
-    """)
+    """, (req.chat_type, req.name, req.description, req.user_id))
     
     chat_id = cursor.fetchone()[0]
     
-    cursor.execute(f"""
+    cursor.execute("""
         INSERT INTO chat_members (chat_id, user_id, role)
-        VALUES ({chat_id}, {req.user_id}, 'owner')
-    """)
+        VALUES (%s, %s, 'owner')
+    """, (chat_id, req.user_id))
     
-    for member_id in req.member_ids:
-        if member_id != req.user_id:
-            cursor.execute(f"""
-                INSERT INTO chat_members (chat_id, user_id, role)
-                VALUES ({chat_id}, {member_id}, 'member')
-                ON CONFLICT (chat_id, user_id) DO NOTHING
-            """)
+    added = insert_members(cursor, chat_id, member_ids)
+    publish_events(cursor, member_events(chat_id, 'added', [req.user_id] + added))
     
     conn.commit()
     cursor.close()
+    invalidate_chat(chat_id)
     
     return {
         'statusCode': 200,
@@ -71,26 +80,114 @@ def create_chat(body_data: Dict, conn) -> Dict:
             'chat_id': chat_id,
             'type': req.chat_type,
             'name': req.name,
-            'description': req.description
+            'description': req.description,
+            'member_count': len(added) + 1
         }
     }
 
-def list_chats(params: Dict, conn) -> Dict:
-    user_id = params.get('user_id')
-    chat_type = params.get('type', '')
+def insert_members(cursor, chat_id: int, member_ids: List[int]) -> List[int]:
+    if not member_ids:
+        return []
+    cursor.execute("""
+        INSERT INTO chat_members (chat_id, user_id, role)
+        SELECT %s, u.id, 'member'
+        FROM users u
+        WHERE u.id = ANY(%s)
+        ON CONFLICT (chat_id, user_id) DO NOTHING
+        RETURNING user_id
+    """, (chat_id, member_ids))
+    return [row[0] for row in cursor.fetchall()]
+
+def lock_chat_for_member_change(cursor, chat_id: int, user_id: int) -> Tuple[Optional[str], Optional[Dict]]:
+    cursor.execute("""
+        SELECT c.type, cm.role
+        FROM chats c
+        LEFT JOIN chat_members cm ON cm.chat_id = c.id AND cm.user_id = %s
+        WHERE c.id = %s
+        FOR UPDATE OF c
+    """, (user_id, chat_id))
+    row = cursor.fetchone()
     
-    if not user_id:
-        return {'statusCode': 400, 'error': 'user_id is required'}
+    if not row:
+        return None, {'statusCode': 404, 'error': 'Chat not found'}
+    if row[0] == 'direct':
+        return None, {'statusCode': 400, 'error': 'Members of a direct chat cannot be changed'}
+    if row[1] is None:
+        return None, {'statusCode': 403, 'error': 'User is not a member of this chat'}
+    return row[1], None
+
+def add_members(body_data: Dict, conn) -> Dict:
+    req = validate('ChangeMembersRequest', body_data)
     
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if len(req.member_ids) > MAX_CHAT_MEMBERS:
+        return {'statusCode': 400, 'error': f'A chat can have at most {MAX_CHAT_MEMBERS} members'}
     
-    type_filter = ''
-    if chat_type:
-        chat_type_escaped = chat_type.replace("'", "''")
-        type_filter = f"AND c.type = '{chat_type_escaped}'"
+    cursor = conn.cursor()
     
-    cursor.execute(f"""
-        SELECT 
+    role, error = lock_chat_for_member_change(cursor, req.chat_id, req.user_id)
+    if error:
+        cursor.close()
+        return error
+    if role not in ('owner', 'admin'):
+        cursor.close()
+        return {'statusCode': 403, 'error': 'Only owners and admins can add members'}
+    
+    added = insert_members(cursor, req.chat_id, sorted(set(req.member_ids)))
+    
+    cursor.execute("SELECT count(*) FROM chat_members WHERE chat_id = %s", (req.chat_id,))
+    member_count = cursor.fetchone()[0]
+    
+    if member_count > MAX_CHAT_MEMBERS:
+        conn.rollback()
+        cursor.close()
+        return {'statusCode': 400, 'error': f'A chat can have at most {MAX_CHAT_MEMBERS} members'}
+    
+    if added:
+        publish_events(cursor, member_events(req.chat_id, 'added', added))
+    
+    conn.commit()
+    cursor.close()
+    invalidate_chat(req.chat_id)
+    
+    return {'statusCode': 200, 'data': {'chat_id': req.chat_id, 'added': added, 'member_count': member_count}}
+
+def remove_members(body_data: Dict, conn) -> Dict:
+    req = validate('ChangeMembersRequest', body_data)
+    
+    cursor = conn.cursor()
+    
+    role, error = lock_chat_for_member_change(cursor, req.chat_id, req.user_id)
+    if error:
+        cursor.close()
+        return error
+    
+    leaving = set(req.member_ids) == {req.user_id}
+    if role not in ('owner', 'admin') and not leaving:
+        cursor.close()
+        return {'statusCode': 403, 'error': 'Only owners and admins can remove members'}
+    
+    cursor.execute("""
+        DELETE FROM chat_members
+        WHERE chat_id = %s
+          AND user_id = ANY(%s)
+          AND role <> 'owner'
+          AND (role = 'member' OR %s = 'owner' OR user_id = %s)
+        RETURNING user_id
+    """, (req.chat_id, sorted(set(req.member_ids)), role, req.user_id))
+    removed = [row[0] for row in cursor.fetchall()]
+    
+    if removed:
+        publish_events(cursor, member_events(req.chat_id, 'removed', removed))
+    
+    conn.commit()
+    cursor.close()
+    invalidate_chat(req.chat_id)
+    
+    return {'statusCode': 200, 'data': {'chat_id': req.chat_id, 'removed': removed}}
+
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+
+CHAT_COLUMNS = """
             c.id,
             c.type,
             c.name,
@@ -98,66 +195,181 @@ def list_chats(params: Dict, conn) -> Dict:
             c.avatar_url,
             c.created_by,
             to_char(c.updated_at, 'YYYY-MM-DD HH24:MI:SS') as updated_at,
-            (SELECT json_build_object(
-                'id', m.id,
-                'content', m.content,
-                'message_type', m.message_type,
-                'sender_id', m.sender_id,
-                'created_at', to_char(m.created_at, 'YYYY-MM-DD HH24:MI:SS')
-            )
-            FROM messages m
-            WHERE m.chat_id = c.id
-            ORDER BY m.created_at DESC
-            LIMIT 1) as last_message
-        FROM chats c
-        INNER JOIN chat_members cm ON cm.chat_id = c.id
-        WHERE cm.user_id = {user_id} {type_filter}
+            CASE WHEN c.last_message_id IS NOT NULL THEN json_build_object(
+                'id', c.last_message_id,
+                'content', c.last_message_preview,
+                'message_type', c.last_message_type,
+                'sender_id', c.last_message_sender_id,
+                'created_at', to_char(c.last_message_at, 'YYYY-MM-DD HH24:MI:SS')
+            ) END as last_message,
+            cm.last_read_message_id,
+            cm.unread_count
+"""
+
+LIST_CHATS = Statement('list_chats', f"""
+        SELECT {CHAT_COLUMNS}
+        FROM chat_members cm
+        INNER JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = $1 AND ($2 = '' OR c.type = $2)
         ORDER BY c.updated_at DESC
-    """)
+""", ('int', 'text'))
+
+CHATS_VERSION = Statement('chats_version', """
+        SELECT
+            count(*) as chat_count,
+            sum(c.id) as chat_id_sum,
+            max(c.updated_at) as updated_at,
+            sum(c.message_seq) as message_seq_sum,
+            max(cm.joined_at) as joined_at,
+            sum(cm.unread_count) as unread_sum,
+            max(cm.last_read_message_id) as last_read_max
+        FROM chat_members cm
+        INNER JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = $1
+""", ('int',))
+
+def make_etag(*parts: Any) -> str:
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or etag[2:] in candidates
+
+def list_chats(params: Dict, conn, if_none_match: Optional[str] = None) -> Dict:
+    user_id = params.get('user_id')
+    chat_type = params.get('type', '')
+    
+    if not user_id:
+        return {'statusCode': 400, 'error': 'user_id is required'}
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    run(cursor, CHATS_VERSION, (user_id,))
+    version = cursor.fetchone()
+    etag = make_etag('chats', user_id, chat_type, *version.values())
+    
+    if etag_matches(if_none_match, etag):
+        cursor.close()
+        return {'statusCode': 304, 'headers': {'ETag': etag}}
+    
+    run(cursor, LIST_CHATS, (user_id, chat_type))
     
     chats = cursor.fetchall()
     cursor.close()
     
-    return {'statusCode': 200, 'data': {'chats': [dict(chat) for chat in chats]}}
+    return {'statusCode': 200, 'headers': {'ETag': etag}, 'data': {'chats': [dict(chat) for chat in chats]}}
+
+INSERT_MESSAGE = Statement('insert_message', """
+        INSERT INTO messages (chat_id, sender_id, message_type, content, media_url, media_sha256, file_name, file_size)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        RETURNING id, created_at
+""", ('int', 'int', 'text', 'text', 'text', 'text', 'text', 'bigint'))
+
+# Media is attached by content hash, never by URL: the sender must have uploaded the blob
+# or already see it in one of their chats, the same rule media-upload serves it by
+SENDABLE_MEDIA = Statement('sendable_media', """
+        SELECT b.sha256, b.storage_key, b.byte_size
+        FROM media_blobs b
+        WHERE b.sha256 = ANY($1) AND (
+            EXISTS (
+                SELECT 1 FROM media_uploads mu
+                WHERE mu.sha256 = b.sha256 AND mu.user_id = $2 AND mu.status = 'complete'
+            ) OR EXISTS (
+                SELECT 1
+                FROM messages m
+                INNER JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = $2
+                WHERE m.media_sha256 = b.sha256
+            )
+        )
+""", ('text[]', 'int'))
+
+MEDIA_URL_ERROR = 'media_url is set by the server; attach uploaded media with media_sha256'
+
+def sendable_media(cursor, user_id: int, hashes: List[str]) -> Dict[str, Tuple[str, int]]:
+    '''The media_url and size of each hash the user may attach; other hashes are left out.'''
+    if not hashes:
+        return {}
+    from storage import get_store
+    run(cursor, SENDABLE_MEDIA, (sorted(set(hashes)), user_id))
+    store = get_store()
+    return {row[0]: (store.describe(row[1])['url'], row[2]) for row in cursor.fetchall()}
+
+# Concurrent sends can commit out of id order, so the pointer only moves forward;
+# updated_at and message_seq are bumped either way
+FORWARD_LAST_MESSAGE = """
+            last_message_id = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v.message_id
+                THEN v.message_id ELSE c.last_message_id END,
+            last_message_sender_id = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v.message_id
+                THEN v.sender_id ELSE c.last_message_sender_id END,
+            last_message_type = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v.message_id
+                THEN v.message_type ELSE c.last_message_type END,
+            last_message_preview = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v.message_id
+                THEN v.preview ELSE c.last_message_preview END,
+            last_message_at = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v.message_id
+                THEN v.created_at ELSE c.last_message_at END
+"""
+
+TOUCH_CHAT = Statement('touch_chat', f"""
+        UPDATE chats c
+        SET updated_at = CURRENT_TIMESTAMP,
+            message_seq = c.message_seq + 1,
+            {FORWARD_LAST_MESSAGE}
+        FROM (SELECT $1 AS message_id, $2 AS sender_id, $3 AS message_type,
+                     left($4, {LAST_MESSAGE_PREVIEW_LENGTH}) AS preview, $5 AS created_at) v
+        WHERE c.id = $6
+""", ('int', 'int', 'text', 'text', 'timestamp', 'int'))
+
+BUMP_UNREAD = Statement('bump_unread', """
+        UPDATE chat_members
+        SET unread_count = unread_count + 1
+        WHERE chat_id = $1 AND user_id <> $2
+""", ('int', 'int'))
 
 def send_message(body_data: Dict, conn) -> Dict:
-    req = SendMessageRequest(**body_data)
+    req = validate('SendMessageRequest', body_data)
     
     if req.message_type == 'text' and not req.content:
         return {'statusCode': 400, 'error': 'Content is required for text messages'}
     
-    cursor = conn.cursor()
+    if req.media_url and not req.media_sha256:
+        return {'statusCode': 400, 'error': MEDIA_URL_ERROR}
     
-    cursor.execute(f"""
-        SELECT 1 FROM chat_members WHERE chat_id = {req.chat_id} AND user_id = {req.sender_id}
-    """)
+    cursor = conn.cursor()
     
-    if not cursor.fetchone():
+    # Hot chats answer from the membership cache without a round trip
+    if not is_member(cursor, req.chat_id, req.sender_id):
         cursor.close()
         return {'statusCode': 403, 'error': 'User is not a member of this chat'}
     
-    content_escaped = req.content.replace("'", "''") if req.content else 'NULL'
-    media_escaped = req.media_url.replace("'", "''") if req.media_url else 'NULL'
-    file_name_escaped = req.file_name.replace("'", "''") if req.file_name else 'NULL'
+    media_url, file_size = None, req.file_size
+    if req.media_sha256:
+        media = sendable_media(cursor, req.sender_id, [req.media_sha256])
+        if req.media_sha256 not in media:
+            cursor.close()
+            return {'statusCode': 404, 'error': 'Media not found'}
+        media_url, file_size = media[req.media_sha256]
     
-    content_value = f"'{content_escaped}'" if req.content else 'NULL'
-    media_value = f"'{media_escaped}'" if req.media_url else 'NULL'
-    file_name_value = f"'{file_name_escaped}'" if req.file_name else 'NULL'
-    file_size_value = str(req.file_size) if req.file_size else 'NULL'
-    
-    cursor.execute(f"""
-        INSERT INTO messages (chat_id, sender_id, message_type, content, media_url, file_name, file_size)
-        VALUES ({req.chat_id}, {req.sender_id}, '{req.message_type}', {content_value}, {media_value}, {file_name_value}, {file_size_value})
-        RETURNING id, created_at
-    """)
+    run(cursor, INSERT_MESSAGE, (
+        req.chat_id,
+        req.sender_id,
+        req.message_type,
+        req.content,
+        media_url,
+        req.media_sha256,
+        req.file_name,
+        file_size
+    ))
     
     result = cursor.fetchone()
     message_id = result[0]
     created_at = result[1].isoformat()
     
-    cursor.execute(f"""
-        UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = {req.chat_id}
-    """)
+    run(cursor, TOUCH_CHAT, (message_id, req.sender_id, req.message_type, req.content, result[1], req.chat_id))
+    run(cursor, BUMP_UNREAD, (req.chat_id, req.sender_id))
+    publish_events(cursor, [{'t': 'message', 'chat_id': req.chat_id, 'id': message_id, 'sender_id': req.sender_id}])
     
     conn.commit()
     cursor.close()
@@ -170,90 +382,782 @@ def send_message(body_data: Dict, conn) -> Dict:
             'sender_id': req.sender_id,
             'message_type': req.message_type,
             'content': req.content,
-            'media_url': req.media_url,
+            'media_url': media_url,
+            'media_sha256': req.media_sha256,
             'file_name': req.file_name,
-            'file_size': req.file_size,
+            'file_size': file_size,
             'created_at': created_at
         }
     }
 
-def list_messages(params: Dict, conn) -> Dict:
-    chat_id = params.get('chat_id')
-    limit = params.get('limit', '50')
-    offset = params.get('offset', '0')
+SEND_BATCH_MAX = 500
+
+def send_messages(body_data: Dict, conn) -> Dict:
+    items = body_data.get('messages')
     
-    if not chat_id:
-        return {'statusCode': 400, 'error': 'chat_id is required'}
+    if not isinstance(items, list) or not items:
+        return {'statusCode': 400, 'error': 'messages must be a non-empty list'}
     
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if len(items) > SEND_BATCH_MAX:
+        return {'statusCode': 400, 'error': f'At most {SEND_BATCH_MAX} messages per request'}
     
-    cursor.execute(f"""
-        SELECT 
+    results: List[Dict] = [{} for _ in items]
+    valid: List[Tuple[int, Any]] = []
+    
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'status': 'error', 'statusCode': 400, 'error': 'Message must be an object'}
+            continue
+        try:
+            req = validate('SendMessageRequest', item)
+        except ValueError as e:
+            results[index] = {'index': index, 'status': 'error', 'statusCode': 400, 'error': str(e)}
+            continue
+        if req.message_type == 'text' and not req.content:
+            results[index] = {'index': index, 'status': 'error', 'statusCode': 400, 'error': 'Content is required for text messages'}
+            continue
+        if req.media_url and not req.media_sha256:
+            results[index] = {'index': index, 'status': 'error', 'statusCode': 400, 'error': MEDIA_URL_ERROR}
+            continue
+        valid.append((index, req))
+    
+    cursor = conn.cursor()
+    
+    if valid:
+        pairs = sorted({(req.chat_id, req.sender_id) for _, req in valid})
+        allowed = cached_members(pairs)
+        unknown = [pair for pair in pairs if pair not in allowed]
+        if unknown:
+            cursor.execute("""
+                SELECT p.chat_id, p.user_id
+                FROM unnest(%s::int[], %s::int[]) AS p(chat_id, user_id)
+                WHERE EXISTS (
+                    SELECT 1 FROM chat_members cm
+                    WHERE cm.chat_id = p.chat_id AND cm.user_id = p.user_id
+                )
+            """, ([pair[0] for pair in unknown], [pair[1] for pair in unknown]))
+            allowed.update((row[0], row[1]) for row in cursor.fetchall())
+        
+        accepted = []
+        for index, req in valid:
+            if (req.chat_id, req.sender_id) in allowed:
+                accepted.append((index, req))
+            else:
+                results[index] = {'index': index, 'status': 'error', 'statusCode': 403, 'error': 'User is not a member of this chat'}
+        valid = accepted
+    
+    media: Dict[Tuple[int, str], Tuple[str, int]] = {}
+    if any(req.media_sha256 for _, req in valid):
+        for sender_id in sorted({req.sender_id for _, req in valid}):
+            hashes = [req.media_sha256 for _, req in valid if req.sender_id == sender_id and req.media_sha256]
+            for sha256, found in sendable_media(cursor, sender_id, hashes).items():
+                media[(sender_id, sha256)] = found
+        attached = []
+        for index, req in valid:
+            if req.media_sha256 and (req.sender_id, req.media_sha256) not in media:
+                results[index] = {'index': index, 'status': 'error', 'statusCode': 404, 'error': 'Media not found'}
+            else:
+                attached.append((index, req))
+        valid = attached
+    
+    if valid:
+        # RETURNING does not promise the order of the input rows, so each row carries
+        # its position in the batch through a pre-drawn id
+        cursor.execute("""
+            WITH batch AS MATERIALIZED (
+                SELECT nextval('messages_id_seq') AS id, b.*
+                FROM unnest(%s::int[], %s::int[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::bigint[])
+                    WITH ORDINALITY AS b(chat_id, sender_id, message_type, content, media_url, media_sha256, file_name, file_size, position)
+            ), inserted AS (
+                INSERT INTO messages (id, chat_id, sender_id, message_type, content, media_url, media_sha256, file_name, file_size)
+                SELECT id, chat_id, sender_id, message_type, content, media_url, media_sha256, file_name, file_size
+                FROM batch
+                RETURNING id, created_at
+            )
+            SELECT batch.position, inserted.id, inserted.created_at
+            FROM inserted
+            INNER JOIN batch ON batch.id = inserted.id
+        """, tuple(list(column) for column in zip(*[
+            (
+                req.chat_id,
+                req.sender_id,
+                req.message_type,
+                req.content,
+                media[(req.sender_id, req.media_sha256)][0] if req.media_sha256 else None,
+                req.media_sha256,
+                req.file_name,
+                media[(req.sender_id, req.media_sha256)][1] if req.media_sha256 else req.file_size
+            )
+            for _, req in valid
+        ])))
+        inserted = {position: (message_id, created_at) for position, message_id, created_at in cursor.fetchall()}
+        
+        latest: Dict[int, Tuple] = {}
+        sent_per_chat: Dict[int, int] = {}
+        for position, (index, req) in enumerate(valid, start=1):
+            message_id, created_at = inserted[position]
+            sent_per_chat[req.chat_id] = sent_per_chat.get(req.chat_id, 0) + 1
+            results[index] = {
+                'index': index,
+                'status': 'sent',
+                'message_id': message_id,
+                'chat_id': req.chat_id,
+                'created_at': created_at.isoformat()
+            }
+            if req.chat_id in latest and latest[req.chat_id][1] > message_id:
+                continue
+            latest[req.chat_id] = (
+                req.chat_id,
+                message_id,
+                req.sender_id,
+                req.message_type,
+                req.content[:LAST_MESSAGE_PREVIEW_LENGTH] if req.content else None,
+                created_at
+            )
+        
+        execute_values(cursor, f"""
+            UPDATE chats c
+            SET updated_at = CURRENT_TIMESTAMP,
+                message_seq = c.message_seq + v.sent,
+                {FORWARD_LAST_MESSAGE}
+            FROM (VALUES %s) AS v(chat_id, message_id, sender_id, message_type, preview, created_at, sent)
+            WHERE c.id = v.chat_id
+        """, [row + (sent_per_chat[row[0]],) for row in latest.values()], page_size=len(latest))
+        
+        cursor.execute("""
+            UPDATE chat_members cm
+            SET unread_count = cm.unread_count + b.unread
+            FROM (
+                SELECT recipient.id, count(*) AS unread
+                FROM unnest(%s::int[], %s::int[]) AS sent(chat_id, sender_id)
+                INNER JOIN chat_members recipient
+                    ON recipient.chat_id = sent.chat_id AND recipient.user_id <> sent.sender_id
+                GROUP BY recipient.id
+            ) b
+            WHERE cm.id = b.id
+        """, ([req.chat_id for _, req in valid], [req.sender_id for _, req in valid]))
+        
+        publish_events(cursor, [
+            {'t': 'message', 'chat_id': req.chat_id, 'id': results[index]['message_id'], 'sender_id': req.sender_id}
+            for index, req in valid
+        ])
+        
+        conn.commit()
+    
+    cursor.close()
+    
+    sent = sum(1 for result in results if result.get('status') == 'sent')
+    
+    return {
+        'statusCode': 200,
+        'data': {
+            'results': results,
+            'sent': sent,
+            'failed': len(results) - sent
+        }
+    }
+
+MESSAGES_PAGE_DEFAULT = 50
+MESSAGES_PAGE_MAX = 200
+
+MESSAGE_COLUMNS = """
             m.id,
             m.chat_id,
             m.sender_id,
             m.message_type,
             m.content,
             m.media_url,
+            m.media_sha256,
             m.file_name,
             m.file_size,
             to_char(m.created_at, 'YYYY-MM-DD HH24:MI:SS') as created_at,
+            m.created_at as sort_key,
             u.username,
             u.full_name,
             u.avatar_url
+"""
+
+CHAT_VERSION = Statement('chat_version', """
+        SELECT c.last_message_id, c.message_seq
+        FROM chat_members cm
+        INNER JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.chat_id = $1 AND cm.user_id = $2
+""", ('int', 'int'))
+
+MESSAGE_ANCHOR = Statement('message_anchor', """
+        SELECT created_at FROM messages WHERE id = $1 AND chat_id = $2
+""", ('int', 'int'))
+
+LIST_MESSAGES_LATEST = Statement('list_messages_latest', f"""
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages m
+        INNER JOIN users u ON u.id = m.sender_id
+        WHERE m.chat_id = $1
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT $2 OFFSET $3
+""", ('int', 'int', 'int'))
+
+LIST_MESSAGES_BEFORE = Statement('list_messages_before', f"""
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages m
+        INNER JOIN users u ON u.id = m.sender_id
+        WHERE m.chat_id = $1 AND m.created_at <= $2 AND (m.created_at, m.id) < ($2, $3)
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT $4
+""", ('int', 'timestamp', 'int', 'int'))
+
+LIST_MESSAGES_AFTER = Statement('list_messages_after', f"""
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages m
+        INNER JOIN users u ON u.id = m.sender_id
+        WHERE m.chat_id = $1 AND m.created_at >= $2 AND (m.created_at, m.id) > ($2, $3)
+        ORDER BY m.created_at ASC, m.id ASC
+        LIMIT $4
+""", ('int', 'timestamp', 'int', 'int'))
+
+COMPACT_MESSAGE_COLUMNS = """
+            m.id,
+            m.chat_id,
+            m.sender_id,
+            m.message_type,
+            m.content,
+            m.media_url,
+            m.media_sha256,
+            m.file_name,
+            m.file_size,
+            to_char(m.created_at, 'YYYY-MM-DD HH24:MI:SS') as created_at,
+            m.created_at as sort_key
+"""
+
+LIST_MESSAGES_LATEST_COMPACT = Statement('list_messages_latest_compact', f"""
+        SELECT {COMPACT_MESSAGE_COLUMNS}
+        FROM messages m
+        WHERE m.chat_id = $1
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT $2 OFFSET $3
+""", ('int', 'int', 'int'))
+
+LIST_MESSAGES_BEFORE_COMPACT = Statement('list_messages_before_compact', f"""
+        SELECT {COMPACT_MESSAGE_COLUMNS}
+        FROM messages m
+        WHERE m.chat_id = $1 AND m.created_at <= $2 AND (m.created_at, m.id) < ($2, $3)
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT $4
+""", ('int', 'timestamp', 'int', 'int'))
+
+LIST_MESSAGES_AFTER_COMPACT = Statement('list_messages_after_compact', f"""
+        SELECT {COMPACT_MESSAGE_COLUMNS}
+        FROM messages m
+        WHERE m.chat_id = $1 AND m.created_at >= $2 AND (m.created_at, m.id) > ($2, $3)
+        ORDER BY m.created_at ASC, m.id ASC
+        LIMIT $4
+""", ('int', 'timestamp', 'int', 'int'))
+
+def encode_cursor(direction: str, message_id: int, created_at: datetime) -> str:
+    raw = f"{direction}:{message_id}:{created_at.isoformat()}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Optional[Tuple[str, int, datetime]]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, message_id, created_at = base64.urlsafe_b64decode(padded).decode().split(':', 2)
+        if direction not in ('before', 'after'):
+            return None
+        return direction, int(message_id), datetime.fromisoformat(created_at)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def list_messages(params: Dict, conn, if_none_match: Optional[str] = None) -> Dict:
+    chat_id = params.get('chat_id')
+    
+    if not chat_id:
+        return {'statusCode': 400, 'error': 'chat_id is required'}
+    
+    try:
+        chat_id = int(chat_id)
+        limit = min(max(int(params.get('limit', MESSAGES_PAGE_DEFAULT)), 1), MESSAGES_PAGE_MAX)
+        offset = int(params['offset']) if params.get('offset') else None
+        before_id = int(params['before_id']) if params.get('before_id') else None
+        after_id = int(params['after_id']) if params.get('after_id') else None
+    except ValueError:
+        return {'statusCode': 400, 'error': 'chat_id, limit, offset, before_id and after_id must be integers'}
+    
+    compact = params.get('compact') in ('1', 'true')
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    run(cursor, CHAT_VERSION, (chat_id, params.get('user_id')))
+    version = cursor.fetchone()
+    if not version:
+        cursor.close()
+        return {'statusCode': 403, 'error': 'User is not a member of this chat'}
+    
+    etag = make_etag(
+        'messages',
+        chat_id,
+        version['last_message_id'],
+        version['message_seq'],
+        limit,
+        offset,
+        before_id,
+        after_id,
+        params.get('cursor'),
+        compact
+    )
+    
+    if etag_matches(if_none_match, etag):
+        cursor.close()
+        return {'statusCode': 304, 'headers': {'ETag': etag}}
+    
+    position = None
+    if params.get('cursor'):
+        position = decode_cursor(params['cursor'])
+        if not position:
+            cursor.close()
+            return {'statusCode': 400, 'error': 'Invalid cursor'}
+    elif before_id or after_id:
+        anchor_id = before_id or after_id
+        run(cursor, MESSAGE_ANCHOR, (anchor_id, chat_id))
+        anchor = cursor.fetchone()
+        if not anchor:
+            cursor.close()
+            return {'statusCode': 400, 'error': 'Message not found in this chat'}
+        position = ('before' if before_id else 'after', anchor_id, anchor['created_at'])
+    
+    if position and position[0] == 'after':
+        statement = LIST_MESSAGES_AFTER_COMPACT if compact else LIST_MESSAGES_AFTER
+        run(cursor, statement, (chat_id, position[2], position[1], limit + 1))
+    elif position:
+        statement = LIST_MESSAGES_BEFORE_COMPACT if compact else LIST_MESSAGES_BEFORE
+        run(cursor, statement, (chat_id, position[2], position[1], limit + 1))
+    else:
+        statement = LIST_MESSAGES_LATEST_COMPACT if compact else LIST_MESSAGES_LATEST
+        run(cursor, statement, (chat_id, limit + 1, offset or 0))
+    
+    messages = cursor.fetchall()
+    cursor.close()
+    
+    has_more = len(messages) > limit
+    messages_list = [dict(msg) for msg in messages[:limit]]
+    
+    direction = 'after' if position and position[0] == 'after' else 'before'
+    next_cursor = None
+    if has_more:
+        edge = messages_list[-1]
+        next_cursor = encode_cursor(direction, edge['id'], edge['sort_key'])
+    
+    if direction == 'before':
+        messages_list.reverse()
+    
+    for msg in messages_list:
+        del msg['sort_key']
+    
+    data = {'messages': messages_list, 'next_cursor': next_cursor, 'has_more': has_more}
+    
+    if compact:
+        profiles = load_profiles(conn, [msg['sender_id'] for msg in messages_list])
+        data['users'] = {str(user_id): profile for user_id, profile in profiles.items()}
+    
+    return {
+        'statusCode': 200,
+        'headers': {'ETag': etag},
+        'data': data
+    }
+
+SYNC_BATCH_DEFAULT = 500
+SYNC_BATCH_MAX = 1000
+
+# Chats with messages above the message watermark, plus chats joined or changed
+# (metadata, role, read state) above the chat watermark
+SYNC_CHATS = Statement('sync_chats', f"""
+        SELECT {CHAT_COLUMNS},
+            greatest(c.change_seq, cm.change_seq) as change_seq
+        FROM chat_members cm
+        INNER JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = $1
+          AND (c.last_message_id > $2 OR c.change_seq > $3 OR cm.change_seq > $3)
+        ORDER BY c.updated_at DESC
+""", ('int', 'int', 'bigint'))
+
+SYNC_REMOVED_CHATS = Statement('sync_removed_chats', """
+        SELECT r.chat_id, max(r.change_seq) as change_seq
+        FROM chat_member_removals r
+        WHERE r.user_id = $1 AND r.change_seq > $2
+          AND NOT EXISTS (
+              SELECT 1 FROM chat_members cm WHERE cm.chat_id = r.chat_id AND cm.user_id = r.user_id
+          )
+        GROUP BY r.chat_id
+""", ('int', 'bigint'))
+
+SYNC_MESSAGES = Statement('sync_messages', f"""
+        SELECT {MESSAGE_COLUMNS}
         FROM messages m
         INNER JOIN users u ON u.id = m.sender_id
-        WHERE m.chat_id = {chat_id}
-        ORDER BY m.created_at DESC
-        LIMIT {limit} OFFSET {offset}
-    """)
+        WHERE m.chat_id = ANY($1) AND m.id > $2
+        ORDER BY m.id ASC
+        LIMIT $3
+""", ('int[]', 'int', 'int'))
+
+def sync(params: Dict, conn) -> Dict:
+    user_id = params.get('user_id')
+    
+    if not user_id:
+        return {'statusCode': 400, 'error': 'user_id is required'}
+    
+    try:
+        user_id = int(user_id)
+        since = int(params.get('since', 0))
+        # Without chat_since every chat is returned, as a first sync needs
+        chat_since = int(params['chat_since']) if params.get('chat_since') else -1
+        limit = min(max(int(params.get('limit', SYNC_BATCH_DEFAULT)), 1), SYNC_BATCH_MAX)
+    except ValueError:
+        return {'statusCode': 400, 'error': 'user_id, since, chat_since and limit must be integers'}
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    run(cursor, SYNC_CHATS, (user_id, since, chat_since))
+    chats = [dict(chat) for chat in cursor.fetchall()]
+    
+    run(cursor, SYNC_REMOVED_CHATS, (user_id, chat_since))
+    removed = cursor.fetchall()
+    
+    chat_watermark = max([chat_since, 0] + [row['change_seq'] for row in chats + removed])
+    for chat in chats:
+        del chat['change_seq']
+    
+    messages_list: List[Dict] = []
+    has_more = False
+    if chats:
+        run(cursor, SYNC_MESSAGES, ([chat['id'] for chat in chats], since, limit + 1))
+        messages = cursor.fetchall()
+        has_more = len(messages) > limit
+        messages_list = [dict(msg) for msg in messages[:limit]]
+        for msg in messages_list:
+            del msg['sort_key']
+    
+    cursor.close()
+    
+    watermark = messages_list[-1]['id'] if messages_list else since
+    
+    return {
+        'statusCode': 200,
+        'data': {
+            'messages': messages_list,
+            'chats': chats,
+            'removed_chat_ids': [row['chat_id'] for row in removed],
+            'watermark': watermark,
+            'chat_watermark': chat_watermark,
+            'has_more': has_more
+        }
+    }
+
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_QUERY_MAX_LENGTH = 200
+SEARCH_HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2'
+
+SEARCH_COLUMNS = f"""
+            h.id,
+            h.chat_id,
+            h.sender_id,
+            h.message_type,
+            ts_headline(
+                'russian',
+                replace(replace(replace(h.content, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                q.query,
+                '{SEARCH_HEADLINE_OPTIONS}'
+            ) as snippet,
+            to_char(h.created_at, 'YYYY-MM-DD HH24:MI:SS') as created_at,
+            h.created_at as sort_key,
+            h.rank,
+            u.username,
+            u.full_name,
+            u.avatar_url
+"""
+
+USER_CHAT_IDS = Statement('user_chat_ids', """
+        SELECT coalesce(array_agg(chat_id), '{}') AS chat_ids FROM chat_members WHERE user_id = $1
+""", ('int',))
+
+# chat_id = ANY($2) and the @@ match are both conditions of the (chat_id, search_vector)
+# index scan, so ranking only sees matches in the caller's chats
+SEARCH_BY_RANK = Statement('search_by_rank', f"""
+        WITH q AS (SELECT websearch_to_tsquery('russian', $1) AS query)
+        SELECT {SEARCH_COLUMNS}
+        FROM (
+            SELECT m.id, m.chat_id, m.sender_id, m.message_type, m.content, m.created_at,
+                   round(ts_rank_cd(m.search_vector, q.query)::numeric, 6) AS rank
+            FROM messages m, q
+            WHERE m.chat_id = ANY($2) AND m.search_vector @@ q.query
+        ) h
+        CROSS JOIN q
+        INNER JOIN users u ON u.id = h.sender_id
+        WHERE NOT $3 OR (h.rank, h.id) < ($4, $5)
+        ORDER BY h.rank DESC, h.id DESC
+        LIMIT $6
+""", ('text', 'int[]', 'boolean', 'numeric', 'int', 'int'))
+
+SEARCH_BY_RECENT = Statement('search_by_recent', f"""
+        WITH q AS (SELECT websearch_to_tsquery('russian', $1) AS query)
+        SELECT {SEARCH_COLUMNS}
+        FROM (
+            SELECT m.id, m.chat_id, m.sender_id, m.message_type, m.content, m.created_at,
+                   round(ts_rank_cd(m.search_vector, q.query)::numeric, 6) AS rank
+            FROM messages m, q
+            WHERE m.chat_id = ANY($2) AND m.search_vector @@ q.query
+              AND (NOT $3 OR (m.created_at <= $4 AND (m.created_at, m.id) < ($4, $5)))
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT $6
+        ) h
+        CROSS JOIN q
+        INNER JOIN users u ON u.id = h.sender_id
+        ORDER BY h.created_at DESC, h.id DESC
+""", ('text', 'int[]', 'boolean', 'timestamp', 'int', 'int'))
+
+def encode_search_cursor(sort: str, message_id: int, key: Any) -> str:
+    value = key.isoformat() if isinstance(key, datetime) else str(key)
+    raw = f"{sort}:{message_id}:{value}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_search_cursor(cursor: str, sort: str) -> Optional[Tuple[int, Any]]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, message_id, value = base64.urlsafe_b64decode(padded).decode().split(':', 2)
+        if cursor_sort != sort:
+            return None
+        key = datetime.fromisoformat(value) if sort == 'recent' else Decimal(value)
+        return int(message_id), key
+    except (ValueError, UnicodeDecodeError, InvalidOperation):
+        return None
+
+def search_messages(params: Dict, conn) -> Dict:
+    query = (params.get('query') or '').strip()
+    sort = params.get('sort') or 'relevance'
+    
+    if not query:
+        return {'statusCode': 400, 'error': 'query is required'}
+    
+    if len(query) > SEARCH_QUERY_MAX_LENGTH:
+        return {'statusCode': 400, 'error': f'query must be at most {SEARCH_QUERY_MAX_LENGTH} characters'}
+    
+    if sort not in ('relevance', 'recent'):
+        return {'statusCode': 400, 'error': 'sort must be relevance or recent'}
+    
+    try:
+        user_id = int(params.get('user_id'))
+        chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        limit = min(max(int(params.get('limit', SEARCH_PAGE_DEFAULT)), 1), SEARCH_PAGE_MAX)
+    except (TypeError, ValueError):
+        return {'statusCode': 400, 'error': 'user_id, chat_id and limit must be integers'}
+    
+    position = None
+    if params.get('cursor'):
+        position = decode_search_cursor(params['cursor'], sort)
+        if not position:
+            return {'statusCode': 400, 'error': 'Invalid cursor'}
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    if chat_id:
+        run(cursor, CHAT_MEMBERSHIP, (chat_id, user_id))
+        if not cursor.fetchone():
+            cursor.close()
+            return {'statusCode': 403, 'error': 'User is not a member of this chat'}
+        chat_ids = [chat_id]
+    else:
+        run(cursor, USER_CHAT_IDS, (user_id,))
+        chat_ids = cursor.fetchone()['chat_ids']
+    
+    if not chat_ids:
+        cursor.close()
+        return {'statusCode': 200, 'data': {'messages': [], 'next_cursor': None, 'has_more': False}}
+    
+    statement = SEARCH_BY_RECENT if sort == 'recent' else SEARCH_BY_RANK
+    message_id, key = position if position else (0, None)
+    run(cursor, statement, (query, chat_ids, position is not None, key, message_id, limit + 1))
     
     messages = cursor.fetchall()
     cursor.close()
     
-    messages_list = [dict(msg) for msg in messages]
-    messages_list.reverse()
+    has_more = len(messages) > limit
+    messages_list = [dict(msg) for msg in messages[:limit]]
+    
+    next_cursor = None
+    if has_more:
+        edge = messages_list[-1]
+        next_cursor = encode_search_cursor(sort, edge['id'], edge['sort_key'] if sort == 'recent' else edge['rank'])
+    
+    for msg in messages_list:
+        del msg['sort_key']
+        msg['rank'] = float(msg['rank'])
+    
+    return {
+        'statusCode': 200,
+        'data': {'messages': messages_list, 'next_cursor': next_cursor, 'has_more': has_more}
+    }
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '2000'))
+
+EXPORT_COLUMNS = ('id', 'sender_id', 'username', 'message_type', 'content', 'media_url', 'file_name', 'file_size', 'created_at')
+
+EXPORT_QUERY = """
+        SELECT m.id, m.sender_id, u.username, m.message_type, m.content,
+               m.media_url, m.file_name, m.file_size,
+               to_char(m.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        FROM messages m
+        INNER JOIN users u ON u.id = m.sender_id
+        WHERE m.chat_id = %s
+        ORDER BY m.created_at ASC, m.id ASC
+"""
+
+def export_chat(body_data: Dict, conn) -> Dict:
+    import gzip
+    import secrets
+    from storage import get_store
+    
+    req = validate('ExportChatRequest', body_data)
+    
+    cursor = conn.cursor()
+    run(cursor, CHAT_MEMBERSHIP, (req.chat_id, req.user_id))
+    membership = cursor.fetchone()
+    cursor.close()
+    
+    if not membership:
+        return {'statusCode': 403, 'error': 'User is not a member of this chat'}
+    
+    started_at = datetime.utcnow()
+    suffix = '.ndjson.gz' if req.compress else '.ndjson'
+    key = f"exports/chat-{req.chat_id}/{started_at.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}{suffix}"
+    store = get_store()
+    exported = 0
+    
+    rows = conn.cursor(name=f'export_chat_{req.chat_id}_{secrets.token_hex(4)}')
+    
+    try:
+        rows.execute(EXPORT_QUERY, (req.chat_id,))
+        with store.open_write(key) as target:
+            output = gzip.GzipFile(fileobj=target, mode='wb', compresslevel=6) if req.compress else target
+            try:
+                while True:
+                    batch = rows.fetchmany(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    output.write(b''.join(
+                        json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False).encode() + b'\n'
+                        for row in batch
+                    ))
+                    exported += len(batch)
+            finally:
+                if output is not target:
+                    output.close()
+    finally:
+        rows.close()
+    conn.commit()
+    
+    return {
+        'statusCode': 200,
+        'data': {
+            'export': {
+                **store.describe(key),
+                'chat_id': req.chat_id,
+                'messages': exported,
+                'content_type': 'application/x-ndjson',
+                'content_encoding': 'gzip' if req.compress else None,
+                'created_at': started_at.isoformat()
+            }
+        }
+    }
+
+READ_STATE = Statement('read_state', """
+        SELECT cm.last_read_message_id, c.last_message_id
+        FROM chat_members cm
+        INNER JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.chat_id = $1 AND cm.user_id = $2
+        FOR UPDATE OF cm
+""", ('int', 'int'))
+
+COUNT_UNREAD = Statement('count_unread', """
+        SELECT count(*) FROM messages
+        WHERE chat_id = $1 AND id > $2 AND sender_id <> $3
+""", ('int', 'int', 'int'))
+
+MARK_READ = Statement('mark_read', """
+        UPDATE chat_members
+        SET last_read_message_id = $3, unread_count = $4
+        WHERE chat_id = $1 AND user_id = $2
+""", ('int', 'int', 'int', 'int'))
+
+def mark_read(body_data: Dict, conn) -> Dict:
+    req = validate('MarkReadRequest', body_data)
+    
+    cursor = conn.cursor()
+    
+    run(cursor, READ_STATE, (req.chat_id, req.user_id))
+    state = cursor.fetchone()
+    
+    if not state:
+        cursor.close()
+        return {'statusCode': 403, 'error': 'User is not a member of this chat'}
+    
+    current_read_id, last_message_id = state[0] or 0, state[1] or 0
+    target_id = min(req.message_id, last_message_id) if req.message_id else last_message_id
+    read_id = max(current_read_id, target_id)
+    
+    if read_id >= last_message_id:
+        unread_count = 0
+    else:
+        run(cursor, COUNT_UNREAD, (req.chat_id, read_id, req.user_id))
+        unread_count = cursor.fetchone()[0]
+    
+    run(cursor, MARK_READ, (req.chat_id, req.user_id, read_id, unread_count))
+    
+    conn.commit()
+    cursor.close()
     
-    return {'statusCode': 200, 'data': {'messages': messages_list}}
+    return {
+        'statusCode': 200,
+        'data': {
+            'chat_id': req.chat_id,
+            'last_read_message_id': read_id,
+            'unread_count': unread_count
+        }
+    }
 
 def update_profile(body_data: Dict, conn) -> Dict:
-    req = UpdateProfileRequest(**body_data)
+    req = validate('UpdateProfileRequest', body_data)
     
     cursor = conn.cursor()
     
-    update_fields = []
+    updates: List[Tuple[str, Any]] = []
     
     if req.username:
-        username_escaped = req.username.replace("'", "''")
-        cursor.execute(f"SELECT id FROM users WHERE username = '{username_escaped}' AND id != {req.user_id}")
+        cursor.execute("SELECT id FROM users WHERE username = %s AND id != %s", (req.username, req.user_id))
         if cursor.fetchone():
             cursor.close()
             return {'statusCode': 400, 'error': 'Username already taken'}
-        update_fields.append(f"username = '{username_escaped}'")
+        updates.append(('username', req.username))
     
     if req.full_name:
-        full_name_escaped = req.full_name.replace("'", "''")
-        update_fields.append(f"full_name = '{full_name_escaped}'")
+        updates.append(('full_name', req.full_name))
     
     if req.bio is not None:
-        bio_escaped = req.bio.replace("'", "''")
-        update_fields.append(f"bio = '{bio_escaped}'")
+        updates.append(('bio', req.bio))
     
     if req.avatar_url is not None:
-        avatar_escaped = req.avatar_url.replace("'", "''")
-        update_fields.append(f"avatar_url = '{avatar_escaped}'")
+        updates.append(('avatar_url', req.avatar_url))
     
-    if not update_fields:
+    if not updates:
+        cursor.close()
         return {'statusCode': 400, 'error': 'No fields to update'}
     
-    update_fields.append("updated_at = CURRENT_TIMESTAMP")
+    set_clause = ', '.join(f"{column} = %s" for column, _ in updates)
     
     cursor.execute(f"""
         UPDATE users
-        SET {', '.join(update_fields)}
-        WHERE id = {req.user_id}
+        SET {set_clause}, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
         RETURNING id, username, email, full_name, avatar_url, bio, online_status
-    """)
+    """, [value for _, value in updates] + [req.user_id])
     
     user = cursor.fetchone()
     
@@ -263,6 +1167,7 @@ def update_profile(body_data: Dict, conn) -> Dict:
     
     conn.commit()
     cursor.close()
+    invalidate_profile(req.user_id)
     
     user_data = {
         'id': user[0],
@@ -276,10 +1181,217 @@ def update_profile(body_data: Dict, conn) -> Dict:
     
     return {'statusCode': 200, 'data': {'user': user_data}}
 
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '60'))
+PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get('PRESENCE_HEARTBEAT_INTERVAL', '15'))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '30'))
+PRESENCE_DEDUPE_SIZE = int(os.environ.get('PRESENCE_DEDUPE_SIZE', '50000'))
+PRESENCE_QUERY_MAX = 500
+
+_heartbeats: Dict[int, float] = {}
+_presence_flushed_at = 0.0
+
+TOUCH_PRESENCE = Statement('touch_presence', """
+        INSERT INTO user_presence (user_id, last_active_at)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE
+        SET last_active_at = EXCLUDED.last_active_at
+        WHERE user_presence.last_active_at < EXCLUDED.last_active_at
+""", ('int', 'timestamp'))
+
+PRESENCE_BY_IDS = Statement('presence_by_ids', """
+        SELECT u.id AS user_id,
+               coalesce(p.last_active_at > $2, false) AS online,
+               to_char(greatest(p.last_active_at, u.last_seen), 'YYYY-MM-DD HH24:MI:SS') AS last_seen
+        FROM unnest($1) AS ids(id)
+        INNER JOIN users u ON u.id = ids.id
+        LEFT JOIN user_presence p ON p.user_id = u.id
+""", ('int[]', 'timestamp'))
+
+def heartbeat(body_data: Dict, conn) -> Dict:
+    global _presence_flushed_at
+    user_id = int(body_data['user_id'])
+    now = time.monotonic()
+    
+    # Repeated beats from the same user inside the interval are answered from memory
+    last_beat = _heartbeats.get(user_id)
+    if last_beat is None or now - last_beat >= PRESENCE_HEARTBEAT_INTERVAL:
+        if len(_heartbeats) >= PRESENCE_DEDUPE_SIZE:
+            _heartbeats.clear()
+        _heartbeats[user_id] = now
+        
+        cursor = conn.cursor()
+        run(cursor, TOUCH_PRESENCE, (user_id, datetime.utcnow()))
+        if now - _presence_flushed_at >= PRESENCE_FLUSH_INTERVAL:
+            _presence_flushed_at = now
+            cursor.execute("SELECT flush_user_presence(%s)", (PRESENCE_TTL,))
+        conn.commit()
+        cursor.close()
+    
+    return {
+        'statusCode': 200,
+        'data': {'online': True, 'ttl': PRESENCE_TTL, 'next_heartbeat_in': PRESENCE_HEARTBEAT_INTERVAL}
+    }
+
+def presence(params: Dict, conn) -> Dict:
+    try:
+        user_ids = sorted({int(value) for value in (params.get('user_ids') or '').split(',') if value.strip()})
+    except ValueError:
+        return {'statusCode': 400, 'error': 'user_ids must be a comma separated list of integers'}
+    
+    if not user_ids:
+        return {'statusCode': 400, 'error': 'user_ids is required'}
+    
+    if len(user_ids) > PRESENCE_QUERY_MAX:
+        return {'statusCode': 400, 'error': f'At most {PRESENCE_QUERY_MAX} user_ids per request'}
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    run(cursor, PRESENCE_BY_IDS, (user_ids, datetime.utcnow() - timedelta(seconds=PRESENCE_TTL)))
+    rows = [dict(row) for row in cursor.fetchall()]
+    cursor.close()
+    
+    return {'statusCode': 200, 'data': {'presence': rows}}
+
+PARTITION_MONTHS_AHEAD = 2
+
+_partitions_checked_on: Optional[date] = None
+
+def ensure_partitions(conn) -> None:
+    global _partitions_checked_on
+    today = date.today()
+    if _partitions_checked_on == today:
+        return
+    cursor = conn.cursor()
+    cursor.execute("SELECT ensure_messages_partitions(%s)", (PARTITION_MONTHS_AHEAD,))
+    conn.commit()
+    cursor.close()
+    _partitions_checked_on = today
+
+PREWARM_ON_IMPORT = os.environ.get('PREWARM_ON_IMPORT', '') == '1'
+
+_prewarm_lock = threading.Lock()
+_prewarmed: Optional[Dict[str, Any]] = None
+
+def prewarm(dsn: Optional[str]) -> Dict[str, Any]:
+    global _prewarmed
+    with _prewarm_lock:
+        if _prewarmed is not None:
+            return {**_prewarmed, 'already_warm': True}
+        
+        started = time.perf_counter()
+        import models
+        for name in ('SendMessageRequest', 'CreateChatRequest', 'MarkReadRequest'):
+            getattr(models, name).model_rebuild(force=True)
+        
+        prepared = 0
+        if dsn:
+            with get_pool(dsn).connection() as conn:
+                prepared = prepare(conn, (
+                    SESSION_LOOKUP,
+                    CHATS_VERSION,
+                    LIST_CHATS,
+                    CHAT_VERSION,
+                    LIST_MESSAGES_LATEST,
+                    CHAT_MEMBERSHIP,
+                    INSERT_MESSAGE,
+                    TOUCH_CHAT,
+                    BUMP_UNREAD,
+                    PUBLISH_EVENTS
+                ))
+        
+        _prewarmed = {'prepared': prepared, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)}
+        return {**_prewarmed, 'already_warm': False}
+
+def metrics() -> Dict:
+    return {
+        'statusCode': 200,
+        'data': {
+            'membership_cache': membership_cache.snapshot(),
+            'session_cache': session_cache.snapshot(),
+            'profile_cache': profile_cache.snapshot(),
+            'pools': pool_stats(),
+            'routing': router_stats(),
+            'statements': statement_report()
+        }
+    }
+
+# Served by a replica when DATABASE_REPLICA_URLS is set; presence stays on the
+# primary because user_presence is unlogged and does not exist on replicas
+REPLICA_ACTIONS = ('list_chats', 'list_messages', 'sync', 'search_messages')
+
+# Writes the sender reads back, so their WAL position is returned and pinned
+TRACKED_WRITE_ACTIONS = (
+    'create_chat', 'send_message', 'send_messages', 'add_members',
+    'remove_members', 'mark_read', 'update_profile'
+)
+
+# Shape checks that need no database, answered before the session lookup as
+# contact-add does, so malformed requests never take a pooled connection
+def reject_malformed(method: str, data: Dict) -> Optional[Dict]:
+    action = data.get('action', '')
+    if method == 'GET' and action == 'list_messages' and data.get('cursor') and not decode_cursor(data['cursor']):
+        return {'statusCode': 400, 'error': 'Invalid cursor'}
+    if method == 'POST' and action == 'send_messages':
+        items = data.get('messages')
+        if not isinstance(items, list) or not items:
+            return {'statusCode': 400, 'error': 'messages must be a non-empty list'}
+        if len(items) > SEND_BATCH_MAX:
+            return {'statusCode': 400, 'error': f'At most {SEND_BATCH_MAX} messages per request'}
+    return None
+
+def http_response(result: Dict) -> Dict[str, Any]:
+    if 'error' in result:
+        return {
+            'statusCode': result['statusCode'],
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': result['error']})
+        }
+    
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag, X-Write-LSN',
+        **result.get('headers', {})
+    }
+    
+    if result['statusCode'] == 304:
+        return {
+            'statusCode': 304,
+            'headers': headers,
+            'isBase64Encoded': False,
+            'body': ''
+        }
+    
+    with phase('serialize'):
+        response_body = json.dumps(result['data'])
+    
+    return {
+        'statusCode': result['statusCode'],
+        'headers': headers,
+        'isBase64Encoded': False,
+        'body': response_body
+    }
+
+def bind_user(data: Dict, user_id: int) -> Optional[Dict]:
+    for field in ('user_id', 'sender_id'):
+        value = data.get(field)
+        if value is None or value == '':
+            data[field] = user_id
+        elif str(value) != str(user_id):
+            return {'statusCode': 403, 'error': f'{field} does not match the session user'}
+    return None
+
+@instrumented('messenger-api')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Unified messenger API for chats and messages
-    Args: event - dict with httpMethod, queryStringParameters, body
+    Args: event - dict with httpMethod, headers (X-Auth-Token), queryStringParameters, body
           context - object with request_id attribute
     Returns: HTTP response with requested data
     '''
@@ -291,7 +1403,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, If-None-Match, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -305,55 +1417,109 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Database configuration missing'})
         }
     
-    conn = psycopg2.connect(dsn)
-    
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters', {})
-            action = params.get('action', '')
-            
-            if action == 'list_chats':
-                result = list_chats(params, conn)
-            elif action == 'list_messages':
-                result = list_messages(params, conn)
-            else:
-                result = {'statusCode': 400, 'error': 'Invalid action'}
+        if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'prewarm':
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(prewarm(dsn))
+            }
         
-        elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action', '')
-            
-            if action == 'create_chat':
-                result = create_chat(body_data, conn)
-            elif action == 'send_message':
-                result = send_message(body_data, conn)
-            elif action == 'update_profile':
-                result = update_profile(body_data, conn)
-            else:
-                result = {'statusCode': 400, 'error': 'Invalid action'}
+        if method == 'POST':
+            request_data = json.loads(event.get('body') or '{}')
         else:
-            result = {'statusCode': 405, 'error': 'Method not allowed'}
-        
-        conn.close()
+            request_data = dict(event.get('queryStringParameters') or {})
         
-        if 'error' in result:
+        malformed = reject_malformed(method, request_data)
+        if malformed:
             return {
-                'statusCode': result['statusCode'],
+                'statusCode': malformed['statusCode'],
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': result['error']})
+                'body': json.dumps({'error': malformed['error']})
             }
         
-        return {
-            'statusCode': result['statusCode'],
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps(result['data'])
-        }
+        router = get_router(dsn)
+        token = get_session_token(event)
+        read_only = method == 'GET' and request_data.get('action') in REPLICA_ACTIONS
+        
+        with router.connection(read_only, token, get_header(event, 'X-Min-LSN')) as conn:
+            auth_user_id = verify_session(conn, token)
+            
+            if auth_user_id is None:
+                result = {'statusCode': 401, 'error': 'Invalid or missing session token'}
+            
+            elif method == 'GET':
+                params = request_data
+                action = params.get('action', '')
+                bind_error = bind_user(params, auth_user_id)
+            
+                if bind_error:
+                    result = bind_error
+                elif action == 'list_chats':
+                    result = list_chats(params, conn, get_header(event, 'If-None-Match'))
+                elif action == 'list_messages':
+                    result = list_messages(params, conn, get_header(event, 'If-None-Match'))
+                elif action == 'sync':
+                    result = sync(params, conn)
+                elif action == 'search_messages':
+                    result = search_messages(params, conn)
+                elif action == 'presence':
+                    result = presence(params, conn)
+                elif action == 'metrics':
+                    result = metrics()
+                else:
+                    result = {'statusCode': 400, 'error': 'Invalid action'}
+        
+            elif method == 'POST':
+                body_data = request_data
+                action = body_data.get('action', '')
+                bind_error = bind_user(body_data, auth_user_id)
+                if not bind_error and isinstance(body_data.get('messages'), list):
+                    for item in body_data['messages']:
+                        if isinstance(item, dict):
+                            bind_error = bind_error or bind_user(item, auth_user_id)
+            
+                if action in ('send_message', 'send_messages'):
+                    ensure_partitions(conn)
+            
+                if bind_error:
+                    result = bind_error
+                elif action == 'create_chat':
+                    result = create_chat(body_data, conn)
+                elif action == 'send_message':
+                    result = send_message(body_data, conn)
+                elif action == 'send_messages':
+                    result = send_messages(body_data, conn)
+                elif action == 'add_members':
+                    result = add_members(body_data, conn)
+                elif action == 'remove_members':
+                    result = remove_members(body_data, conn)
+                elif action == 'mark_read':
+                    result = mark_read(body_data, conn)
+                elif action == 'update_profile':
+                    result = update_profile(body_data, conn)
+                elif action == 'export_chat':
+                    result = export_chat(body_data, conn)
+                elif action == 'heartbeat':
+                    result = heartbeat(body_data, conn)
+                else:
+                    result = {'statusCode': 400, 'error': 'Invalid action'}
+            
+                if action in TRACKED_WRITE_ACTIONS and result['statusCode'] < 300:
+                    write_lsn = router.record_write(conn, token)
+                    if write_lsn:
+                        result['headers'] = {**result.get('headers', {}), 'X-Write-LSN': write_lsn}
+            else:
+                result = {'statusCode': 405, 'error': 'Method not allowed'}
+        
+        return http_response(result)
     
     except Exception as e:
-        conn.close()
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        }
+
+if PREWARM_ON_IMPORT:
+    threading.Thread(target=prewarm, args=(os.environ.get('DATABASE_URL'),), daemon=True).start()
@@ -0,0 +1,167 @@
+'''
+In-process cache of chat membership for hot chats, so repeated sends to a busy
+group or channel skip the chat_members round trip. A chat is loaded as a sorted
+array of member ids once it sees MEMBERSHIP_HOT_THRESHOLD checks within
+MEMBERSHIP_CACHE_TTL. Chats over MEMBERSHIP_CACHE_MAX_MEMBERS are remembered as
+uncacheable for a TTL and keep using the single-row check. Only positive answers are served from memory: a user missing
+from a cached chat is still checked against the database, so a member added on
+another instance is never refused. Removals invalidate this instance; other
+instances stop accepting a removed member within MEMBERSHIP_CACHE_TTL.
+'''
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from db import Statement, run
+
+MEMBERSHIP_CACHE_CHATS = int(os.environ.get('MEMBERSHIP_CACHE_CHATS', '2000'))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', '15'))
+MEMBERSHIP_HOT_THRESHOLD = int(os.environ.get('MEMBERSHIP_HOT_THRESHOLD', '20'))
+MEMBERSHIP_CACHE_MAX_MEMBERS = int(os.environ.get('MEMBERSHIP_CACHE_MAX_MEMBERS', '10000'))
+
+CHAT_MEMBERSHIP = Statement('chat_membership', """
+        SELECT 1 FROM chat_members WHERE chat_id = $1 AND user_id = $2
+""", ('int', 'int'))
+
+# Reads at most $2 ids, so finding out a chat is too big to cache stays cheap
+CHAT_MEMBER_IDS = Statement('chat_member_ids', """
+        SELECT coalesce(array_agg(user_id ORDER BY user_id), '{}')
+        FROM (
+            SELECT user_id FROM chat_members
+            WHERE chat_id = $1
+            ORDER BY user_id
+            LIMIT $2
+        ) m
+""", ('int', 'int'))
+
+class MembershipCache:
+    def __init__(self, max_chats: int, ttl: float, hot_threshold: int):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self.hot_threshold = hot_threshold
+        self._entries: 'OrderedDict[int, Tuple[array, float]]' = OrderedDict()
+        self._heat: 'OrderedDict[int, Tuple[int, float]]' = OrderedDict()
+        # Chats too large to hold, with the time they may be tried again
+        self._uncacheable: 'OrderedDict[int, float]' = OrderedDict()
+        # Bumped by every invalidation; a load that started before one is not stored
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_checks': 0,
+            'loads': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'uncacheable': 0,
+        }
+
+    def lookup(self, chat_id: int, user_id: int) -> Optional[bool]:
+        '''True when the cached chat contains user_id, False when it does not, None when the chat is not cached.'''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[1] <= now:
+                del self._entries[chat_id]
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            members = entry[0]
+            position = bisect_left(members, user_id)
+            if position < len(members) and members[position] == user_id:
+                self.stats['hits'] += 1
+                return True
+            self.stats['negative_checks'] += 1
+            return False
+
+    def is_hot(self, chat_id: int) -> bool:
+        '''Counts a check against chat_id; True once it crosses the threshold within one TTL window.'''
+        now = time.monotonic()
+        with self._lock:
+            retry_at = self._uncacheable.get(chat_id)
+            if retry_at is not None:
+                if retry_at > now:
+                    return False
+                del self._uncacheable[chat_id]
+            count, window_start = self._heat.get(chat_id, (0, now))
+            if now - window_start >= self.ttl:
+                count, window_start = 0, now
+            count += 1
+            self._heat[chat_id] = (count, window_start)
+            self._heat.move_to_end(chat_id)
+            while len(self._heat) > self.max_chats * 4:
+                self._heat.popitem(last=False)
+            return count >= self.hot_threshold
+
+    def epoch(self) -> int:
+        with self._lock:
+            return self._epoch
+
+    def put(self, chat_id: int, member_ids: Iterable[int], epoch: int) -> None:
+        members = array('i', member_ids)
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._entries[chat_id] = (members, time.monotonic() + self.ttl)
+            self._entries.move_to_end(chat_id)
+            self._heat.pop(chat_id, None)
+            self.stats['loads'] += 1
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def mark_uncacheable(self, chat_id: int) -> None:
+        with self._lock:
+            self._uncacheable[chat_id] = time.monotonic() + self.ttl
+            self._uncacheable.move_to_end(chat_id)
+            self._heat.pop(chat_id, None)
+            self.stats['uncacheable'] += 1
+            while len(self._uncacheable) > self.max_chats:
+                self._uncacheable.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._epoch += 1
+            if self._entries.pop(chat_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            chats = len(self._entries)
+            members = sum(len(entry[0]) for entry in self._entries.values())
+        checks = self.stats['hits'] + self.stats['misses'] + self.stats['negative_checks']
+        hit_rate = self.stats['hits'] / checks if checks else 0.0
+        return {**self.stats, 'chats': chats, 'members': members, 'hit_rate': round(hit_rate, 4)}
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_CHATS, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_HOT_THRESHOLD)
+
+def is_member(cursor, chat_id: int, user_id: int) -> bool:
+    cached = membership_cache.lookup(chat_id, user_id)
+    if cached:
+        return True
+
+    if cached is None and membership_cache.is_hot(chat_id):
+        epoch = membership_cache.epoch()
+        run(cursor, CHAT_MEMBER_IDS, (chat_id, MEMBERSHIP_CACHE_MAX_MEMBERS + 1))
+        member_ids = cursor.fetchone()[0]
+        if len(member_ids) <= MEMBERSHIP_CACHE_MAX_MEMBERS:
+            membership_cache.put(chat_id, member_ids, epoch)
+            position = bisect_left(member_ids, user_id)
+            return position < len(member_ids) and member_ids[position] == user_id
+        membership_cache.mark_uncacheable(chat_id)
+
+    run(cursor, CHAT_MEMBERSHIP, (chat_id, user_id))
+    return cursor.fetchone() is not None
+
+def cached_members(pairs: Iterable[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+    '''The (chat_id, user_id) pairs that the cache confirms; the rest need a database check.'''
+    return {pair for pair in pairs if membership_cache.lookup(*pair)}
+
+def invalidate_chat(chat_id: int) -> None:
+    membership_cache.invalidate(chat_id)
@@ -0,0 +1,54 @@
+'''
+Request models for the POST actions. Imported on first validation so GET-only
+instances never load pydantic.
+'''
+import os
+from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+# pydantic reads this on the first model build, not at import: skips scanning
+# installed package metadata for plugins. The other functions set it the same way.
+os.environ.setdefault('PYDANTIC_DISABLE_PLUGINS', '__all__')
+
+class RequestModel(BaseModel):
+    # Validators are built on first use, so an instance only pays for the models its actions need
+    model_config = ConfigDict(defer_build=True)
+
+class CreateChatRequest(RequestModel):
+    user_id: int = Field(..., gt=0)
+    chat_type: str = Field(..., pattern='^(direct|group|channel)$')
+    name: Optional[str] = Field(None, min_length=1, max_length=255)
+    description: Optional[str] = Field(None, max_length=1000)
+    member_ids: List[int] = Field(default_factory=list)
+
+class SendMessageRequest(RequestModel):
+    chat_id: int = Field(..., gt=0)
+    sender_id: int = Field(..., gt=0)
+    message_type: str = Field(default='text', pattern='^(text|image|video|audio|file)$')
+    content: Optional[str] = None
+    media_url: Optional[str] = None
+    media_sha256: Optional[str] = Field(None, pattern='^[0-9a-f]{64}$')
+    file_name: Optional[str] = None
+    file_size: Optional[int] = None
+
+class ChangeMembersRequest(RequestModel):
+    chat_id: int = Field(..., gt=0)
+    user_id: int = Field(..., gt=0)
+    member_ids: List[int] = Field(..., min_length=1)
+
+class MarkReadRequest(RequestModel):
+    chat_id: int = Field(..., gt=0)
+    user_id: int = Field(..., gt=0)
+    message_id: Optional[int] = Field(None, gt=0)
+
+class UpdateProfileRequest(RequestModel):
+    user_id: int = Field(..., gt=0)
+    username: Optional[str] = Field(None, min_length=3, max_length=50)
+    full_name: Optional[str] = Field(None, min_length=1, max_length=255)
+    bio: Optional[str] = Field(None, max_length=500)
+    avatar_url: Optional[str] = None
+
+class ExportChatRequest(RequestModel):
+    chat_id: int = Field(..., gt=0)
+    user_id: int = Field(..., gt=0)
+    compress: bool = True
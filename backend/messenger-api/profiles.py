@@ -0,0 +1,83 @@
+'''
+In-process LRU+TTL cache of public user profiles for compact message pages.
+update_profile invalidates this instance; other instances catch up within PROFILE_CACHE_TTL.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Tuple
+
+from db import Statement, run
+
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '20000'))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '60'))
+
+PROFILES_BY_IDS = Statement('profiles_by_ids', """
+    SELECT id, username, full_name, avatar_url FROM users WHERE id = ANY($1)
+""", ('int[]',))
+
+class ProfileCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[int, Tuple[Dict[str, Any], float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_many(self, user_ids: Iterable[int]) -> Tuple[Dict[int, Dict[str, Any]], List[int]]:
+        now = time.monotonic()
+        found: Dict[int, Dict[str, Any]] = {}
+        missing: List[int] = []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(user_id)
+                    found[user_id] = entry[0]
+                    self.stats['hits'] += 1
+                else:
+                    missing.append(user_id)
+                    self.stats['misses'] += 1
+        return found, missing
+
+    def put_many(self, profiles: Dict[int, Dict[str, Any]]) -> None:
+        valid_until = time.monotonic() + self.ttl
+        with self._lock:
+            for user_id, profile in profiles.items():
+                self._entries[user_id] = (profile, valid_until)
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        return {**self.stats, 'size': size, 'hit_rate': round(hit_rate, 4)}
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+def load_profiles(conn, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    profiles, missing = profile_cache.get_many(sorted(set(user_ids)))
+    if missing:
+        cursor = conn.cursor()
+        run(cursor, PROFILES_BY_IDS, (missing,))
+        loaded = {
+            row[0]: {'username': row[1], 'full_name': row[2], 'avatar_url': row[3]}
+            for row in cursor.fetchall()
+        }
+        cursor.close()
+        profile_cache.put_many(loaded)
+        profiles.update(loaded)
+    return profiles
+
+def invalidate_profile(user_id: int) -> None:
+    profile_cache.invalidate(user_id)
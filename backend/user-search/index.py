@@ -1,13 +1,80 @@
+import base64
 import json
 import os
-from typing import Dict, Any, List
-import psycopg2
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
 from psycopg2.extras import RealDictCursor
 
+from db import Statement, get_router, primary_connection, run
+from sessions import get_session_token, verify_session
+from instrument import instrumented
+
+MIN_QUERY_LENGTH = 3
+PAGE_DEFAULT = 20
+PAGE_MAX = 50
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '60'))
+
+SEARCH_USERS = Statement('search_users', """
+    WITH ranked AS (
+        SELECT 
+            u.id,
+            u.username,
+            u.full_name,
+            u.avatar_url,
+            CASE
+                WHEN lower(u.username) = lower($1) OR lower(u.full_name) = lower($1) THEN 0
+                WHEN u.username ILIKE $2 OR u.full_name ILIKE $2 THEN 1
+                ELSE 2
+            END as bucket,
+            (greatest(similarity(u.username, $1), similarity(u.full_name, $1)) * 1000)::int as score
+        FROM users u
+        WHERE (u.username ILIKE $3 OR u.full_name ILIKE $3)
+        AND u.id != $4
+    )
+    SELECT 
+        r.*,
+        CASE WHEN c.id IS NOT NULL THEN true ELSE false END as is_contact
+    FROM ranked r
+    LEFT JOIN contacts c ON c.user_id = $4 AND c.contact_user_id = r.id
+    WHERE NOT $5
+       OR (r.bucket, -r.score, r.username, r.id) > ($6, $7, $8, $9)
+    ORDER BY r.bucket, r.score DESC, r.username, r.id
+    LIMIT $10
+""", ('text', 'text', 'text', 'int', 'boolean', 'int', 'int', 'text', 'int', 'int'))
+
+# user_presence is unlogged and only exists on the primary, so the search itself can
+# run on a replica while online flags for the page come from the primary
+ONLINE_USERS = Statement('online_users', """
+    SELECT user_id FROM user_presence WHERE user_id = ANY($1) AND last_active_at > $2
+""", ('int[]', 'timestamp'))
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def encode_cursor(bucket: int, score: int, username: str, user_id: int) -> str:
+    raw = json.dumps([bucket, score, username, user_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Optional[Tuple[int, int, str, int]]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        bucket, score, username, user_id = json.loads(base64.urlsafe_b64decode(padded))
+        return int(bucket), int(score), str(username), int(user_id)
+    except (ValueError, TypeError):
+        return None
+
+@instrumented('user-search')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Search users by username to add as contacts
-    Args: event - dict with httpMethod, queryStringParameters (query, current_user_id)
+    Business: Search users by username or full name to add as contacts
+    Args: event - dict with httpMethod, headers (X-Auth-Token), queryStringParameters (query, limit, cursor)
           context - object with request_id attribute
     Returns: HTTP response with list of matching users
     '''
@@ -19,7 +86,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -43,11 +110,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Search query is required'})
         }
     
-    if not current_user_id:
+    if len(query) < MIN_QUERY_LENGTH:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'current_user_id is required'})
+            'body': json.dumps({'error': f'Search query must be at least {MIN_QUERY_LENGTH} characters'})
+        }
+    
+    try:
+        current_user_id = int(current_user_id) if current_user_id else None
+        limit = min(max(int(params.get('limit', PAGE_DEFAULT)), 1), PAGE_MAX)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'current_user_id and limit must be integers'})
+        }
+    
+    position = decode_cursor(params['cursor']) if params.get('cursor') else None
+    if params.get('cursor') and not position:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid cursor'})
         }
     
     dsn = os.environ.get('DATABASE_URL')
@@ -58,36 +143,72 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Database configuration missing'})
         }
     
-    conn = psycopg2.connect(dsn)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    pattern = '%' + escape_like(query) + '%'
+    prefix = escape_like(query) + '%'
     
-    search_pattern = query.replace("'", "''")
-    
-    cursor.execute(f"""
-        SELECT 
-            u.id,
-            u.username,
-            u.full_name,
-            u.avatar_url,
-            u.online_status,
-            CASE WHEN c.id IS NOT NULL THEN true ELSE false END as is_contact
-        FROM users u
-        LEFT JOIN contacts c ON c.user_id = {current_user_id} AND c.contact_user_id = u.id
-        WHERE u.username ILIKE '%{search_pattern}%'
-        AND u.id != {current_user_id}
-        ORDER BY u.username
-        LIMIT 20
-    """)
+    token = get_session_token(event)
     
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with get_router(dsn).connection(True, token, get_header(event, 'X-Min-LSN')) as conn:
+        auth_user_id = verify_session(conn, token)
+        
+        if auth_user_id is None:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or missing session token'})
+            }
+        
+        if current_user_id is not None and current_user_id != auth_user_id:
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'current_user_id does not match the session user'})
+            }
+        
+        current_user_id = auth_user_id
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        run(cursor, SEARCH_USERS, (
+            query,
+            prefix,
+            pattern,
+            current_user_id,
+            position is not None,
+            position[0] if position else 0,
+            -position[1] if position else 0,
+            position[2] if position else '',
+            position[3] if position else 0,
+            limit + 1
+        ))
+        
+        users = cursor.fetchall()
+        cursor.close()
+        
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            edge = users[-1]
+            next_cursor = encode_cursor(edge['bucket'], edge['score'], edge['username'], edge['id'])
+        
+        online = set()
+        if users:
+            with primary_connection(conn) as primary:
+                cursor = primary.cursor()
+                run(cursor, ONLINE_USERS, ([user['id'] for user in users], datetime.utcnow() - timedelta(seconds=PRESENCE_TTL)))
+                online = {row[0] for row in cursor.fetchall()}
+                cursor.close()
     
-    users_list = [dict(user) for user in users]
+    users_list = []
+    for user in users:
+        user_data = dict(user)
+        del user_data['bucket']
+        del user_data['score']
+        user_data['online_status'] = user['id'] in online
+        users_list.append(user_data)
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
         'isBase64Encoded': False,
-        'body': json.dumps({'users': users_list})
+        'body': json.dumps({'users': users_list, 'next_cursor': next_cursor})
     }
@@ -0,0 +1,192 @@
+'''
+Measures cold-start cost of each backend function: a fresh interpreter imports
+index.py and serves one request. Each request kind gets its own interpreter, so
+first_get and first_post are what an instance pays when that is its first request,
+including validator builds and the first database connection. Also reports the
+slowest imports from python -X importtime so regressions can be traced to a module.
+
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/coldstart.py --runs 15 --output coldstart.json
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/coldstart.py --runs 15 --compare coldstart.json
+
+The GET and POST probes need the database seeded by benchmarks/seed.py; they are
+chosen to pass authentication and validation without writing rows. Without
+DATABASE_URL only import and OPTIONS are measured.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from handlers import BACKEND_DIR, FUNCTIONS, ROOT
+from seed import session_token
+
+PROBE_USER_ID = 1
+
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, {function_dir!r})
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+response = index.handler(json.loads({event!r}), None)
+served = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'request_ms': (served - started) * 1000,
+    'status': response.get('statusCode'),
+}}))
+'''
+
+def authed(method: str, query: Optional[Dict[str, str]] = None, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        'httpMethod': method,
+        'headers': {'X-Auth-Token': session_token(PROBE_USER_ID)},
+        'queryStringParameters': query or {},
+        'body': json.dumps(body) if body is not None else '',
+    }
+
+# The first GET and POST each function typically serves. POST bodies go through
+# model validation and are refused before any write, so repeated runs add no rows.
+PROBES: Dict[str, Dict[str, Dict[str, Any]]] = {
+    'messenger-api': {
+        'get': authed('GET', {'action': 'list_chats'}),
+        'post': authed('POST', body={'action': 'send_message', 'chat_id': 1, 'content': ''}),
+    },
+    'auth-login': {
+        'post': {'httpMethod': 'POST', 'headers': {}, 'body': json.dumps({'username': 'bench_user_1', 'password': 'not-the-password'})},
+    },
+    'auth-register': {
+        'post': {'httpMethod': 'POST', 'headers': {}, 'body': json.dumps({
+            'username': 'bench_user_1', 'email': 'bench_user_1@example.com', 'password': 'short', 'full_name': 'Bench'
+        })},
+    },
+    'user-search': {
+        'get': authed('GET', {'query': 'bench_user_1'}),
+    },
+    'contact-add': {
+        'post': authed('POST', body={'user_id': PROBE_USER_ID, 'contact_user_id': PROBE_USER_ID}),
+    },
+    'media-upload': {
+        'get': authed('GET', {'action': 'upload_status', 'upload_id': 'missing'}),
+        'post': authed('POST', body={'action': 'init_upload', 'file_name': 'probe.bin', 'file_size': 0}),
+    },
+}
+
+OPTIONS_EVENT = {'httpMethod': 'OPTIONS', 'headers': {}}
+
+REQUEST_KINDS = ('options', 'get', 'post')
+
+def probe_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env.pop('PREWARM_ON_IMPORT', None)
+    return env
+
+def run_probe(function_name: str, event: Dict[str, Any]) -> Dict[str, float]:
+    code = PROBE.format(function_dir=os.path.join(BACKEND_DIR, function_name), event=json.dumps(event))
+    output = subprocess.check_output([sys.executable, '-c', code], env=probe_env(), cwd=ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def import_profile(function_name: str, top: int) -> List[Dict[str, Any]]:
+    code = f"import sys; sys.path.insert(0, {os.path.join(BACKEND_DIR, function_name)!r}); import index"
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=probe_env(), cwd=ROOT, capture_output=True, check=True
+    )
+    modules = []
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        # depth 0 is index itself, depth 1 are the modules it imports directly
+        if depth <= 1:
+            modules.append({
+                'module': name.strip(),
+                'self_ms': round(int(self_us) / 1000, 2),
+                'cumulative_ms': round(int(cumulative_us) / 1000, 2),
+            })
+    modules.sort(key=lambda module: module['cumulative_ms'], reverse=True)
+    return modules[:top]
+
+def measure(function_name: str, runs: int, top: int, with_database: bool) -> Dict[str, Any]:
+    events = {'options': OPTIONS_EVENT}
+    if with_database:
+        events.update(PROBES.get(function_name, {}))
+
+    result: Dict[str, Any] = {'runs': runs}
+    for kind, event in events.items():
+        run_probe(function_name, event)
+        samples = [run_probe(function_name, event) for _ in range(runs)]
+        if kind == 'options':
+            imports = sorted(sample['import_ms'] for sample in samples)
+            result['import_ms_median'] = round(statistics.median(imports), 2)
+            result['import_ms_min'] = round(imports[0], 2)
+            result['import_ms_max'] = round(imports[-1], 2)
+        result[f'first_{kind}_ms_median'] = round(statistics.median(sample['request_ms'] for sample in samples), 2)
+        result[f'first_{kind}_status'] = samples[-1]['status']
+    result['top_imports'] = import_profile(function_name, top)
+    return result
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Measure cold-start import time of the backend functions')
+    parser.add_argument('--functions', default=','.join(FUNCTIONS))
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=8, help='slowest direct imports to report per function')
+    parser.add_argument('--output', help='write results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    args = parser.parse_args()
+
+    with_database = bool(os.environ.get('DATABASE_URL'))
+    if not with_database:
+        print('DATABASE_URL is not set: measuring import and OPTIONS only', file=sys.stderr)
+
+    results = {}
+    for function_name in args.functions.split(','):
+        results[function_name] = measure(function_name, args.runs, args.top, with_database)
+        stats = results[function_name]
+        line = f"{function_name:<16} import {stats['import_ms_median']:>8.1f} ms"
+        for kind in REQUEST_KINDS:
+            if f'first_{kind}_ms_median' in stats:
+                line += f"   first {kind} {stats[f'first_{kind}_ms_median']:>7.1f} ms ({stats[f'first_{kind}_status']})"
+        print(line)
+        for module in stats['top_imports']:
+            print(f"    {module['module']:<40}{module['cumulative_ms']:>9.2f} ms  (self {module['self_ms']:.2f})")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat() + 'Z',
+                'git_commit': git_commit(),
+                'python': sys.version.split()[0],
+                'functions': results,
+            }, output, indent=2)
+        print(f'baseline written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['functions']
+        print(f"\n{'function':<16}{'request':<10}{'baseline':>12}{'current':>12}{'delta':>10}")
+        for function_name, stats in results.items():
+            for kind in REQUEST_KINDS:
+                key = f'first_{kind}_ms_median'
+                if key not in stats or key not in baseline.get(function_name, {}):
+                    continue
+                before = baseline[function_name][key]
+                after = stats[key]
+                print(f'{function_name:<16}{kind:<10}{before:>10.1f}ms{after:>10.1f}ms{(after - before) / before * 100:>+9.1f}%')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
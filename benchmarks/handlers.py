@@ -0,0 +1,38 @@
+'''
+Loads the backend functions in-process so they can be driven without the platform.
+Helper modules shipped with every function (db.py, sessions.py, ...) are identical
+copies, so whichever copy is imported first is shared by all loaded handlers.
+'''
+import importlib.util
+import os
+import sys
+import uuid
+from types import ModuleType, SimpleNamespace
+from typing import Any, Callable, Dict, Iterable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+
+FUNCTIONS = ('messenger-api', 'auth-login', 'auth-register', 'user-search', 'contact-add', 'media-upload')
+
+Handler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+def load_module(function_name: str) -> ModuleType:
+    function_dir = os.path.join(BACKEND_DIR, function_name)
+    module_name = 'bench_' + function_name.replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(function_dir, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Stays on sys.path: handlers import some helpers (models, storage) lazily on first use
+    if function_dir not in sys.path:
+        sys.path.append(function_dir)
+    spec.loader.exec_module(module)
+    sys.modules[module_name] = module
+    return module
+
+def load_handlers(function_names: Iterable[str] = FUNCTIONS) -> Dict[str, Handler]:
+    return {name: load_module(name).handler for name in function_names}
+
+def make_context(function_name: str) -> Any:
+    return SimpleNamespace(request_id=uuid.uuid4().hex, function_name=function_name)
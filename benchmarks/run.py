@@ -0,0 +1,379 @@
+'''
+Drives the backend handlers in-process with concurrent workers against a seeded database.
+
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/run.py --duration 30 --output baseline.json
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/run.py --duration 30 --compare baseline.json
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/run.py --server http://127.0.0.1:8000
+
+Reports throughput and p50/p95/p99 latency per action, and requests per CPU-second
+of the process running the handlers: this one in-process, or the server/asgi.py
+process with --server (run it with --workers 1 so its stats cover every request).
+With --compare it exits with status 1 when any action regresses by more than
+--threshold percent.
+'''
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import psycopg2
+
+import handlers
+from seed import BENCH_PASSWORD, session_token
+
+DEFAULT_MIX = 'list_chats=30,list_messages=30,send_message=15,user_search=15,login=10'
+
+Event = Tuple[str, Dict[str, Any]]
+
+def parse_mix(spec: str) -> List[Tuple[str, int]]:
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ACTIONS:
+            raise ValueError(f'Unknown action in mix: {name.strip()}')
+        mix.append((name.strip(), int(weight or '1')))
+    return mix
+
+def load_memberships(dsn: str) -> Dict[int, List[int]]:
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT cm.user_id, array_agg(cm.chat_id ORDER BY cm.chat_id)
+        FROM chat_members cm
+        JOIN users u ON u.id = cm.user_id
+        WHERE u.username LIKE 'bench\\_user\\_%'
+        GROUP BY cm.user_id
+    """)
+    memberships = {row[0]: row[1] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return memberships
+
+def auth_headers(user_id: int) -> Dict[str, str]:
+    return {'X-Auth-Token': session_token(user_id)}
+
+def list_chats_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    user_id = rng.choice(user_ids)
+    return 'messenger-api', {
+        'httpMethod': 'GET',
+        'headers': auth_headers(user_id),
+        'queryStringParameters': {'action': 'list_chats', 'user_id': str(user_id)},
+    }
+
+def list_messages_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    user_id = rng.choice(user_ids)
+    return 'messenger-api', {
+        'httpMethod': 'GET',
+        'headers': auth_headers(user_id),
+        'queryStringParameters': {
+            'action': 'list_messages',
+            'chat_id': str(rng.choice(memberships[user_id])),
+            'user_id': str(user_id),
+        },
+    }
+
+def list_messages_compact_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    function_name, event = list_messages_event(rng, memberships, user_ids)
+    event['queryStringParameters']['compact'] = '1'
+    return function_name, event
+
+def send_message_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    user_id = rng.choice(user_ids)
+    return 'messenger-api', {
+        'httpMethod': 'POST',
+        'headers': auth_headers(user_id),
+        'body': json.dumps({
+            'action': 'send_message',
+            'chat_id': rng.choice(memberships[user_id]),
+            'sender_id': user_id,
+            'content': f'benchmark message {rng.randrange(1 << 30)}',
+        }),
+    }
+
+def user_search_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    user_id = rng.choice(user_ids)
+    return 'user-search', {
+        'httpMethod': 'GET',
+        'headers': auth_headers(user_id),
+        'queryStringParameters': {'query': f'bench_user_{rng.randint(1, 99)}'},
+    }
+
+def login_event(rng: random.Random, memberships: Dict[int, List[int]], user_ids: List[int]) -> Event:
+    return 'auth-login', {
+        'httpMethod': 'POST',
+        'headers': {},
+        'body': json.dumps({
+            'username': f'bench_user_{rng.randint(1, len(user_ids))}',
+            'password': BENCH_PASSWORD,
+        }),
+    }
+
+ACTIONS: Dict[str, Callable[[random.Random, Dict[int, List[int]], List[int]], Event]] = {
+    'list_chats': list_chats_event,
+    'list_messages': list_messages_event,
+    'list_messages_compact': list_messages_compact_event,
+    'send_message': send_message_event,
+    'user_search': user_search_event,
+    'login': login_event,
+}
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, action: str, elapsed: float, status: int) -> None:
+        with self._lock:
+            self.latencies.setdefault(action, []).append(elapsed)
+            statuses = self.statuses.setdefault(action, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            if status >= 400:
+                self.errors[action] = self.errors.get(action, 0) + 1
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def summarize(recorder: Recorder, wall_seconds: float) -> Dict[str, Dict[str, Any]]:
+    summary = {}
+    for action, values in sorted(recorder.latencies.items()):
+        ordered = sorted(values)
+        summary[action] = {
+            'count': len(ordered),
+            'errors': recorder.errors.get(action, 0),
+            'statuses': {str(code): count for code, count in sorted(recorder.statuses[action].items())},
+            'throughput_rps': round(len(ordered) / wall_seconds, 2),
+            'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        }
+    return summary
+
+Invoke = Callable[[str, Dict[str, Any]], int]
+
+def in_process_invoker(loaded: Dict[str, handlers.Handler]) -> Invoke:
+    def invoke(function_name: str, event: Dict[str, Any]) -> int:
+        response = loaded[function_name](event, handlers.make_context(function_name))
+        return response.get('statusCode', 500)
+    return invoke
+
+def http_invoker(base_url: str) -> Invoke:
+    target = urlsplit(base_url)
+    local = threading.local()
+
+    def invoke(function_name: str, event: Dict[str, Any]) -> int:
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        path = f"{target.path.rstrip('/')}/{function_name}"
+        if event.get('queryStringParameters'):
+            path += '?' + urlencode(event['queryStringParameters'])
+        headers = {'Content-Type': 'application/json', **(event.get('headers') or {})}
+        try:
+            connection.request(event['httpMethod'], path, body=event.get('body'), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            local.connection = None
+            raise
+    return invoke
+
+def server_stats(base_url: str) -> Dict[str, Any]:
+    target = urlsplit(base_url)
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=10)
+    connection.request('GET', f"{target.path.rstrip('/')}/_server/stats")
+    stats = json.loads(connection.getresponse().read())
+    connection.close()
+    return stats
+
+def worker(worker_id: int, args, invoke: Invoke, memberships, user_ids, mix, deadline: Optional[float], budget: Dict[str, int], budget_lock, recorder: Recorder) -> None:
+    rng = random.Random(args.seed * 1000 + worker_id)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    while True:
+        if deadline is not None and time.perf_counter() >= deadline:
+            return
+        if deadline is None:
+            with budget_lock:
+                if budget['remaining'] <= 0:
+                    return
+                budget['remaining'] -= 1
+
+        action = rng.choices(names, weights)[0]
+        function_name, event = ACTIONS[action](rng, memberships, user_ids)
+        started = time.perf_counter()
+        try:
+            status = invoke(function_name, event)
+        except Exception:
+            status = 599
+        recorder.add(action, time.perf_counter() - started, status)
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=handlers.ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(summary: Dict[str, Dict[str, Any]], baseline_path: str, threshold: float, per_cpu_second: float) -> bool:
+    with open(baseline_path) as baseline_file:
+        document = json.load(baseline_file)
+    baseline = document['actions']
+
+    regressed = False
+    print(f"\n{'action':<16}{'metric':<16}{'baseline':>12}{'current':>12}{'delta':>10}")
+    for action, current in summary.items():
+        previous = baseline.get(action)
+        if not previous:
+            continue
+        for metric, higher_is_better in (('throughput_rps', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)):
+            before, after = previous[metric], current[metric]
+            delta = (after - before) / before * 100 if before else 0.0
+            worse = -delta if higher_is_better else delta
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f'{action:<16}{metric:<16}{before:>12.3f}{after:>12.3f}{delta:>+9.1f}%{flag}')
+    # Reported, not gated: baselines may come from the other mode
+    before = document.get('requests_per_cpu_second')
+    if before:
+        mode = document.get('params', {}).get('mode', 'in-process')
+        print(f"{'all':<16}{'req/cpu-second':<16}{before:>12.1f}{per_cpu_second:>12.1f}{(per_cpu_second - before) / before * 100:>+9.1f}%  (baseline {mode})")
+    return regressed
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Run the in-process handler benchmark')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run (ignored when --requests is set)')
+    parser.add_argument('--requests', type=int, default=0, help='total requests to send instead of a fixed duration')
+    parser.add_argument('--warmup', type=int, default=50, help='requests sent before measuring')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='comma separated action=weight pairs')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed regression in percent')
+    parser.add_argument('--server', help='base URL of a running server/asgi.py to drive over HTTP instead of in-process')
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.workers))
+
+    mix = parse_mix(args.mix)
+    memberships = load_memberships(dsn)
+    if not memberships:
+        print('No seeded users found, run benchmarks/seed.py first', file=sys.stderr)
+        return 2
+    user_ids = sorted(memberships)
+    if args.server:
+        invoke = http_invoker(args.server)
+    else:
+        invoke = in_process_invoker(handlers.load_handlers(('messenger-api', 'user-search', 'auth-login')))
+    budget_lock = threading.Lock()
+
+    warmup = Recorder()
+    worker(0, args, invoke, memberships, user_ids, mix, None, {'remaining': args.warmup}, budget_lock, warmup)
+
+    recorder = Recorder()
+    budget = {'remaining': args.requests}
+    server_before = server_stats(args.server) if args.server else None
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    deadline = None if args.requests else started + args.duration
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(worker, index + 1, args, invoke, memberships, user_ids, mix, deadline, budget, budget_lock, recorder)
+            for index in range(args.workers)
+        ]
+        for future in futures:
+            future.result()
+    wall_seconds = time.perf_counter() - started
+    client_cpu_seconds = time.process_time() - cpu_started
+    if args.server:
+        server_after = server_stats(args.server)
+        cpu_seconds = server_after['cpu_seconds'] - server_before['cpu_seconds']
+    else:
+        cpu_seconds = client_cpu_seconds
+
+    summary = summarize(recorder, wall_seconds)
+    total = sum(action['count'] for action in summary.values())
+    print(f"{'action':<16}{'count':>8}{'errors':>8}{'rps':>10}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for action, stats in summary.items():
+        print(
+            f"{action:<16}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_rps']:>10.1f}"
+            f"{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        )
+    print(f'total {total} requests in {wall_seconds:.1f}s ({total / wall_seconds:.1f} rps)')
+    # Requests per CPU-second of the handler process is throughput per fully used core
+    per_cpu_second = total / cpu_seconds if cpu_seconds > 0 else 0.0
+    print(
+        f"{'server' if args.server else 'in-process'}: {cpu_seconds:.2f} CPU-seconds, "
+        f"{per_cpu_second:.1f} requests per CPU-second (load generator used {client_cpu_seconds:.2f})"
+    )
+
+    # The handlers share one copy of db.py, so its router counters cover every function
+    routing = sys.modules['db'].router_stats() if os.environ.get('DATABASE_REPLICA_URLS') else {}
+    for router in routing.values():
+        print(
+            f"routing: {router['replica_reads']} replica reads, {router['primary_reads']} primary reads, "
+            f"{router['lag_fallbacks']} lag fallbacks, {router['error_fallbacks']} error fallbacks, "
+            f"{router['primary_writes']} primary writes"
+        )
+    membership = sys.modules['members'].membership_cache.snapshot() if 'members' in sys.modules else {}
+    if membership:
+        print(
+            f"membership cache: {membership['hit_rate']:.1%} hit rate, {membership['chats']} chats cached, "
+            f"{membership['loads']} loads, {membership['invalidations']} invalidations"
+        )
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat() + 'Z',
+                'git_commit': git_commit(),
+                'params': {
+                    'mode': 'server' if args.server else 'in-process',
+                    'workers': args.workers,
+                    'duration': args.duration,
+                    'requests': args.requests,
+                    'mix': args.mix,
+                    'seed': args.seed,
+                },
+                'wall_seconds': round(wall_seconds, 3),
+                'total_requests': total,
+                'cpu_seconds': round(cpu_seconds, 3),
+                'requests_per_cpu_second': round(per_cpu_second, 2),
+                'actions': summary,
+                'routing': routing,
+                'membership_cache': membership,
+            }, output, indent=2)
+        print(f'baseline written to {args.output}')
+
+    if args.compare and compare(summary, args.compare, args.threshold, per_cpu_second):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
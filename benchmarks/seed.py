@@ -0,0 +1,206 @@
+'''
+Seeds a local PostgreSQL database with a synthetic messenger dataset.
+
+    DATABASE_URL=postgresql://localhost/messenger_bench python benchmarks/seed.py --migrate --reset
+
+Every seeded user can log in with BENCH_PASSWORD and owns the session token
+bench-token-<user_id>, so the load generator can call authenticated actions.
+'''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS_DIR = os.path.join(ROOT, 'db_migrations')
+
+BENCH_PASSWORD = 'bench-password'
+BENCH_SALT = 'benchsalt'
+MESSAGE_SPACING_SECONDS = 37
+
+def session_token(user_id: int) -> str:
+    return f'bench-token-{user_id}'
+
+def password_hash(password: str) -> str:
+    return f"{BENCH_SALT}${hashlib.sha256((password + BENCH_SALT).encode()).hexdigest()}"
+
+def apply_migrations(conn) -> None:
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+        with open(path) as migration:
+            sql = migration.read()
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        cursor.close()
+        conn.commit()
+        print(f'applied {os.path.basename(path)}')
+
+def reset(conn) -> None:
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT string_agg(quote_ident(tablename), ', ')
+        FROM pg_tables
+        WHERE schemaname = current_schema()
+          AND tablename IN ('users', 'sessions', 'contacts', 'chats', 'chat_members', 'messages')
+    """)
+    tables = cursor.fetchone()[0]
+    if tables:
+        cursor.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+    conn.commit()
+    cursor.close()
+
+def zipf_counts(total: int, buckets: int, exponent: float, rng: random.Random) -> List[int]:
+    weights = [1.0 / (rank ** exponent) for rank in range(1, buckets + 1)]
+    rng.shuffle(weights)
+    scale = total / sum(weights)
+    return [int(weight * scale) for weight in weights]
+
+def seed(conn, args) -> Dict[str, int]:
+    rng = random.Random(args.seed)
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        INSERT INTO users (username, email, password_hash, full_name, last_seen)
+        SELECT 'bench_user_' || g, 'bench_user_' || g || '@example.com', %s, 'Bench User ' || g, CURRENT_TIMESTAMP
+        FROM generate_series(1, %s) g
+        RETURNING id
+    """, (password_hash(BENCH_PASSWORD), args.users))
+    user_ids = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute("""
+        INSERT INTO sessions (user_id, session_token, expires_at)
+        SELECT id, 'bench-token-' || id, CURRENT_TIMESTAMP + INTERVAL '30 days'
+        FROM unnest(%s::int[]) AS id
+    """, (user_ids,))
+
+    contact_pairs = set()
+    for user_id in user_ids:
+        for contact_id in rng.sample(user_ids, min(args.contacts_per_user + 1, len(user_ids))):
+            if contact_id != user_id:
+                contact_pairs.add((user_id, contact_id))
+    contact_pairs = sorted(contact_pairs)
+    cursor.execute("""
+        INSERT INTO contacts (user_id, contact_user_id)
+        SELECT * FROM unnest(%s::int[], %s::int[])
+        ON CONFLICT DO NOTHING
+    """, ([pair[0] for pair in contact_pairs], [pair[1] for pair in contact_pairs]))
+
+    chats: List[List[int]] = []
+    for _ in range(args.direct_chats):
+        chats.append(rng.sample(user_ids, 2))
+    for _ in range(args.groups):
+        chats.append(rng.sample(user_ids, min(args.group_size, len(user_ids))))
+
+    chat_ids = []
+    for index, members in enumerate(chats):
+        chat_type = 'direct' if len(members) == 2 and index < args.direct_chats else 'group'
+        cursor.execute("""
+            INSERT INTO chats (type, name, created_by)
+            VALUES (%s, %s, %s)
+            RETURNING id
+        """, (chat_type, None if chat_type == 'direct' else f'Bench group {index}', members[0]))
+        chat_id = cursor.fetchone()[0]
+        chat_ids.append(chat_id)
+        cursor.execute("""
+            INSERT INTO chat_members (chat_id, user_id, role)
+            SELECT %s, member_id, CASE WHEN ordinality = 1 THEN 'owner' ELSE 'member' END
+            FROM unnest(%s::int[]) WITH ORDINALITY AS m(member_id, ordinality)
+        """, (chat_id, members))
+
+    counts = zipf_counts(args.messages, len(chat_ids), args.skew, rng)
+
+    cursor.execute("SELECT to_regproc('create_messages_partition') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute("""
+            SELECT create_messages_partition(month::date)
+            FROM generate_series(
+                date_trunc('month', CURRENT_TIMESTAMP - make_interval(secs => %s * %s)),
+                date_trunc('month', CURRENT_TIMESTAMP),
+                INTERVAL '1 month'
+            ) month
+        """, (max(counts), MESSAGE_SPACING_SECONDS))
+        conn.commit()
+
+    for chat_id, members, count in zip(chat_ids, chats, counts):
+        if count == 0:
+            continue
+        cursor.execute("""
+            INSERT INTO messages (chat_id, sender_id, message_type, content, created_at)
+            SELECT %s, (%s::int[])[1 + (g %% %s)], 'text', 'bench message ' || g,
+                   CURRENT_TIMESTAMP - make_interval(secs => (%s - g) * %s)
+            FROM generate_series(1, %s) g
+        """, (chat_id, members, len(members), count, MESSAGE_SPACING_SECONDS, count))
+        conn.commit()
+
+    cursor.execute("""
+        UPDATE chats c
+        SET updated_at = lm.created_at,
+            last_message_id = lm.id,
+            last_message_sender_id = lm.sender_id,
+            last_message_type = lm.message_type,
+            last_message_preview = left(lm.content, 200),
+            last_message_at = lm.created_at
+        FROM (
+          SELECT DISTINCT ON (chat_id) id, chat_id, sender_id, message_type, content, created_at
+          FROM messages
+          ORDER BY chat_id, created_at DESC, id DESC
+        ) lm
+        WHERE lm.chat_id = c.id
+    """)
+    cursor.execute("""
+        UPDATE chat_members cm
+        SET last_read_message_id = c.last_message_id
+        FROM chats c
+        WHERE c.id = cm.chat_id
+    """)
+    conn.commit()
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.close()
+
+    return {
+        'users': len(user_ids),
+        'contacts': len(contact_pairs),
+        'chats': len(chat_ids),
+        'messages': sum(counts),
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Seed a local database for handler benchmarks')
+    parser.add_argument('--migrate', action='store_true', help='apply db_migrations/*.sql first (fresh database only)')
+    parser.add_argument('--reset', action='store_true', help='truncate messenger tables before seeding')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--contacts-per-user', type=int, default=20)
+    parser.add_argument('--direct-chats', type=int, default=3000)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--group-size', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=500000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of messages per chat')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+
+    conn = psycopg2.connect(dsn)
+    started = time.perf_counter()
+    if args.migrate:
+        apply_migrations(conn)
+    if args.reset:
+        reset(conn)
+    totals = seed(conn, args)
+    conn.close()
+
+    print(json.dumps({**totals, 'seconds': round(time.perf_counter() - started, 1)}))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
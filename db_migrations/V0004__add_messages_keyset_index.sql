@@ -0,0 +1,5 @@
+-- Composite index for keyset (cursor) pagination in list_messages
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at DESC, id DESC);
+
+-- The composite index has chat_id as its leading column and replaces this one
+DROP INDEX IF EXISTS idx_messages_chat_id;
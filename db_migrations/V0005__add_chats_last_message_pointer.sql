@@ -0,0 +1,21 @@
+-- Denormalized pointer to the latest message of each chat, maintained by send_message.
+-- No foreign key on purpose: it is a cache and must not block message archival.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_sender_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_type VARCHAR(20);
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_preview VARCHAR(200);
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+
+-- Backfill from existing history
+UPDATE chats c
+SET last_message_id = lm.id,
+    last_message_sender_id = lm.sender_id,
+    last_message_type = lm.message_type,
+    last_message_preview = left(lm.content, 200),
+    last_message_at = lm.created_at
+FROM (
+  SELECT DISTINCT ON (chat_id) id, chat_id, sender_id, message_type, content, created_at
+  FROM messages
+  ORDER BY chat_id, created_at DESC, id DESC
+) lm
+WHERE lm.chat_id = c.id;
@@ -0,0 +1,2 @@
+-- Supports the sync action: new messages per chat above a message id watermark
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
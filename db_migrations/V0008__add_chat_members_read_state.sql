@@ -0,0 +1,9 @@
+-- Per-member read cursor and maintained unread counter
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER;
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0;
+
+-- Existing history is treated as already read
+UPDATE chat_members cm
+SET last_read_message_id = c.last_message_id
+FROM chats c
+WHERE c.id = cm.chat_id AND c.last_message_id IS NOT NULL;
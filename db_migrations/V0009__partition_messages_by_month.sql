@@ -0,0 +1,138 @@
+-- Convert messages into a table range-partitioned by month on created_at.
+-- The primary key has to include the partition key, so it becomes (id, created_at).
+-- Nothing references messages(id) with a foreign key, so the swap is local to this table.
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+  id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+  chat_id INTEGER NOT NULL REFERENCES chats(id),
+  sender_id INTEGER NOT NULL REFERENCES users(id),
+  message_type VARCHAR(20) DEFAULT 'text' CHECK (message_type IN ('text', 'image', 'video', 'audio', 'file')),
+  content TEXT,
+  media_url TEXT,
+  file_name TEXT,
+  file_size BIGINT,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Safety net for rows outside every monthly range; should stay empty
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_messages_partition(month_start DATE) RETURNS TEXT AS $$
+DECLARE
+  start_at DATE := date_trunc('month', month_start)::date;
+  partition_name TEXT := 'messages_' || to_char(start_at, 'YYYY_MM');
+BEGIN
+  IF to_regclass(partition_name) IS NULL THEN
+    EXECUTE format(
+      'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+      partition_name, start_at, (start_at + INTERVAL '1 month')::date
+    );
+  END IF;
+  RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the current month and the next months_ahead months if they are missing.
+-- Only catalog lookups when nothing is missing, so it is cheap to call often.
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(months_ahead INTEGER DEFAULT 2) RETURNS INTEGER AS $$
+DECLARE
+  created INTEGER := 0;
+  month_start DATE;
+BEGIN
+  FOR i IN 0..months_ahead LOOP
+    month_start := (date_trunc('month', CURRENT_TIMESTAMP) + make_interval(months => i))::date;
+    IF to_regclass('messages_' || to_char(month_start, 'YYYY_MM')) IS NULL THEN
+      PERFORM create_messages_partition(month_start);
+      created := created + 1;
+    END IF;
+  END LOOP;
+  RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Partitions for existing history, then the current and upcoming months
+DO $$
+DECLARE
+  month_start DATE;
+BEGIN
+  SELECT date_trunc('month', min(created_at))::date INTO month_start FROM messages_unpartitioned;
+  WHILE month_start IS NOT NULL AND month_start < date_trunc('month', CURRENT_TIMESTAMP) LOOP
+    PERFORM create_messages_partition(month_start);
+    month_start := (month_start + INTERVAL '1 month')::date;
+  END LOOP;
+  PERFORM ensure_messages_partitions(2);
+END $$;
+
+INSERT INTO messages (id, chat_id, sender_id, message_type, content, media_url, file_name, file_size, created_at)
+SELECT id, chat_id, sender_id, message_type, content, media_url, file_name, file_size, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+
+-- Indexes are declared on the parent and cascade to every partition
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages(sender_id);
+
+-- Cold tier: one compressed JSONB document per chat and month
+CREATE TABLE IF NOT EXISTS messages_archive (
+  chat_id INTEGER NOT NULL,
+  month DATE NOT NULL,
+  first_message_id INTEGER NOT NULL,
+  last_message_id INTEGER NOT NULL,
+  message_count INTEGER NOT NULL,
+  messages JSONB NOT NULL,
+  archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (chat_id, month)
+);
+
+DO $$
+BEGIN
+  ALTER TABLE messages_archive ALTER COLUMN messages SET COMPRESSION lz4;
+EXCEPTION WHEN OTHERS THEN
+  RAISE NOTICE 'lz4 compression unavailable, messages_archive keeps default pglz TOAST compression';
+END $$;
+
+-- Detaches a past month, folds it into messages_archive and drops the partition
+CREATE OR REPLACE FUNCTION archive_messages_partition(month_start DATE) RETURNS INTEGER AS $$
+DECLARE
+  start_at DATE := date_trunc('month', month_start)::date;
+  partition_name TEXT := 'messages_' || to_char(start_at, 'YYYY_MM');
+  archived INTEGER;
+BEGIN
+  IF start_at >= date_trunc('month', CURRENT_TIMESTAMP) THEN
+    RAISE EXCEPTION 'Only past months can be archived, got %', start_at;
+  END IF;
+  IF to_regclass(partition_name) IS NULL THEN
+    RETURN 0;
+  END IF;
+
+  EXECUTE format('ALTER TABLE messages DETACH PARTITION %I', partition_name);
+  EXECUTE format(
+    'INSERT INTO messages_archive (chat_id, month, first_message_id, last_message_id, message_count, messages)
+     SELECT p.chat_id, %L, min(p.id), max(p.id), count(*), jsonb_agg(to_jsonb(p) - ''chat_id'' ORDER BY p.created_at, p.id)
+     FROM %I p
+     GROUP BY p.chat_id',
+    start_at, partition_name
+  );
+  GET DIAGNOSTICS archived = ROW_COUNT;
+  EXECUTE format('DROP TABLE %I', partition_name);
+  RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Schedule partition creation in the database when pg_cron is installed;
+-- messenger-api also calls ensure_messages_partitions() once a day per instance.
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_cron') THEN
+    PERFORM cron.schedule('ensure-messages-partitions', '0 3 * * *', 'SELECT ensure_messages_partitions(2)');
+  END IF;
+END $$;
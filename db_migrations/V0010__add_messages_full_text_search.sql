@@ -0,0 +1,37 @@
+-- Full-text search over message content.
+-- The 'russian' configuration stems Cyrillic words with the Russian Snowball stemmer
+-- and Latin words with the English one, so one vector covers both languages.
+-- Adding a stored generated column rewrites every partition; run it in a quiet window.
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+  GENERATED ALWAYS AS (to_tsvector('russian'::regconfig, coalesce(content, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING GIN (search_vector);
+
+-- The archive keeps message fields only; the vector can be rebuilt from content
+CREATE OR REPLACE FUNCTION archive_messages_partition(month_start DATE) RETURNS INTEGER AS $$
+DECLARE
+  start_at DATE := date_trunc('month', month_start)::date;
+  partition_name TEXT := 'messages_' || to_char(start_at, 'YYYY_MM');
+  archived INTEGER;
+BEGIN
+  IF start_at >= date_trunc('month', CURRENT_TIMESTAMP) THEN
+    RAISE EXCEPTION 'Only past months can be archived, got %', start_at;
+  END IF;
+  IF to_regclass(partition_name) IS NULL THEN
+    RETURN 0;
+  END IF;
+
+  EXECUTE format('ALTER TABLE messages DETACH PARTITION %I', partition_name);
+  EXECUTE format(
+    'INSERT INTO messages_archive (chat_id, month, first_message_id, last_message_id, message_count, messages)
+     SELECT p.chat_id, %L, min(p.id), max(p.id), count(*), jsonb_agg(to_jsonb(p) - ''chat_id'' - ''search_vector'' ORDER BY p.created_at, p.id)
+     FROM %I p
+     GROUP BY p.chat_id',
+    start_at, partition_name
+  );
+  GET DIAGNOSTICS archived = ROW_COUNT;
+  EXECUTE format('DROP TABLE %I', partition_name);
+  RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,57 @@
+-- Heartbeat presence kept out of the hot users table.
+-- UNLOGGED: no WAL per heartbeat; the table is emptied after a crash and is not
+-- replicated, so presence is always read from the primary.
+CREATE UNLOGGED TABLE IF NOT EXISTS user_presence (
+  user_id INTEGER PRIMARY KEY,
+  last_active_at TIMESTAMP NOT NULL,
+  flushed_at TIMESTAMP,
+  flushed_online BOOLEAN NOT NULL DEFAULT false
+) WITH (fillfactor = 70);
+
+-- online_status used to be set on login and never cleared
+UPDATE users SET online_status = false WHERE online_status;
+
+-- Copies presence into users.last_seen / online_status. A user row is written only
+-- when the online flag flips or last_seen has moved by at least ttl_seconds, so
+-- heartbeats are coalesced into at most one users UPDATE per TTL per active user.
+CREATE OR REPLACE FUNCTION flush_user_presence(ttl_seconds INTEGER DEFAULT 60) RETURNS INTEGER AS $$
+DECLARE
+  online_after TIMESTAMP := CURRENT_TIMESTAMP - make_interval(secs => ttl_seconds);
+  flushed INTEGER;
+BEGIN
+  IF NOT pg_try_advisory_xact_lock(hashtext('flush_user_presence')) THEN
+    RETURN 0;
+  END IF;
+
+  WITH changed AS (
+    UPDATE user_presence p
+    SET flushed_at = p.last_active_at,
+        flushed_online = p.last_active_at > online_after
+    WHERE p.flushed_online <> (p.last_active_at > online_after)
+       OR p.flushed_at IS NULL
+       OR p.last_active_at >= p.flushed_at + make_interval(secs => ttl_seconds)
+    RETURNING p.user_id, p.last_active_at, p.flushed_online
+  )
+  UPDATE users u
+  SET last_seen = c.last_active_at,
+      online_status = c.flushed_online
+  FROM changed c
+  WHERE u.id = c.user_id;
+  GET DIAGNOSTICS flushed = ROW_COUNT;
+
+  -- Offline for a day and fully flushed: nothing left to track
+  DELETE FROM user_presence
+  WHERE last_active_at < CURRENT_TIMESTAMP - INTERVAL '1 day'
+    AND NOT flushed_online
+    AND flushed_at = last_active_at;
+
+  RETURN flushed;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_cron') THEN
+    PERFORM cron.schedule('flush-user-presence', '* * * * *', 'SELECT flush_user_presence(60)');
+  END IF;
+END $$;
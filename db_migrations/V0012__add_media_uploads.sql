@@ -0,0 +1,60 @@
+-- Media stored once per distinct content: the object key is derived from the sha256,
+-- so forwarding the same file again only adds a reference, never a second copy.
+CREATE TABLE IF NOT EXISTS media_blobs (
+  sha256 CHAR(64) PRIMARY KEY,
+  storage_key TEXT NOT NULL,
+  byte_size BIGINT NOT NULL,
+  content_type VARCHAR(100) NOT NULL,
+  -- Derived renditions written by the media worker, e.g. {"thumbnail": {"key": ..., "width": ...}}
+  variants JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_by INTEGER REFERENCES users(id),
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- One row per resumable upload session; chunks land in the object store under
+-- uploads/<upload_id>/ and are tracked in media_upload_chunks.
+CREATE TABLE IF NOT EXISTS media_uploads (
+  upload_id VARCHAR(64) PRIMARY KEY,
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  file_name TEXT NOT NULL,
+  content_type VARCHAR(100) NOT NULL,
+  byte_size BIGINT NOT NULL CHECK (byte_size > 0),
+  chunk_size INTEGER NOT NULL CHECK (chunk_size > 0),
+  chunk_count INTEGER NOT NULL CHECK (chunk_count > 0),
+  expected_sha256 CHAR(64),
+  status VARCHAR(20) NOT NULL DEFAULT 'uploading' CHECK (status IN ('uploading', 'complete')),
+  sha256 CHAR(64) REFERENCES media_blobs(sha256),
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_uploads_user_id ON media_uploads(user_id);
+CREATE INDEX IF NOT EXISTS idx_media_uploads_expires_at ON media_uploads(expires_at) WHERE status = 'uploading';
+
+-- A row per received chunk, so parallel chunk requests never rewrite a shared row
+CREATE TABLE IF NOT EXISTS media_upload_chunks (
+  upload_id VARCHAR(64) NOT NULL REFERENCES media_uploads(upload_id) ON DELETE CASCADE,
+  chunk_index INTEGER NOT NULL,
+  byte_size INTEGER NOT NULL,
+  received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (upload_id, chunk_index)
+);
+
+-- Background work for the media worker, claimed with FOR UPDATE SKIP LOCKED.
+-- UNIQUE (sha256, kind): a blob uploaded many times is processed once.
+CREATE TABLE IF NOT EXISTS media_jobs (
+  id BIGSERIAL PRIMARY KEY,
+  sha256 CHAR(64) NOT NULL REFERENCES media_blobs(sha256),
+  kind VARCHAR(20) NOT NULL CHECK (kind IN ('thumbnail')),
+  status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed', 'skipped')),
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  locked_until TIMESTAMP,
+  last_error TEXT,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  finished_at TIMESTAMP,
+  UNIQUE (sha256, kind)
+);
+
+-- Only runnable jobs are indexed, so the queue scan stays small as history grows
+CREATE INDEX IF NOT EXISTS idx_media_jobs_runnable ON media_jobs(run_after, id) WHERE status IN ('pending', 'running');
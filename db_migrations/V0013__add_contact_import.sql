@@ -0,0 +1,19 @@
+-- Address-book import matches entries by the sha256 of the normalized username or
+-- email, so clients may send hashes instead of plain values. Declared IMMUTABLE so it
+-- can back expression indexes; the database encoding never changes under it.
+CREATE OR REPLACE FUNCTION contact_hash(value TEXT) RETURNS TEXT AS $$
+  SELECT encode(sha256(convert_to(lower(btrim(value)), 'UTF8')), 'hex')
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_hash ON users (contact_hash(username));
+CREATE INDEX IF NOT EXISTS idx_users_email_hash ON users (contact_hash(email));
+
+-- Entries each user has already imported, stored only as hashes. A re-sync skips
+-- known entries unless the client asks for a full resync.
+CREATE TABLE IF NOT EXISTS contact_import_entries (
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  entry_hash CHAR(64) NOT NULL,
+  matched_user_id INTEGER REFERENCES users(id),
+  imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, entry_hash)
+);
@@ -0,0 +1,4 @@
+-- media-upload answers action=media only for blobs the caller uploaded or that were
+-- sent to one of their chats; both checks look a blob up by its identity.
+CREATE INDEX IF NOT EXISTS idx_media_uploads_sha256_user ON media_uploads(sha256, user_id) WHERE status = 'complete';
+CREATE INDEX IF NOT EXISTS idx_messages_media_url ON messages(media_url) WHERE media_url IS NOT NULL;
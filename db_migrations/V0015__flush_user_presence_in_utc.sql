@@ -0,0 +1,39 @@
+-- user_presence.last_active_at is written by the functions as UTC (datetime.utcnow()),
+-- and the presence action compares it against a UTC cutoff. CURRENT_TIMESTAMP cast to
+-- TIMESTAMP is in the session time zone instead, so on a server whose TimeZone is not
+-- UTC the flush disagreed with the presence action. Same function, one clock.
+CREATE OR REPLACE FUNCTION flush_user_presence(ttl_seconds INTEGER DEFAULT 60) RETURNS INTEGER AS $$
+DECLARE
+  now_utc TIMESTAMP := now() AT TIME ZONE 'UTC';
+  online_after TIMESTAMP := now_utc - make_interval(secs => ttl_seconds);
+  flushed INTEGER;
+BEGIN
+  IF NOT pg_try_advisory_xact_lock(hashtext('flush_user_presence')) THEN
+    RETURN 0;
+  END IF;
+
+  WITH changed AS (
+    UPDATE user_presence p
+    SET flushed_at = p.last_active_at,
+        flushed_online = p.last_active_at > online_after
+    WHERE p.flushed_online <> (p.last_active_at > online_after)
+       OR p.flushed_at IS NULL
+       OR p.last_active_at >= p.flushed_at + make_interval(secs => ttl_seconds)
+    RETURNING p.user_id, p.last_active_at, p.flushed_online
+  )
+  UPDATE users u
+  SET last_seen = c.last_active_at,
+      online_status = c.flushed_online
+  FROM changed c
+  WHERE u.id = c.user_id;
+  GET DIAGNOSTICS flushed = ROW_COUNT;
+
+  -- Offline for a day and fully flushed: nothing left to track
+  DELETE FROM user_presence
+  WHERE last_active_at < now_utc - INTERVAL '1 day'
+    AND NOT flushed_online
+    AND flushed_at = last_active_at;
+
+  RETURN flushed;
+END;
+$$ LANGUAGE plpgsql;
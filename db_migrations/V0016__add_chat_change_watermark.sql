@@ -0,0 +1,54 @@
+-- Chat-level change watermark for the sync action. Message activity is already
+-- visible through chats.last_message_id; change_seq covers everything else a
+-- client caches: joining a chat, chat metadata, role and read state changed on
+-- another device. Removals leave a row in chat_member_removals.
+CREATE SEQUENCE IF NOT EXISTS chat_change_seq;
+
+-- Existing rows keep 0 without a table rewrite; a sync without chat_since returns them
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE chats ALTER COLUMN change_seq SET DEFAULT nextval('chat_change_seq');
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE chat_members ALTER COLUMN change_seq SET DEFAULT nextval('chat_change_seq');
+
+CREATE OR REPLACE FUNCTION bump_chat_change_seq() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.change_seq := nextval('chat_change_seq');
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the listed columns bump the sequence, so message sends (last_message_*,
+-- unread_count) do not touch it
+DROP TRIGGER IF EXISTS chats_change_seq ON chats;
+CREATE TRIGGER chats_change_seq
+  BEFORE UPDATE OF type, name, description, avatar_url ON chats
+  FOR EACH ROW EXECUTE FUNCTION bump_chat_change_seq();
+
+DROP TRIGGER IF EXISTS chat_members_change_seq ON chat_members;
+CREATE TRIGGER chat_members_change_seq
+  BEFORE UPDATE OF role, last_read_message_id ON chat_members
+  FOR EACH ROW EXECUTE FUNCTION bump_chat_change_seq();
+
+CREATE TABLE IF NOT EXISTS chat_member_removals (
+  user_id INTEGER NOT NULL,
+  chat_id INTEGER NOT NULL,
+  change_seq BIGINT NOT NULL,
+  removed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_member_removals_user_seq ON chat_member_removals(user_id, change_seq);
+
+-- Statement level, so removing thousands of members is one INSERT ... SELECT
+CREATE OR REPLACE FUNCTION record_chat_member_removals() RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO chat_member_removals (user_id, chat_id, change_seq)
+  SELECT user_id, chat_id, nextval('chat_change_seq') FROM removed;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS chat_members_removed ON chat_members;
+CREATE TRIGGER chat_members_removed
+  AFTER DELETE ON chat_members
+  REFERENCING OLD TABLE AS removed
+  FOR EACH STATEMENT EXECUTE FUNCTION record_chat_member_removals();
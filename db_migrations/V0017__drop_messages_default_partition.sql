@@ -0,0 +1,27 @@
+-- A default partition can never be pruned, and while one exists the planner does not
+-- use an ordered Append over the monthly partitions. Newest-first list_messages
+-- without a created_at bound then merged every month instead of stopping at the
+-- newest. Monthly partitions are created ahead of time by ensure_messages_partitions
+-- (messenger-api daily, pg_cron when installed), so the safety net is dropped.
+-- Rows that did land in it are moved to monthly partitions first.
+DO $$
+DECLARE
+  month_start DATE;
+BEGIN
+  IF to_regclass('messages_default') IS NULL THEN
+    RETURN;
+  END IF;
+
+  ALTER TABLE messages DETACH PARTITION messages_default;
+  FOR month_start IN SELECT DISTINCT date_trunc('month', created_at)::date FROM messages_default LOOP
+    PERFORM create_messages_partition(month_start);
+  END LOOP;
+
+  INSERT INTO messages (id, chat_id, sender_id, message_type, content, media_url, file_name, file_size, created_at)
+  SELECT id, chat_id, sender_id, message_type, content, media_url, file_name, file_size, created_at
+  FROM messages_default;
+
+  DROP TABLE messages_default;
+END $$;
+
+SELECT ensure_messages_partitions(2);
@@ -0,0 +1,5 @@
+-- Per-chat counter bumped by every message insert, in the same UPDATE that moves
+-- the last-message pointer. The pointer only moves forward, so a message that
+-- commits after a higher id leaves it unchanged; the counter still changes and
+-- conditional GETs of the chat see the new message.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS message_seq BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,13 @@
+-- Full-text index keyed by chat. search_messages filters on the caller's chats
+-- (chat_id = ANY(...)) together with the tsquery; with btree_gin both conditions
+-- are index conditions of one bitmap scan, so only matches inside the caller's
+-- chats are fetched and ranked, instead of every match in the table.
+-- Relevance sort still ranks all of the caller's own matches before LIMIT: a
+-- very common term in very large chats costs as many rows as it matches there.
+-- Building the index reads every partition; run it in a quiet window.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_search ON messages USING GIN (chat_id, search_vector);
+
+-- A multicolumn GIN index serves search_vector-only conditions as well
+DROP INDEX IF EXISTS idx_messages_search_vector;
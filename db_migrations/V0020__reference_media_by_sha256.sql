@@ -0,0 +1,11 @@
+-- Messages reference uploaded media by content hash. messenger-api only accepts a
+-- media_sha256 the sender uploaded or can already see in one of their chats, and
+-- media-upload grants access through this column rather than through media_url,
+-- which clients used to set freely and which can be derived from a hash.
+-- Messages sent before this migration carry no hash and no longer grant access
+-- to a blob; their media_url is kept as it was.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_sha256 CHAR(64) REFERENCES media_blobs(sha256);
+
+CREATE INDEX IF NOT EXISTS idx_messages_media_sha256 ON messages(media_sha256) WHERE media_sha256 IS NOT NULL;
+
+DROP INDEX IF EXISTS idx_messages_media_url;
@@ -0,0 +1,10 @@
+-- Logouts, for the functions that cache verified sessions in process. Each process
+-- reads the rows newer than the last one it saw (see sessions.py) and drops those
+-- tokens from its cache. Rows are only needed for about a minute; logout prunes
+-- anything older than a day.
+CREATE TABLE IF NOT EXISTS session_revocations (
+  session_token VARCHAR(255) NOT NULL,
+  revoked_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_revocations_revoked_at ON session_revocations(revoked_at);
@@ -0,0 +1,33 @@
+'''
+Minimal gateway client for local testing: prints every frame it receives.
+
+    python realtime/client.py --token bench-token-1 --resume-from 0
+'''
+import argparse
+import asyncio
+import json
+
+import websockets
+
+async def run(url: str, token: str, resume_from) -> None:
+    async with websockets.connect(url) as websocket:
+        hello = {'type': 'auth', 'token': token}
+        if resume_from is not None:
+            hello['resume_from'] = resume_from
+        await websocket.send(json.dumps(hello))
+        async for frame in websocket:
+            print(frame, flush=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Print realtime gateway events for one session')
+    parser.add_argument('--url', default='ws://localhost:8765')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--resume-from', type=int)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args.url, args.token, args.resume_from))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
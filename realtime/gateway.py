@@ -0,0 +1,296 @@
+'''
+Realtime delivery gateway: LISTENs on the chat_events channel that messenger-api
+NOTIFYs on commit and fans events out to WebSocket clients by chat membership.
+
+    DATABASE_URL=postgresql://localhost/messenger python realtime/gateway.py
+
+Protocol (JSON text frames):
+    client -> {"type": "auth", "token": "<session token>", "resume_from": <message id, optional>}
+    server -> {"type": "ready", "user_id": 1, "chats": [..]}
+    server -> {"type": "message", "message": {...}}
+    server -> {"type": "members", "chat_id": 1, "added": [..], "removed": [..]}
+              (a large change arrives as several members frames)
+    server -> {"type": "resync_required"} when more than RESUME_LIMIT messages were missed
+'''
+import asyncio
+import json
+import logging
+import os
+import signal
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import asyncpg
+import websockets
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+REALTIME_HOST = os.environ.get('REALTIME_HOST', '0.0.0.0')
+REALTIME_PORT = int(os.environ.get('REALTIME_PORT', '8765'))
+REALTIME_CHANNEL = os.environ.get('REALTIME_CHANNEL', 'chat_events')
+AUTH_TIMEOUT = float(os.environ.get('REALTIME_AUTH_TIMEOUT', '10'))
+CLIENT_QUEUE_SIZE = int(os.environ.get('REALTIME_CLIENT_QUEUE_SIZE', '1000'))
+RESUME_LIMIT = int(os.environ.get('REALTIME_RESUME_LIMIT', '1000'))
+LISTEN_RETRY_SECONDS = float(os.environ.get('REALTIME_LISTEN_RETRY', '2'))
+
+log = logging.getLogger('realtime.gateway')
+
+SESSION_LOOKUP = """
+    SELECT user_id FROM sessions WHERE session_token = $1 AND expires_at > $2
+"""
+
+USER_CHATS = """
+    SELECT chat_id FROM chat_members WHERE user_id = $1
+"""
+
+MESSAGE_COLUMNS = """
+    m.id, m.chat_id, m.sender_id, m.message_type, m.content, m.media_url, m.file_name, m.file_size,
+    to_char(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+    u.username, u.full_name, u.avatar_url
+"""
+
+MESSAGE_BY_ID = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m
+    INNER JOIN users u ON u.id = m.sender_id
+    WHERE m.chat_id = $1 AND m.id = $2
+"""
+
+MESSAGES_SINCE = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m
+    INNER JOIN users u ON u.id = m.sender_id
+    WHERE m.chat_id = ANY($1::int[]) AND m.id > $2
+    ORDER BY m.id ASC
+    LIMIT $3
+"""
+
+class Client:
+    def __init__(self, websocket: Any, user_id: int, chats: Set[int]):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.chats = chats
+        self.queue: 'asyncio.Queue[str]' = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, frame: str) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # A client that cannot keep up is dropped; it reconnects with resume_from
+            self.overflowed = True
+            asyncio.ensure_future(self.websocket.close(code=1013, reason='Client too slow'))
+
+class Gateway:
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.by_chat: Dict[int, Set[Client]] = {}
+        self.by_user: Dict[int, Set[Client]] = {}
+        self.last_message_id = 0
+        self.events: 'asyncio.Queue[str]' = asyncio.Queue()
+        self.stats = {'connections': 0, 'events': 0, 'frames': 0, 'dropped_clients': 0}
+
+    def register(self, client: Client) -> None:
+        self.by_user.setdefault(client.user_id, set()).add(client)
+        for chat_id in client.chats:
+            self.by_chat.setdefault(chat_id, set()).add(client)
+        self.stats['connections'] += 1
+
+    def unregister(self, client: Client) -> None:
+        for chat_id in client.chats:
+            subscribers = self.by_chat.get(chat_id)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.by_chat[chat_id]
+        clients = self.by_user.get(client.user_id)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.by_user[client.user_id]
+        if client.overflowed:
+            self.stats['dropped_clients'] += 1
+
+    def broadcast(self, clients: Iterable[Client], frame: str) -> None:
+        for client in list(clients):
+            client.push(frame)
+            self.stats['frames'] += 1
+
+    def on_notify(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        self.events.put_nowait(payload)
+
+    async def dispatch(self) -> None:
+        # One event at a time, so clients see messages in commit order
+        while True:
+            payload = await self.events.get()
+            try:
+                await self.handle_event(payload)
+            except Exception:
+                log.exception('Failed to dispatch event')
+
+    async def handle_event(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            log.warning('Ignoring malformed event payload: %r', payload[:200])
+            return
+        self.stats['events'] += 1
+
+        if event.get('t') == 'message':
+            self.last_message_id = max(self.last_message_id, event['id'])
+            subscribers = self.by_chat.get(event['chat_id'])
+            if not subscribers:
+                return
+            row = await self.pool.fetchrow(MESSAGE_BY_ID, event['chat_id'], event['id'])
+            if row is not None:
+                self.broadcast(subscribers, json.dumps({'type': 'message', 'message': dict(row)}))
+        elif event.get('t') == 'members':
+            self.apply_membership(event['chat_id'], event.get('added', []), event.get('removed', []))
+
+    def apply_membership(self, chat_id: int, added: List[int], removed: List[int]) -> None:
+        for user_id in added:
+            for client in self.by_user.get(user_id, ()):
+                client.chats.add(chat_id)
+                self.by_chat.setdefault(chat_id, set()).add(client)
+        recipients = set(self.by_chat.get(chat_id, ()))
+        for user_id in removed:
+            for client in self.by_user.get(user_id, ()):
+                client.chats.discard(chat_id)
+                recipients.add(client)
+                subscribers = self.by_chat.get(chat_id)
+                if subscribers is not None:
+                    subscribers.discard(client)
+                    if not subscribers:
+                        del self.by_chat[chat_id]
+        frame = json.dumps({'type': 'members', 'chat_id': chat_id, 'added': added, 'removed': removed})
+        self.broadcast(recipients, frame)
+
+    async def replay(self, client: Client, since: int) -> int:
+        '''Sends messages newer than since to one client; returns the last id sent or -1 when it gave up.'''
+        if not client.chats:
+            return since
+        rows = await self.pool.fetch(MESSAGES_SINCE, list(client.chats), since, RESUME_LIMIT + 1)
+        if len(rows) > RESUME_LIMIT:
+            await client.websocket.send(json.dumps({'type': 'resync_required'}))
+            return -1
+        for row in rows:
+            await client.websocket.send(json.dumps({'type': 'message', 'message': dict(row)}))
+            since = row['id']
+        return since
+
+    async def catch_up(self) -> None:
+        # Events NOTIFYed while the listener was down are gone; replay them from the table
+        if not self.last_message_id or not self.by_chat:
+            return
+        rows = await self.pool.fetch(MESSAGES_SINCE, list(self.by_chat), self.last_message_id, RESUME_LIMIT + 1)
+        if len(rows) > RESUME_LIMIT:
+            frame = json.dumps({'type': 'resync_required'})
+            self.broadcast({client for clients in self.by_user.values() for client in clients}, frame)
+        else:
+            for row in rows:
+                self.broadcast(self.by_chat.get(row['chat_id'], ()), json.dumps({'type': 'message', 'message': dict(row)}))
+        if rows:
+            self.last_message_id = rows[-1]['id']
+
+    async def authenticate(self, websocket: Any) -> Optional[Dict[str, Any]]:
+        try:
+            hello = json.loads(await asyncio.wait_for(websocket.recv(), AUTH_TIMEOUT))
+        except (asyncio.TimeoutError, ValueError):
+            return None
+        if not isinstance(hello, dict) or hello.get('type') != 'auth' or not hello.get('token'):
+            return None
+        user_id = await self.pool.fetchval(SESSION_LOOKUP, hello['token'], datetime.utcnow())
+        if user_id is None:
+            return None
+        chats = {row['chat_id'] for row in await self.pool.fetch(USER_CHATS, user_id)}
+        return {'user_id': user_id, 'chats': chats, 'resume_from': hello.get('resume_from')}
+
+    async def serve_client(self, websocket: Any) -> None:
+        auth = await self.authenticate(websocket)
+        if auth is None:
+            await websocket.close(code=4401, reason='Invalid or missing session token')
+            return
+
+        client = Client(websocket, auth['user_id'], auth['chats'])
+        # Registered before the replay so nothing committed meanwhile is lost;
+        # live frames queue up and duplicates are skipped by id below.
+        self.register(client)
+        try:
+            await websocket.send(json.dumps({'type': 'ready', 'user_id': client.user_id, 'chats': sorted(client.chats)}))
+            sent_up_to = 0
+            if isinstance(auth['resume_from'], int):
+                sent_up_to = await self.replay(client, auth['resume_from'])
+                if sent_up_to < 0:
+                    return
+
+            sender = asyncio.ensure_future(self.pump(client, sent_up_to))
+            receiver = asyncio.ensure_future(self.drain(websocket))
+            done, pending = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.unregister(client)
+
+    async def pump(self, client: Client, skip_up_to: int) -> None:
+        # A replayed message can still arrive live at any point (a slow NOTIFY, or
+        # catch_up after a listener reconnect), so the filter lasts the whole connection
+        while True:
+            frame = await client.queue.get()
+            if skip_up_to and frame.startswith('{"type": "message"'):
+                if json.loads(frame)['message']['id'] <= skip_up_to:
+                    continue
+            await client.websocket.send(frame)
+
+    async def drain(self, websocket: Any) -> None:
+        # Clients only send the auth frame; anything else is read and ignored
+        async for _ in websocket:
+            pass
+
+async def listen(gateway: Gateway, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            connection = await asyncpg.connect(DATABASE_URL)
+        except (OSError, asyncpg.PostgresError) as error:
+            log.warning('LISTEN connection failed: %s', error)
+            await asyncio.sleep(LISTEN_RETRY_SECONDS)
+            continue
+        lost = asyncio.Event()
+        connection.add_termination_listener(lambda _: lost.set())
+        await connection.add_listener(REALTIME_CHANNEL, gateway.on_notify)
+        log.info('Listening on %s', REALTIME_CHANNEL)
+        await gateway.catch_up()
+
+        waiters = {asyncio.ensure_future(stop.wait()), asyncio.ensure_future(lost.wait())}
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        if not connection.is_closed():
+            await connection.close()
+
+async def main() -> None:
+    if not DATABASE_URL:
+        raise SystemExit('DATABASE_URL is not set')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+    gateway = Gateway(pool)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    dispatcher = asyncio.ensure_future(gateway.dispatch())
+    listener = asyncio.ensure_future(listen(gateway, stop))
+    async with websockets.serve(gateway.serve_client, REALTIME_HOST, REALTIME_PORT):
+        log.info('Gateway on ws://%s:%s', REALTIME_HOST, REALTIME_PORT)
+        await stop.wait()
+    await listener
+    dispatcher.cancel()
+    await pool.close()
+    log.info('Stopped: %s', json.dumps(gateway.stats))
+
+if __name__ == '__main__':
+    asyncio.run(main())
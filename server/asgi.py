@@ -0,0 +1,309 @@
+'''
+Long-running server mode: every backend function mounted in one ASGI process.
+Requests are translated into the same handler(event, context) call the serverless
+platform makes, so the function code is identical in both modes.
+
+    DATABASE_URL=postgresql://localhost/messenger python server/asgi.py --port 8000 --workers 4
+    DATABASE_URL=postgresql://localhost/messenger uvicorn --app-dir server asgi:app --workers 4
+
+Routes:
+    /<function>[/...]?query   e.g. GET /messenger-api?action=list_chats&user_id=1
+    /_server/health           liveness
+    /_server/stats            request counters and process CPU time, read by benchmarks/run.py
+
+Handlers are synchronous psycopg2 code; each one runs on a worker thread of a
+SERVER_THREADS pool while the event loop keeps accepting connections. Each function
+gets its own copies of its helper modules (db.py, sessions.py, ...), loaded under
+names like function_messenger_api__db, so a helper vendored into one function never
+shadows another's; each function therefore has its own pool of up to
+DB_POOL_MAX_SIZE connections.
+
+messenger-api list_chats and list_messages, the hottest reads, skip the thread pool:
+native.py serves them on the event loop over an asyncpg pool, so a process keeps
+many of them in flight at once. Set SERVER_NATIVE=0 to send them to the threads too.
+Use one process per core (--workers) to spread Python work past the GIL.
+'''
+import argparse
+import asyncio
+import base64
+import builtins
+import glob
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType, SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from native import NativeMessenger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+
+FUNCTIONS = ('messenger-api', 'auth-login', 'auth-register', 'user-search', 'contact-add', 'media-upload')
+
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', str(min(32, (os.cpu_count() or 1) * 4))))
+SERVER_MAX_INFLIGHT = int(os.environ.get('SERVER_MAX_INFLIGHT', str(SERVER_THREADS * 8)))
+SERVER_MAX_BODY = int(os.environ.get('SERVER_MAX_BODY', str(16 * 1024 * 1024)))
+SERVER_PREWARM = os.environ.get('SERVER_PREWARM', '1') == '1'
+
+# Every request holds one pooled connection for its whole duration, so more
+# connections than threads would never be used
+os.environ.setdefault('DB_POOL_MAX_SIZE', str(SERVER_THREADS))
+
+TEXT_CONTENT_TYPES = ('application/json', 'text/', 'application/x-www-form-urlencoded')
+
+Handler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+class FunctionImporter:
+    '''Resolves one function's top-level imports of its own helper modules to private copies.'''
+    def __init__(self, function_name: str):
+        self.function_dir = os.path.join(BACKEND_DIR, function_name)
+        self.prefix = 'function_' + function_name.replace('-', '_')
+        self.helpers = {
+            os.path.splitext(os.path.basename(path))[0]
+            for path in glob.glob(os.path.join(self.function_dir, '*.py'))
+        } - {'index'}
+        self.builtins = {**vars(builtins), '__import__': self.import_module}
+        # Handlers import some helpers (models, storage) lazily, on worker threads
+        self._lock = threading.RLock()
+
+    def load(self, name: str) -> ModuleType:
+        module_name = self.prefix if name == 'index' else f'{self.prefix}__{name}'
+        with self._lock:
+            if module_name in sys.modules:
+                return sys.modules[module_name]
+            spec = importlib.util.spec_from_file_location(module_name, os.path.join(self.function_dir, name + '.py'))
+            module = importlib.util.module_from_spec(spec)
+            module.__builtins__ = self.builtins
+            # Registered first so import cycles between helpers resolve as they would on sys.path
+            sys.modules[module_name] = module
+            try:
+                spec.loader.exec_module(module)
+            except BaseException:
+                del sys.modules[module_name]
+                raise
+            return module
+
+    def import_module(self, name: str, globals: Optional[Dict] = None, locals: Optional[Dict] = None, fromlist: Tuple = (), level: int = 0) -> ModuleType:
+        if level == 0 and name in self.helpers:
+            return self.load(name)
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+def header_name(raw: bytes) -> str:
+    return '-'.join(part.capitalize() for part in raw.decode('latin-1').split('-'))
+
+def build_event(scope: Dict[str, Any], path: str, body: bytes) -> Dict[str, Any]:
+    headers = {header_name(name): value.decode('latin-1') for name, value in scope['headers']}
+    query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+    event = {
+        'httpMethod': scope['method'],
+        'path': path or '/',
+        'headers': headers,
+        'queryStringParameters': query,
+        'isBase64Encoded': False,
+        'body': '',
+        'requestContext': {
+            'requestId': uuid.uuid4().hex,
+            'identity': {'sourceIp': (scope.get('client') or ('', 0))[0]},
+        },
+    }
+    if body:
+        text = None
+        if headers.get('Content-Type', 'application/json').lower().startswith(TEXT_CONTENT_TYPES):
+            try:
+                text = body.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        if text is None:
+            # Binary bodies reach handlers base64-encoded, as on the platform gateway
+            event['body'] = base64.b64encode(body).decode()
+            event['isBase64Encoded'] = True
+        else:
+            event['body'] = text
+    return event
+
+def encode_response(response: Dict[str, Any]) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        payload = base64.b64decode(body)
+    else:
+        payload = body.encode('utf-8') if isinstance(body, str) else bytes(body)
+    headers = [
+        (str(name).lower().encode('latin-1'), str(value).encode('latin-1'))
+        for name, value in (response.get('headers') or {}).items()
+        if str(name).lower() != 'content-length'
+    ]
+    headers.append((b'content-length', str(len(payload)).encode()))
+    return int(response.get('statusCode', 200)), headers, payload
+
+class Server:
+    def __init__(self, function_names: Tuple[str, ...] = FUNCTIONS):
+        self.importers = {name: FunctionImporter(name) for name in function_names}
+        self.modules = {name: importer.load('index') for name, importer in self.importers.items()}
+        self.handlers: Dict[str, Handler] = {name: module.handler for name, module in self.modules.items()}
+        self.native: Optional[NativeMessenger] = None
+        if 'messenger-api' in self.modules and NativeMessenger.available():
+            self.native = NativeMessenger(self.modules['messenger-api'], self.importers['messenger-api'].load('sessions'))
+        self.executor = ThreadPoolExecutor(max_workers=SERVER_THREADS, thread_name_prefix='handler')
+        self.started_at = time.monotonic()
+        self.inflight = 0
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'rejected': 0, 'errors': 0}
+        self.by_function: Dict[str, int] = {name: 0 for name in function_names}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'by_function': dict(self.by_function),
+            'native': dict(self.native.stats) if self.native is not None else None,
+            'inflight': self.inflight,
+            'threads': SERVER_THREADS,
+            'pid': os.getpid(),
+            'cpu_seconds': round(time.process_time(), 6),
+            'uptime_seconds': round(time.monotonic() - self.started_at, 3),
+        }
+
+    def invoke(self, function_name: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        context = SimpleNamespace(request_id=event['requestContext']['requestId'], function_name=function_name)
+        return self.handlers[function_name](event, context)
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                dsn = os.environ.get('DATABASE_URL')
+                messenger = self.modules.get('messenger-api')
+                if SERVER_PREWARM and dsn and messenger is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(self.executor, messenger.prewarm, dsn)
+                    except Exception as error:
+                        print(json.dumps({'type': 'prewarm_failed', 'error': str(error)}), flush=True)
+                if dsn and self.native is not None:
+                    try:
+                        await self.native.start(dsn)
+                    except Exception as error:
+                        # Without the pool every request still has the threaded handler
+                        print(json.dumps({'type': 'native_pool_failed', 'error': str(error)}), flush=True)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.native is not None:
+                    await self.native.close()
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        function_name, _, rest = scope['path'].lstrip('/').partition('/')
+
+        if function_name == '_server':
+            if rest == 'health':
+                await self.reply(send, 200, {'status': 'ok'})
+            elif rest == 'stats':
+                await self.reply(send, 200, self.snapshot())
+            else:
+                await self.reply(send, 404, {'error': 'Not found'})
+            return
+
+        if function_name not in self.handlers:
+            await self.reply(send, 404, {'error': f'Unknown function: {function_name}'})
+            return
+
+        body = await self.read_body(receive)
+        if body is None:
+            await self.reply(send, 413, {'error': f'Request body larger than {SERVER_MAX_BODY} bytes'})
+            return
+
+        with self._lock:
+            if self.inflight >= SERVER_MAX_INFLIGHT:
+                self.stats['rejected'] += 1
+                rejected = True
+            else:
+                self.inflight += 1
+                self.stats['requests'] += 1
+                self.by_function[function_name] += 1
+                rejected = False
+        if rejected:
+            await self.reply(send, 503, {'error': 'Server busy'}, [(b'retry-after', b'1')])
+            return
+
+        try:
+            event = build_event(scope, '/' + rest, body)
+            if function_name == 'messenger-api' and self.native is not None and self.native.accepts(event):
+                response = await self.native.handle(event)
+            else:
+                response = await asyncio.get_running_loop().run_in_executor(self.executor, self.invoke, function_name, event)
+            status, headers, payload = encode_response(response)
+        except Exception as error:
+            with self._lock:
+                self.stats['errors'] += 1
+            status, headers, payload = encode_response({
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(error)}),
+            })
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def read_body(self, receive: Callable) -> Optional[bytes]:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > SERVER_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def reply(self, send: Callable, status: int, data: Dict[str, Any], extra_headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+        payload = json.dumps(data).encode()
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers + (extra_headers or [])})
+        await send({'type': 'http.response.body', 'body': payload})
+
+def main() -> int:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Serve all backend functions from one ASGI process per worker')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8000')))
+    parser.add_argument('--workers', type=int, default=1, help='processes; one per core is a good start')
+    args = parser.parse_args()
+
+    uvicorn.run(
+        'asgi:app',
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        access_log=False,
+    )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+else:
+    # Built only where requests are served; the launcher process just starts uvicorn
+    app = Server()
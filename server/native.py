@@ -0,0 +1,198 @@
+'''
+Native asyncio path for the hottest messenger-api reads in server mode.
+
+list_chats and list_messages run on the event loop against an asyncpg pool, so
+one process keeps many of them in flight without a thread each. They execute the
+function's own statements, ETag and cursor helpers and response formatting, so
+answers match the threaded handler byte for byte. Everything else, including
+compact list_messages (profiles come from the synchronous profile cache), goes
+to the thread pool.
+
+Reads go to the primary, which satisfies X-Min-LSN read-your-writes pins without
+consulting replicas. Requests served here carry no Server-Timing sample.
+'''
+import json
+import os
+from datetime import datetime
+from types import ModuleType
+from typing import Any, Dict, Optional
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+SERVER_NATIVE = os.environ.get('SERVER_NATIVE', '1') == '1'
+SERVER_NATIVE_POOL_SIZE = int(os.environ.get('SERVER_NATIVE_POOL_SIZE', '20'))
+
+NATIVE_ACTIONS = ('list_chats', 'list_messages')
+
+async def setup_connection(conn: Any) -> None:
+    # psycopg2 decodes json columns; asyncpg returns text unless told otherwise
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+class NativeMessenger:
+    def __init__(self, index: ModuleType, sessions: ModuleType):
+        self.index = index
+        self.sessions = sessions
+        self.pool: Optional[Any] = None
+        self.stats = {'requests': 0, 'errors': 0}
+
+    @staticmethod
+    def available() -> bool:
+        return SERVER_NATIVE and asyncpg is not None
+
+    async def start(self, dsn: str) -> None:
+        self.pool = await asyncpg.create_pool(dsn, min_size=1, max_size=SERVER_NATIVE_POOL_SIZE, init=setup_connection)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def accepts(self, event: Dict[str, Any]) -> bool:
+        query = event.get('queryStringParameters') or {}
+        return (
+            self.pool is not None
+            and event['httpMethod'] == 'GET'
+            and query.get('action') in NATIVE_ACTIONS
+            and query.get('compact') not in ('1', 'true')
+        )
+
+    async def handle(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        index = self.index
+        self.stats['requests'] += 1
+        try:
+            params = dict(event.get('queryStringParameters') or {})
+            malformed = index.reject_malformed('GET', params)
+            if malformed:
+                return index.http_response(malformed)
+
+            async with self.pool.acquire() as conn:
+                user_id = await self.verify_session(conn, index.get_session_token(event))
+                if user_id is None:
+                    result = {'statusCode': 401, 'error': 'Invalid or missing session token'}
+                else:
+                    result = index.bind_user(params, user_id)
+                    if result is None:
+                        if_none_match = index.get_header(event, 'If-None-Match')
+                        if params['action'] == 'list_chats':
+                            result = await self.list_chats(conn, params, if_none_match)
+                        else:
+                            result = await self.list_messages(conn, params, if_none_match)
+            return index.http_response(result)
+        except Exception as error:
+            self.stats['errors'] += 1
+            return index.http_response({'statusCode': 500, 'error': str(error)})
+
+    async def verify_session(self, conn: Any, token: Optional[str]) -> Optional[int]:
+        sessions = self.sessions
+        if not token:
+            return None
+
+        since = sessions.revocation_feed.claim()
+        if since is not None:
+            rows = None
+            try:
+                rows = await conn.fetch(sessions.REVOKED_SESSIONS.sql, since)
+            finally:
+                sessions.revocation_feed.release(sessions.session_cache, [tuple(row) for row in rows] if rows is not None else None)
+
+        found, user_id = sessions.session_cache.get(token)
+        if found:
+            return user_id
+
+        now = datetime.utcnow()
+        row = await conn.fetchrow(sessions.SESSION_LOOKUP.sql, token, now)
+        if row is None:
+            sessions.session_cache.put_negative(token)
+            return None
+        sessions.session_cache.put(token, row['user_id'], (row['expires_at'] - now).total_seconds())
+        return row['user_id']
+
+    async def list_chats(self, conn: Any, params: Dict, if_none_match: Optional[str]) -> Dict:
+        index = self.index
+        user_id = int(params['user_id'])
+        chat_type = params.get('type', '')
+
+        version = await conn.fetchrow(index.CHATS_VERSION.sql, user_id)
+        etag = index.make_etag('chats', user_id, chat_type, *version.values())
+        if index.etag_matches(if_none_match, etag):
+            return {'statusCode': 304, 'headers': {'ETag': etag}}
+
+        chats = await conn.fetch(index.LIST_CHATS.sql, user_id, chat_type)
+        return {'statusCode': 200, 'headers': {'ETag': etag}, 'data': {'chats': [dict(chat) for chat in chats]}}
+
+    async def list_messages(self, conn: Any, params: Dict, if_none_match: Optional[str]) -> Dict:
+        index = self.index
+        if not params.get('chat_id'):
+            return {'statusCode': 400, 'error': 'chat_id is required'}
+
+        try:
+            chat_id = int(params['chat_id'])
+            limit = min(max(int(params.get('limit', index.MESSAGES_PAGE_DEFAULT)), 1), index.MESSAGES_PAGE_MAX)
+            offset = int(params['offset']) if params.get('offset') else None
+            before_id = int(params['before_id']) if params.get('before_id') else None
+            after_id = int(params['after_id']) if params.get('after_id') else None
+        except ValueError:
+            return {'statusCode': 400, 'error': 'chat_id, limit, offset, before_id and after_id must be integers'}
+
+        version = await conn.fetchrow(index.CHAT_VERSION.sql, chat_id, int(params['user_id']))
+        if version is None:
+            return {'statusCode': 403, 'error': 'User is not a member of this chat'}
+
+        etag = index.make_etag(
+            'messages',
+            chat_id,
+            version['last_message_id'],
+            version['message_seq'],
+            limit,
+            offset,
+            before_id,
+            after_id,
+            params.get('cursor'),
+            False
+        )
+        if index.etag_matches(if_none_match, etag):
+            return {'statusCode': 304, 'headers': {'ETag': etag}}
+
+        position = None
+        if params.get('cursor'):
+            position = index.decode_cursor(params['cursor'])
+            if not position:
+                return {'statusCode': 400, 'error': 'Invalid cursor'}
+        elif before_id or after_id:
+            anchor_id = before_id or after_id
+            anchor = await conn.fetchrow(index.MESSAGE_ANCHOR.sql, anchor_id, chat_id)
+            if anchor is None:
+                return {'statusCode': 400, 'error': 'Message not found in this chat'}
+            position = ('before' if before_id else 'after', anchor_id, anchor['created_at'])
+
+        if position and position[0] == 'after':
+            messages = await conn.fetch(index.LIST_MESSAGES_AFTER.sql, chat_id, position[2], position[1], limit + 1)
+        elif position:
+            messages = await conn.fetch(index.LIST_MESSAGES_BEFORE.sql, chat_id, position[2], position[1], limit + 1)
+        else:
+            messages = await conn.fetch(index.LIST_MESSAGES_LATEST.sql, chat_id, limit + 1, offset or 0)
+
+        has_more = len(messages) > limit
+        messages_list = [dict(message) for message in messages[:limit]]
+
+        direction = 'after' if position and position[0] == 'after' else 'before'
+        next_cursor = None
+        if has_more:
+            edge = messages_list[-1]
+            next_cursor = index.encode_cursor(direction, edge['id'], edge['sort_key'])
+
+        if direction == 'before':
+            messages_list.reverse()
+
+        for message in messages_list:
+            del message['sort_key']
+
+        return {
+            'statusCode': 200,
+            'headers': {'ETag': etag},
+            'data': {'messages': messages_list, 'next_cursor': next_cursor, 'has_more': has_more}
+        }
@@ -17,9 +17,10 @@ interface User {
 
 interface ContactSearchProps {
   currentUserId: number;
+  sessionToken: string;
 }
 
-export default function ContactSearch({ currentUserId }: ContactSearchProps) {
+export default function ContactSearch({ currentUserId, sessionToken }: ContactSearchProps) {
   const [searchQuery, setSearchQuery] = useState('');
   const [users, setUsers] = useState<User[]>([]);
   const [loading, setLoading] = useState(false);
@@ -34,7 +35,12 @@ export default function ContactSearch({ currentUserId }: ContactSearchProps) {
     setSearching(true);
     try {
       const response = await fetch(
-        `https://functions.poehali.dev/17351105-6be6-497f-bba1-05366001a96a?query=${encodeURIComponent(searchQuery)}&current_user_id=${currentUserId}`
+        `https://functions.poehali.dev/17351105-6be6-497f-bba1-05366001a96a?query=${encodeURIComponent(searchQuery)}&current_user_id=${currentUserId}`,
+        {
+          headers: {
+            'X-Auth-Token': sessionToken,
+          },
+        }
       );
 
       const data = await response.json();
@@ -62,6 +68,7 @@ export default function ContactSearch({ currentUserId }: ContactSearchProps) {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'X-Auth-Token': sessionToken,
         },
         body: JSON.stringify({
           user_id: currentUserId,
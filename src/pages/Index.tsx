@@ -33,6 +33,25 @@ export default function Index() {
     }
   }, []);
 
+  useEffect(() => {
+    if (!sessionToken) return;
+
+    const sendHeartbeat = () => {
+      fetch('https://functions.poehali.dev/b314fbf0-4800-4147-af7f-cf22beb4df1d', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Auth-Token': sessionToken,
+        },
+        body: JSON.stringify({ action: 'heartbeat' }),
+      }).catch(() => {});
+    };
+
+    sendHeartbeat();
+    const timer = window.setInterval(sendHeartbeat, 30000);
+    return () => window.clearInterval(timer);
+  }, [sessionToken]);
+
   const handleAuthSuccess = (userData: User, token: string) => {
     setUser(userData);
     setSessionToken(token);
@@ -42,6 +61,16 @@ export default function Index() {
   };
 
   const handleLogout = () => {
+    if (sessionToken) {
+      fetch('https://functions.poehali.dev/40948a89-3432-4605-a5f9-35136c548435', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Auth-Token': sessionToken,
+        },
+        body: JSON.stringify({ action: 'logout' }),
+      }).catch(() => {});
+    }
     setUser(null);
     setSessionToken(null);
     localStorage.removeItem('user');
@@ -84,7 +113,7 @@ export default function Index() {
       )}
 
       {activeSection === 'contacts' && (
-        <ContactSearch currentUserId={user.id} />
+        <ContactSearch currentUserId={user.id} sessionToken={sessionToken} />
       )}
 
       {activeSection === 'profile' && (
@@ -0,0 +1,152 @@
+'''
+Tests for the backend functions. Cursors, ETags, session binding and the
+in-process caches need no database; tests that run handler SQL use the database
+fixture and are skipped unless TEST_DATABASE_URL points at a scratch database.
+They migrate it if needed and truncate it before each test.
+
+    python -m pytest tests
+    TEST_DATABASE_URL=postgresql://localhost/messenger_test python -m pytest tests
+'''
+import importlib.util
+import json
+import os
+import sys
+from typing import Any, Dict, Optional, Tuple
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSENGER_API_DIR = os.path.join(ROOT, 'backend', 'messenger-api')
+USER_SEARCH_DIR = os.path.join(ROOT, 'backend', 'user-search')
+MEDIA_UPLOAD_DIR = os.path.join(ROOT, 'backend', 'media-upload')
+AUTH_LOGIN_DIR = os.path.join(ROOT, 'backend', 'auth-login')
+BENCHMARKS_DIR = os.path.join(ROOT, 'benchmarks')
+SERVER_DIR = os.path.join(ROOT, 'server')
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+# Helper modules (db, sessions, members, ...) are imported by name, as the platform does;
+# the copies vendored into the other functions are identical
+if MESSENGER_API_DIR not in sys.path:
+    sys.path.insert(0, MESSENGER_API_DIR)
+
+def load_index(function_dir: str, module_name: str, file_name: str = 'index.py'):
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(function_dir, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+    return sys.modules[module_name]
+
+@pytest.fixture(scope='session')
+def messenger_api():
+    return load_index(MESSENGER_API_DIR, 'messenger_api_index')
+
+@pytest.fixture(scope='session')
+def user_search():
+    return load_index(USER_SEARCH_DIR, 'user_search_index')
+
+@pytest.fixture(scope='session')
+def media_upload():
+    return load_index(MEDIA_UPLOAD_DIR, 'media_upload_index')
+
+@pytest.fixture(scope='session')
+def auth_login():
+    return load_index(AUTH_LOGIN_DIR, 'auth_login_index')
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('time.monotonic', clock)
+    return clock
+
+@pytest.fixture(scope='session')
+def database_url():
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    import psycopg2
+    seed = load_index(BENCHMARKS_DIR, 'bench_seed', 'seed.py')
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('users') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        seed.apply_migrations(conn)
+    cursor.execute("SELECT ensure_messages_partitions()")
+    conn.commit()
+    conn.close()
+    return TEST_DATABASE_URL
+
+@pytest.fixture
+def database(database_url, monkeypatch):
+    '''A connection to the emptied test database, with fresh in-process caches.'''
+    import psycopg2
+    import members
+    import profiles
+    import sessions
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    monkeypatch.setattr(sessions, 'session_cache', sessions.SessionCache(
+        sessions.SESSION_CACHE_SIZE, sessions.SESSION_CACHE_TTL,
+        sessions.SESSION_NEGATIVE_CACHE_SIZE, sessions.SESSION_NEGATIVE_CACHE_TTL,
+    ))
+    monkeypatch.setattr(sessions, 'revocation_feed', sessions.RevocationFeed(sessions.SESSION_REVOCATION_POLL))
+    monkeypatch.setattr(members, 'membership_cache', members.MembershipCache(
+        members.MEMBERSHIP_CACHE_CHATS, members.MEMBERSHIP_CACHE_TTL, members.MEMBERSHIP_HOT_THRESHOLD,
+    ))
+    monkeypatch.setattr(profiles, 'profile_cache', profiles.ProfileCache(profiles.PROFILE_CACHE_SIZE, profiles.PROFILE_CACHE_TTL))
+    conn = psycopg2.connect(database_url)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT string_agg(quote_ident(tablename), ', ')
+        FROM pg_tables
+        WHERE schemaname = current_schema() AND tablename NOT LIKE 'messages%'
+    """)
+    cursor.execute(f"TRUNCATE {cursor.fetchone()[0]}, messages RESTART IDENTITY CASCADE")
+    conn.commit()
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def make_user(database):
+    '''Creates a user with a live session and returns (user_id, token).'''
+    def make(username: str) -> Tuple[int, str]:
+        cursor = database.cursor()
+        cursor.execute("""
+            INSERT INTO users (username, email, password_hash, full_name)
+            VALUES (%s, %s, 'x', %s)
+            RETURNING id
+        """, (username, f'{username}@example.com', username.title()))
+        user_id = cursor.fetchone()[0]
+        token = f'test-token-{user_id}'
+        cursor.execute("""
+            INSERT INTO sessions (user_id, session_token, expires_at)
+            VALUES (%s, %s, now() AT TIME ZONE 'UTC' + interval '1 hour')
+        """, (user_id, token))
+        database.commit()
+        cursor.close()
+        return user_id, token
+    return make
+
+def invoke(module: Any, method: str, token: str, data: Dict, headers: Optional[Dict] = None) -> Tuple[int, Dict, Any]:
+    event = {'httpMethod': method, 'headers': {'X-Auth-Token': token, **(headers or {})}}
+    if method == 'GET':
+        event['queryStringParameters'] = {key: str(value) for key, value in data.items()}
+    else:
+        event['body'] = json.dumps(data)
+    response = module.handler(event, None)
+    body = response.get('body')
+    return response['statusCode'], response.get('headers') or {}, json.loads(body) if body else None
+
+@pytest.fixture
+def call(database):
+    '''Invokes a function handler the way the platform does; returns (status, headers, parsed body).'''
+    return invoke
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+
+import pytest
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    import storage
+    monkeypatch.setattr(storage, '_store', storage.LocalObjectStore(str(tmp_path)))
+
+def upload(call, media_upload, token, content):
+    _, _, body = call(media_upload, 'POST', token, {
+        'action': 'init_upload', 'file_name': 'photo.jpg', 'file_size': len(content), 'content_type': 'image/jpeg'
+    })
+    upload_id = body['upload']['upload_id']
+    response = media_upload.handler({
+        'httpMethod': 'POST',
+        'headers': {'X-Auth-Token': token},
+        'queryStringParameters': {'action': 'upload_chunk', 'upload_id': upload_id, 'index': '0'},
+        'body': base64.b64encode(content).decode()
+    }, None)
+    assert response['statusCode'] == 200
+    status, _, body = call(media_upload, 'POST', token, {'action': 'complete_upload', 'upload_id': upload_id})
+    assert status == 200
+    return body['media']
+
+def create_chat(call, messenger_api, token, member_ids, name='Team'):
+    _, _, body = call(messenger_api, 'POST', token, {'action': 'create_chat', 'chat_type': 'group', 'name': name, 'member_ids': member_ids})
+    return body['chat_id']
+
+def send(call, messenger_api, token, chat_id, **fields):
+    return call(messenger_api, 'POST', token, {'action': 'send_message', 'chat_id': chat_id, 'message_type': 'image', **fields})
+
+def can_fetch(call, media_upload, token, sha256):
+    return call(media_upload, 'GET', token, {'action': 'media', 'sha256': sha256})[0] == 200
+
+def test_media_is_shared_only_through_messages_that_passed_the_check(messenger_api, media_upload, make_user, call, store):
+    _, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    carol, _ = make_user('carol')
+    _, mallory_token = make_user('mallory')
+    team = create_chat(call, messenger_api, alice_token, [bob])
+    bobs_chat = create_chat(call, messenger_api, bob_token, [carol], name='Bob and Carol')
+    mallorys_chat = create_chat(call, messenger_api, mallory_token, [], name='Mallory')
+
+    media = upload(call, media_upload, alice_token, b'\xff\xd8 not really a jpeg')
+    sha256 = media['sha256']
+    assert sha256 == hashlib.sha256(b'\xff\xd8 not really a jpeg').hexdigest()
+
+    # Knowing the hash, or the URL derived from it, does not let anyone attach the blob
+    assert send(call, messenger_api, mallory_token, mallorys_chat, media_sha256=sha256)[0] == 404
+    assert send(call, messenger_api, mallory_token, mallorys_chat, media_url=media['media_url'])[0] == 400
+    _, _, body = call(messenger_api, 'POST', mallory_token, {'action': 'send_messages', 'messages': [
+        {'chat_id': mallorys_chat, 'message_type': 'image', 'media_sha256': sha256},
+        {'chat_id': mallorys_chat, 'content': 'text still goes through'},
+    ]})
+    assert [result.get('statusCode') for result in body['results']] == [404, None]
+    assert not can_fetch(call, media_upload, mallory_token, sha256)
+    assert not can_fetch(call, media_upload, bob_token, sha256)
+
+    status, _, body = send(call, messenger_api, alice_token, team, media_sha256=sha256, media_url='https://example.com/ignored')
+    assert status == 200
+    assert (body['media_url'], body['file_size']) == (media['media_url'], media['file_size'])
+    assert can_fetch(call, media_upload, bob_token, sha256)
+
+    # Bob can see the blob in the team chat, so he may forward it
+    assert send(call, messenger_api, bob_token, bobs_chat, media_sha256=sha256)[0] == 200
+    assert not can_fetch(call, media_upload, mallory_token, sha256)
@@ -0,0 +1,116 @@
+from array import array
+
+import pytest
+
+from members import MembershipCache
+
+@pytest.fixture
+def memberships():
+    return MembershipCache(max_chats=2, ttl=15, hot_threshold=3)
+
+def test_membership_cache_answers_cached_chats(memberships, clock):
+    assert memberships.lookup(1, 5) is None
+    memberships.put(1, [2, 5, 9], memberships.epoch())
+    assert memberships.lookup(1, 5) is True
+    assert memberships.lookup(1, 6) is False
+    snapshot = memberships.snapshot()
+    assert (snapshot['hits'], snapshot['misses'], snapshot['negative_checks']) == (1, 1, 1)
+    assert snapshot['members'] == 3
+
+def test_membership_cache_expires_after_ttl(memberships, clock):
+    memberships.put(1, [5], memberships.epoch())
+    clock.advance(15)
+    assert memberships.lookup(1, 5) is None
+
+def test_membership_cache_drops_loads_that_raced_an_invalidation(memberships, clock):
+    epoch = memberships.epoch()
+    memberships.invalidate(1)
+    memberships.put(1, [5], epoch)
+    assert memberships.lookup(1, 5) is None
+
+def test_membership_cache_heat_resets_each_window(memberships, clock):
+    assert [memberships.is_hot(1) for _ in range(3)] == [False, False, True]
+    clock.advance(15)
+    assert memberships.is_hot(1) is False
+
+def test_membership_cache_evicts_least_recently_used(memberships, clock):
+    for chat_id in (1, 2):
+        memberships.put(chat_id, [5], memberships.epoch())
+    memberships.lookup(1, 5)
+    memberships.put(3, [5], memberships.epoch())
+    assert memberships.lookup(2, 5) is None
+    assert memberships.lookup(1, 5) is True
+
+def test_membership_cache_skips_uncacheable_chats_for_a_ttl(memberships, clock):
+    memberships.mark_uncacheable(1)
+    assert not any(memberships.is_hot(1) for _ in range(5))
+    clock.advance(15)
+    assert [memberships.is_hot(1) for _ in range(3)] == [False, False, True]
+
+class FakeCursor:
+    '''Answers the two membership statements from a fixed member list.'''
+    def __init__(self, members):
+        self.members = members
+        self.connection = type('Connection', (), {'prepared': set()})()
+        self.executed = []
+
+    def execute(self, sql, params=()):
+        verb, name = sql.split()[:2]
+        if verb == 'EXECUTE':
+            self.executed.append(name)
+            self.params = params
+
+    def fetchone(self):
+        if self.executed[-1] == 'chat_member_ids':
+            return (array('i', self.members[:self.params[1]]),)
+        return (1,) if self.params[1] in self.members else None
+
+def test_is_member_loads_hot_chats_once(monkeypatch, clock):
+    import members
+    monkeypatch.setattr(members, 'membership_cache', MembershipCache(10, 15, 2))
+    cursor = FakeCursor([1, 2, 3])
+    assert [members.is_member(cursor, 7, user_id) for user_id in (1, 2, 3, 4)] == [True, True, True, False]
+    # First check is cold, the second loads the chat, the third is a hit, the miss goes to the database
+    assert cursor.executed == ['chat_membership', 'chat_member_ids', 'chat_membership']
+
+def test_is_member_falls_back_for_chats_too_large_to_cache(monkeypatch, clock):
+    import members
+    monkeypatch.setattr(members, 'membership_cache', MembershipCache(10, 15, 1))
+    monkeypatch.setattr(members, 'MEMBERSHIP_CACHE_MAX_MEMBERS', 2)
+    cursor = FakeCursor([1, 2, 3])
+    assert [members.is_member(cursor, 7, 3) for _ in range(3)] == [True, True, True]
+    assert cursor.executed == ['chat_member_ids', 'chat_membership', 'chat_membership', 'chat_membership']
+
+def send(call, messenger_api, token, chat_id, content='hi'):
+    return call(messenger_api, 'POST', token, {'action': 'send_message', 'chat_id': chat_id, 'content': content})[0]
+
+def test_send_message_reloads_members_after_changes(messenger_api, make_user, call, monkeypatch):
+    import members
+    monkeypatch.setattr(members, 'membership_cache', MembershipCache(10, 15, 2))
+    _, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    carol, carol_token = make_user('carol')
+    _, _, body = call(messenger_api, 'POST', alice_token, {'action': 'create_chat', 'chat_type': 'group', 'name': 'Team', 'member_ids': [bob]})
+    chat = body['chat_id']
+
+    assert [send(call, messenger_api, token, chat) for token in (alice_token, bob_token, bob_token)] == [200, 200, 200]
+    assert members.membership_cache.snapshot()['loads'] == 1
+    assert send(call, messenger_api, carol_token, chat) == 403
+
+    call(messenger_api, 'POST', alice_token, {'action': 'remove_members', 'chat_id': chat, 'member_ids': [bob]})
+    call(messenger_api, 'POST', alice_token, {'action': 'add_members', 'chat_id': chat, 'member_ids': [carol]})
+    assert [send(call, messenger_api, token, chat) for token in (bob_token, carol_token, carol_token)] == [403, 200, 200]
+    assert members.membership_cache.snapshot()['loads'] == 2
+
+def test_send_message_checks_chats_too_large_to_cache_directly(messenger_api, make_user, call, monkeypatch):
+    import members
+    monkeypatch.setattr(members, 'membership_cache', MembershipCache(10, 15, 1))
+    monkeypatch.setattr(members, 'MEMBERSHIP_CACHE_MAX_MEMBERS', 1)
+    _, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    _, _, body = call(messenger_api, 'POST', alice_token, {'action': 'create_chat', 'chat_type': 'group', 'name': 'Team', 'member_ids': [bob]})
+    chat = body['chat_id']
+
+    assert [send(call, messenger_api, bob_token, chat) for _ in range(3)] == [200, 200, 200]
+    snapshot = members.membership_cache.snapshot()
+    assert (snapshot['loads'], snapshot['uncacheable']) == (0, 1)
@@ -0,0 +1,104 @@
+def create_chat(call, messenger_api, token, member_ids, name='Team'):
+    status, _, body = call(messenger_api, 'POST', token, {'action': 'create_chat', 'chat_type': 'group', 'name': name, 'member_ids': member_ids})
+    assert status == 200
+    return body['chat_id']
+
+def test_send_messages_maps_results_to_batch_positions(messenger_api, make_user, call, database):
+    alice, alice_token = make_user('alice')
+    bob, _ = make_user('bob')
+    _, carol_token = make_user('carol')
+    team = create_chat(call, messenger_api, alice_token, [bob])
+    other = create_chat(call, messenger_api, carol_token, [], name='Other')
+
+    batch = [{'chat_id': team, 'content': f'message {number}'} for number in range(6)]
+    batch[2] = {'chat_id': other, 'content': 'not a member'}
+    batch[4] = {'chat_id': team, 'content': ''}
+    status, _, body = call(messenger_api, 'POST', alice_token, {'action': 'send_messages', 'messages': batch})
+
+    assert status == 200
+    assert (body['sent'], body['failed']) == (4, 2)
+    assert [result['index'] for result in body['results']] == list(range(6))
+    assert [result.get('statusCode') for result in body['results']] == [None, None, 403, None, 400, None]
+
+    cursor = database.cursor()
+    sent = [result for result in body['results'] if result['status'] == 'sent']
+    cursor.execute("SELECT id, content FROM messages WHERE id = ANY(%s)", ([result['message_id'] for result in sent],))
+    content = dict(cursor.fetchall())
+    assert all(content[result['message_id']] == batch[result['index']]['content'] for result in sent)
+
+    cursor.execute("SELECT last_message_id, last_message_preview FROM chats WHERE id = %s", (team,))
+    assert cursor.fetchone() == (max(content), 'message 5')
+    cursor.execute("SELECT unread_count FROM chat_members WHERE chat_id = %s AND user_id = %s", (team, bob))
+    assert cursor.fetchone()[0] == 4
+
+def test_list_messages_answers_304_until_the_chat_changes(messenger_api, make_user, call):
+    alice, alice_token = make_user('alice')
+    chat = create_chat(call, messenger_api, alice_token, [])
+    call(messenger_api, 'POST', alice_token, {'action': 'send_message', 'chat_id': chat, 'content': 'hello'})
+
+    query = {'action': 'list_messages', 'chat_id': chat}
+    status, headers, _ = call(messenger_api, 'GET', alice_token, query)
+    assert status == 200
+    etag = headers['ETag']
+    assert call(messenger_api, 'GET', alice_token, query, {'If-None-Match': etag})[0] == 304
+
+    call(messenger_api, 'POST', alice_token, {'action': 'send_message', 'chat_id': chat, 'content': 'again'})
+    status, headers, _ = call(messenger_api, 'GET', alice_token, query, {'If-None-Match': etag})
+    assert status == 200 and headers['ETag'] != etag
+
+def test_list_messages_etag_changes_when_a_lower_id_commits_late(messenger_api, make_user, call, database_url):
+    import psycopg2
+    from db import PooledConnection, run
+    alice, alice_token = make_user('alice')
+    chat = create_chat(call, messenger_api, alice_token, [])
+
+    # The slow sender has inserted its message but not yet touched the chat
+    slow = psycopg2.connect(database_url, connection_factory=PooledConnection)
+    cursor = slow.cursor()
+    run(cursor, messenger_api.INSERT_MESSAGE, (chat, alice, 'text', 'slow', None, None, None, None))
+    slow_id, slow_created_at = cursor.fetchone()
+
+    call(messenger_api, 'POST', alice_token, {'action': 'send_message', 'chat_id': chat, 'content': 'fast'})
+    query = {'action': 'list_messages', 'chat_id': chat}
+    _, headers, body = call(messenger_api, 'GET', alice_token, query)
+    assert [message['content'] for message in body['messages']] == ['fast']
+
+    run(cursor, messenger_api.TOUCH_CHAT, (slow_id, alice, 'text', 'slow', slow_created_at, chat))
+    slow.commit()
+    slow.close()
+
+    status, _, body = call(messenger_api, 'GET', alice_token, query, {'If-None-Match': headers['ETag']})
+    assert status == 200
+    assert [message['content'] for message in body['messages']] == ['slow', 'fast']
+
+def test_search_messages_ranks_only_the_callers_chats(messenger_api, make_user, call):
+    alice, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    _, carol_token = make_user('carol')
+    team = create_chat(call, messenger_api, alice_token, [bob])
+    other = create_chat(call, messenger_api, carol_token, [], name='Other')
+    for token, chat, content in [
+        (alice_token, team, 'Deploy the release tonight'),
+        (bob_token, team, 'Release notes for the release are ready'),
+        (bob_token, team, 'Lunch anyone?'),
+        (carol_token, other, 'Release party at eight'),
+    ]:
+        assert call(messenger_api, 'POST', token, {'action': 'send_message', 'chat_id': chat, 'content': content})[0] == 200
+
+    pages = []
+    query = {'action': 'search_messages', 'query': 'release', 'limit': 1}
+    while True:
+        status, _, body = call(messenger_api, 'GET', alice_token, query)
+        assert status == 200
+        pages.append([(message['chat_id'], message['snippet']) for message in body['messages']])
+        if not body['has_more']:
+            break
+        query['cursor'] = body['next_cursor']
+    assert pages == [
+        [(team, '<mark>Release</mark> notes for the <mark>release</mark> are ready')],
+        [(team, 'Deploy the <mark>release</mark> tonight')],
+    ]
+
+    _, _, body = call(messenger_api, 'GET', alice_token, {'action': 'search_messages', 'query': 'release', 'sort': 'recent'})
+    assert [message['snippet'] for message in body['messages']][0].startswith('<mark>Release</mark> notes')
+    assert call(messenger_api, 'GET', alice_token, {'action': 'search_messages', 'query': 'party', 'chat_id': other})[0] == 403
@@ -0,0 +1,93 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+def test_bind_user_fills_missing_ids(messenger_api):
+    data = {'chat_id': 3, 'sender_id': ''}
+    assert messenger_api.bind_user(data, 9) is None
+    assert data == {'chat_id': 3, 'user_id': 9, 'sender_id': 9}
+
+def test_bind_user_accepts_matching_ids_of_any_type(messenger_api):
+    assert messenger_api.bind_user({'user_id': '9', 'sender_id': 9}, 9) is None
+
+def test_bind_user_refuses_another_users_id(messenger_api):
+    error = messenger_api.bind_user({'sender_id': 10}, 9)
+    assert error['statusCode'] == 403
+    assert 'sender_id' in error['error']
+
+def test_reject_malformed_before_authentication(messenger_api):
+    assert messenger_api.reject_malformed('GET', {'action': 'list_messages', 'cursor': 'bad'})['error'] == 'Invalid cursor'
+    assert messenger_api.reject_malformed('POST', {'action': 'send_messages', 'messages': []})['statusCode'] == 400
+    too_many = [{'chat_id': 1, 'content': 'x'}] * (messenger_api.SEND_BATCH_MAX + 1)
+    assert messenger_api.reject_malformed('POST', {'action': 'send_messages', 'messages': too_many})['statusCode'] == 400
+
+def test_reject_malformed_passes_well_formed_requests(messenger_api):
+    cursor = messenger_api.encode_cursor('before', 42, datetime(2026, 3, 14))
+    assert messenger_api.reject_malformed('GET', {'action': 'list_messages', 'cursor': cursor}) is None
+    assert messenger_api.reject_malformed('GET', {'action': 'list_chats'}) is None
+    assert messenger_api.reject_malformed('POST', {'action': 'send_messages', 'messages': [{'chat_id': 1}]}) is None
+
+def test_message_cursor_round_trip(messenger_api):
+    created_at = datetime(2026, 3, 14, 9, 26, 53, 589793)
+    for direction in ('before', 'after'):
+        cursor = messenger_api.encode_cursor(direction, 42, created_at)
+        assert '=' not in cursor
+        assert messenger_api.decode_cursor(cursor) == (direction, 42, created_at)
+
+@pytest.mark.parametrize('raw', [
+    'sideways:42:2026-03-14T09:26:53',
+    'before:forty-two:2026-03-14T09:26:53',
+    'before:42:yesterday',
+    'before:42',
+])
+def test_message_cursor_rejects_malformed(messenger_api, raw):
+    cursor = base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+    assert messenger_api.decode_cursor(cursor) is None
+
+def test_message_cursor_rejects_garbage(messenger_api):
+    assert messenger_api.decode_cursor('!!not base64!!') is None
+    assert messenger_api.decode_cursor(base64.urlsafe_b64encode(b'\xff\xfe').decode()) is None
+
+def test_make_etag_is_weak_and_stable(messenger_api):
+    etag = messenger_api.make_etag('chats', 1, 'group')
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert etag == messenger_api.make_etag('chats', 1, 'group')
+    assert etag != messenger_api.make_etag('chats', 1, 'channel')
+
+def test_etag_matches(messenger_api):
+    etag = messenger_api.make_etag('messages', 5)
+    assert not messenger_api.etag_matches(None, etag)
+    assert not messenger_api.etag_matches('', etag)
+    assert messenger_api.etag_matches(etag, etag)
+    # Proxies may strip the weak prefix
+    assert messenger_api.etag_matches(etag[2:], etag)
+    assert messenger_api.etag_matches(f'W/"other", {etag}', etag)
+    assert messenger_api.etag_matches('*', etag)
+    assert not messenger_api.etag_matches('W/"other"', etag)
+
+def test_search_cursor_round_trip(messenger_api):
+    created_at = datetime(2026, 3, 14, 9, 26, 53)
+    recent = messenger_api.encode_search_cursor('recent', 7, created_at)
+    assert messenger_api.decode_search_cursor(recent, 'recent') == (7, created_at)
+
+    relevance = messenger_api.encode_search_cursor('relevance', 7, Decimal('0.123456'))
+    assert messenger_api.decode_search_cursor(relevance, 'relevance') == (7, Decimal('0.123456'))
+
+def test_search_cursor_is_bound_to_its_sort(messenger_api):
+    relevance = messenger_api.encode_search_cursor('relevance', 7, Decimal('0.5'))
+    assert messenger_api.decode_search_cursor(relevance, 'recent') is None
+    assert messenger_api.decode_search_cursor('garbage', 'relevance') is None
+
+def test_search_cursor_rejects_non_numeric_rank(messenger_api):
+    cursor = base64.urlsafe_b64encode(b'relevance:7:high').decode()
+    assert messenger_api.decode_search_cursor(cursor, 'relevance') is None
+
+def test_member_events_stay_under_notify_limit(messenger_api):
+    user_ids = list(range(2_000_000_000, 2_000_005_000))
+    events = messenger_api.member_events(4, 'added', user_ids)
+    assert [user_id for event in events for user_id in event['added']] == user_ids
+    assert all(len(json.dumps(event, separators=(',', ':'))) < 8000 for event in events)
+    assert messenger_api.member_events(4, 'removed', []) == []
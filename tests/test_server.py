@@ -0,0 +1,86 @@
+import asyncio
+import sys
+
+import pytest
+
+from conftest import SERVER_DIR, load_index
+
+@pytest.fixture(scope='module')
+def asgi():
+    # server/asgi.py imports native.py by name, as uvicorn --app-dir does
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+    return load_index(SERVER_DIR, 'server_asgi', 'asgi.py')
+
+def test_functions_get_private_helper_modules(asgi):
+    messenger_api = asgi.app.modules['messenger-api']
+    user_search = asgi.app.modules['user-search']
+    assert messenger_api.get_router.__module__ == 'function_messenger_api__db'
+    assert user_search.get_router.__module__ == 'function_user_search__db'
+    assert messenger_api.session_cache is not user_search.verify_session.__globals__['session_cache']
+
+@pytest.fixture
+def server(asgi, database_url, database, monkeypatch):
+    pytest.importorskip('asyncpg')
+    server = asgi.Server(('messenger-api',))
+    sessions = server.importers['messenger-api'].load('sessions')
+    members = server.importers['messenger-api'].load('members')
+    # Sampled threaded requests gain a Server-Timing header the native path never adds
+    monkeypatch.setattr(server.importers['messenger-api'].load('instrument'), 'INSTRUMENT_SAMPLE_RATE', 0)
+    monkeypatch.setattr(sessions, 'session_cache', sessions.SessionCache(
+        sessions.SESSION_CACHE_SIZE, sessions.SESSION_CACHE_TTL,
+        sessions.SESSION_NEGATIVE_CACHE_SIZE, sessions.SESSION_NEGATIVE_CACHE_TTL,
+    ))
+    monkeypatch.setattr(members, 'membership_cache', members.MembershipCache(
+        members.MEMBERSHIP_CACHE_CHATS, members.MEMBERSHIP_CACHE_TTL, members.MEMBERSHIP_HOT_THRESHOLD,
+    ))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.native.start(database_url))
+    yield server, loop
+    loop.run_until_complete(server.native.close())
+    loop.close()
+    server.executor.shutdown()
+
+def test_native_reads_answer_like_the_threaded_handler(server, make_user, call):
+    server, loop = server
+    messenger_api = server.modules['messenger-api']
+    alice, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    _, _, body = call(messenger_api, 'POST', alice_token, {'action': 'create_chat', 'chat_type': 'group', 'name': 'Team', 'member_ids': [bob]})
+    chat = body['chat_id']
+    for number in range(5):
+        call(messenger_api, 'POST', bob_token, {'action': 'send_message', 'chat_id': chat, 'content': f'message {number}'})
+
+    def both(query, headers=None):
+        event = {
+            'httpMethod': 'GET',
+            'headers': {'X-Auth-Token': alice_token, **(headers or {})},
+            'queryStringParameters': {key: str(value) for key, value in query.items()},
+            'requestContext': {'requestId': 'test'},
+        }
+        assert server.native.accepts(event)
+        native = loop.run_until_complete(server.native.handle(dict(event)))
+        threaded = server.invoke('messenger-api', dict(event, queryStringParameters=dict(event['queryStringParameters'])))
+        assert native == threaded
+        return native
+
+    listed = both({'action': 'list_chats'})
+    assert listed['statusCode'] == 200 and '"Team"' in listed['body']
+    assert both({'action': 'list_chats'}, {'If-None-Match': listed['headers']['ETag']})['statusCode'] == 304
+
+    query = {'action': 'list_messages', 'chat_id': chat, 'limit': 2}
+    pages = 0
+    while True:
+        page = both(query)
+        assert page['statusCode'] == 200
+        pages += 1
+        next_cursor = messenger_api.json.loads(page['body'])['next_cursor']
+        if not next_cursor:
+            break
+        query['cursor'] = next_cursor
+    assert pages == 3
+    latest = both({'action': 'list_messages', 'chat_id': chat})
+    assert both({'action': 'list_messages', 'chat_id': chat}, {'If-None-Match': latest['headers']['ETag']})['statusCode'] == 304
+    assert both({'action': 'list_messages', 'chat_id': chat, 'cursor': 'bad'})['statusCode'] == 400
+    assert both({'action': 'list_chats', 'user_id': bob})['statusCode'] == 403
+    assert both({'action': 'list_messages', 'chat_id': chat}, {'X-Auth-Token': 'nobody'})['statusCode'] == 401
@@ -0,0 +1,64 @@
+import pytest
+
+from sessions import SessionCache
+
+@pytest.fixture
+def sessions():
+    return SessionCache(max_size=2, ttl=60, negative_max_size=2, negative_ttl=10)
+
+def test_session_cache_hit_and_miss(sessions, clock):
+    assert sessions.get('a') == (False, None)
+    sessions.put('a', 1, expires_in=3600)
+    assert sessions.get('a') == (True, 1)
+    assert sessions.stats['hits'] == 1 and sessions.stats['misses'] == 1
+
+def test_session_cache_never_outlives_the_session(sessions, clock):
+    sessions.put('a', 1, expires_in=5)
+    clock.advance(5)
+    assert sessions.get('a') == (False, None)
+
+def test_session_cache_expires_after_ttl(sessions, clock):
+    sessions.put('a', 1, expires_in=3600)
+    clock.advance(59)
+    assert sessions.get('a') == (True, 1)
+    clock.advance(1)
+    assert sessions.get('a') == (False, None)
+
+def test_session_cache_remembers_unknown_tokens_briefly(sessions, clock):
+    sessions.put_negative('bad')
+    assert sessions.get('bad') == (True, None)
+    clock.advance(10)
+    assert sessions.get('bad') == (False, None)
+
+def test_session_cache_evicts_least_recently_used(sessions, clock):
+    sessions.put('a', 1, expires_in=3600)
+    sessions.put('b', 2, expires_in=3600)
+    sessions.get('a')
+    sessions.put('c', 3, expires_in=3600)
+    assert sessions.get('b') == (False, None)
+    assert sessions.get('a') == (True, 1)
+    assert sessions.stats['evictions'] == 1
+
+def test_session_cache_invalidate(sessions, clock):
+    sessions.put('a', 1, expires_in=3600)
+    sessions.put_negative('bad')
+    sessions.invalidate('a')
+    sessions.invalidate('bad')
+    assert sessions.get('a') == (False, None)
+    assert sessions.get('bad') == (False, None)
+    assert sessions.snapshot()['invalidations'] == 1
+
+def test_logout_reaches_caches_in_other_processes(messenger_api, auth_login, make_user, call, clock, monkeypatch):
+    import sessions
+    _, token = make_user('alice')
+    assert call(messenger_api, 'GET', token, {'action': 'list_chats'})[0] == 200
+
+    # Logging out in auth-login only clears auth-login's own cache
+    monkeypatch.setattr(auth_login, 'invalidate_session', lambda token: None)
+    assert call(auth_login, 'POST', token, {'action': 'logout'})[0] == 200
+
+    # messenger-api keeps its cached answer until the next revocation poll
+    assert call(messenger_api, 'GET', token, {'action': 'list_chats'})[0] == 200
+    clock.advance(sessions.SESSION_REVOCATION_POLL)
+    assert call(messenger_api, 'GET', token, {'action': 'list_chats'})[0] == 401
+    assert sessions.session_cache.stats['invalidations'] == 1
@@ -0,0 +1,16 @@
+import base64
+
+import pytest
+
+def test_cursor_round_trip(user_search):
+    cursor = user_search.encode_cursor(1, 870, 'анна:smith', 42)
+    assert '=' not in cursor
+    assert user_search.decode_cursor(cursor) == (1, 870, 'анна:smith', 42)
+
+@pytest.mark.parametrize('raw', [b'[1, 870, "anna"]', b'{"bucket": 1}', b'[1, "high", "anna", 42]', b'not json'])
+def test_cursor_rejects_malformed(user_search, raw):
+    assert user_search.decode_cursor(base64.urlsafe_b64encode(raw).decode()) is None
+
+def test_escape_like(user_search):
+    assert user_search.escape_like('50%_off\\') == '50\\%\\_off\\\\'
+    assert user_search.escape_like('anna') == 'anna'